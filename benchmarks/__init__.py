@@ -0,0 +1 @@
+"""Benchmarks for the Edit Math Supervisor. Run modules with `python -m benchmarks.<name>`."""
@@ -0,0 +1,89 @@
+"""
+Baseline files shared by the benchmarks: load, merge-and-write, and regression checks.
+
+A baseline is {"python", "platform", "machine", ..., "results": {case_id: {metric: value}}}.
+"""
+
+import json
+import os
+import platform
+from typing import Dict, Iterable, List, Optional
+
+
+def load_baseline(path: str) -> Dict[str, Dict]:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f).get("results", {})
+
+
+def make_document(results: Dict[str, Dict], **extra) -> Dict:
+    document = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    document.update(extra)
+    return document
+
+
+def write_json(path: str, document: Dict) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(document, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def update_baseline(path: str, results: Dict[str, Dict], **extra) -> None:
+    """Partial runs update only their own cases; the rest of the stored baseline is kept."""
+    merged = load_baseline(path)
+    merged.update(results)
+    write_json(path, make_document(merged, **extra))
+
+
+def compare(
+    results: Dict[str, Dict],
+    baseline: Dict[str, Dict],
+    time_metrics: Iterable[str],
+    time_threshold: float,
+    noise_floor_s: float,
+    rss_metrics: Iterable[str] = (),
+    rss_threshold: float = 1.0,
+    rss_noise_floor: Optional[Dict[str, float]] = None,
+) -> List[str]:
+    """
+    Returns one line per metric that got worse than baseline * threshold.
+    rss_noise_floor: per memory metric, the absolute growth (in the metric's own unit) ignored as noise.
+    """
+    time_metrics, rss_metrics = tuple(time_metrics), tuple(rss_metrics)
+    regressions = []
+    for case_id, current in sorted(results.items()):
+        previous = baseline.get(case_id)
+        if not previous or "error" in previous:
+            continue
+        if "error" in current:
+            regressions.append(f"{case_id}: {current['error']}")
+            continue
+        for metric in time_metrics + rss_metrics:
+            if metric not in current or metric not in previous:
+                continue
+            old, new = previous[metric], current[metric]
+            threshold = rss_threshold if metric in rss_metrics else time_threshold
+            # Разница меньше порога шума — планировщик, а не регрессия.
+            if metric in time_metrics and new - old < noise_floor_s:
+                continue
+            if metric in rss_metrics and rss_noise_floor and new - old < rss_noise_floor.get(metric, 0):
+                continue
+            if old > 0 and new > old * threshold:
+                regressions.append(f"{case_id}: {metric} {old:.4g} -> {new:.4g} ({new / old:.2f}x, limit {threshold:.2f}x)")
+    return regressions
+
+
+def report(regressions: List[str], baseline_path: str) -> int:
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) against {baseline_path}:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print(f"\nNo regressions against {baseline_path}.")
+    return 0
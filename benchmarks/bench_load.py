@@ -0,0 +1,380 @@
+"""
+End-to-end load test: N concurrent MCP clients drive the full EASM loop
+(scan_dependencies -> calculate_integrity_score [-> 'ok'] -> commit_safe_edit)
+against a server started from this checkout, over SSE and over stdio.
+
+SSE runs one server process shared by every client. stdio starts one server per
+client, as an IDE does. Each client edits its own copy of a corpus file in a
+temporary workspace, so sessions never race for the same approval or base hash.
+Timing starts once every client has finished the MCP handshake.
+
+Per transport it reports:
+    throughput          completed EASM sessions per second
+    p50/p95/p99         latency per tool, over every call
+    error rate          failed calls / all calls: JSON-RPC and tool errors, and EASM
+                        answers the loop did not expect (e.g. a refused commit)
+    server RSS          sampled every --rss-interval seconds and summed over the
+                        server processes and their scan workers (read from /proc,
+                        so Linux only)
+
+    python -m benchmarks.bench_load
+    python -m benchmarks.bench_load --transports sse --clients 50 --sessions 10
+    python -m benchmarks.bench_load --clients 8 --bucket medium --output load.json
+
+This is a tracking report, not a regression gate: keep the JSON output of each
+release and compare them.
+"""
+
+import argparse
+import asyncio
+import os
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from typing import Any, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.baseline import make_document, write_json  # noqa: E402
+from benchmarks.corpus import EXTENSIONS, SIZE_BUCKETS, all_cases, generate, target_for  # noqa: E402
+
+SERVER_SCRIPT = os.path.join(ROOT, "mcp_edit_math.py")
+TRANSPORTS = ("sse", "stdio")
+TOOLS = ("scan_dependencies", "calculate_integrity_score", "commit_safe_edit")
+COMMENT_PREFIX = {"python": "#", "javascript": "//", "typescript": "//"}
+
+_DEPENDENCIES = re.compile(r"Found Dependencies: (.*)")
+_BASE_HASH = re.compile(r"BASE HASH: ([0-9a-f]{64})")
+
+
+class SessionFailed(Exception):
+    pass
+
+
+class Recorder:
+    """Latencies and errors of every call, per tool."""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {tool: [] for tool in TOOLS}
+        self.errors: Dict[str, int] = {tool: 0 for tool in TOOLS}
+        self.sessions = 0
+        self.failed_sessions = 0
+        self.first_error = ""
+
+    def fail(self, tool: str, message: str) -> None:
+        self.errors[tool] = self.errors.get(tool, 0) + 1
+        if not self.first_error:
+            self.first_error = f"{tool}: {message[:300]}"
+
+
+def _server_env(workspace: str) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.pop("PORT", None)
+    env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    # Индексы и состояние сервера — внутри временного каталога, а не в ~/.cache.
+    env["EDIT_MATH_CACHE_DIR"] = os.path.join(workspace, ".cache")
+    return env
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _rss_kb(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status", "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def _descendants(root: int) -> List[int]:
+    """All processes below `root`: servers and their scan workers."""
+    children: Dict[int, List[int]] = {}
+    if not os.path.isdir("/proc"):
+        return []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r", encoding="ascii", errors="replace") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    found, stack = [], [root]
+    while stack:
+        for child in children.get(stack.pop(), []):
+            found.append(child)
+            stack.append(child)
+    return found
+
+
+async def _sample_rss(pids, interval: float, started: float, samples: List[List[float]]) -> None:
+    while True:
+        current = pids()
+        if current:
+            samples.append([round(time.perf_counter() - started, 3), sum(_rss_kb(pid) for pid in current), len(current)])
+        await asyncio.sleep(interval)
+
+
+async def _call(session, recorder: Recorder, tool: str, arguments: Dict[str, Any], expect) -> str:
+    started = time.perf_counter()
+    try:
+        result = await session.call_tool(tool, arguments)
+    except Exception as e:
+        recorder.fail(tool, f"{type(e).__name__}: {e}")
+        raise SessionFailed(tool)
+    elapsed = time.perf_counter() - started
+    text = "".join(getattr(content, "text", "") for content in result.content)
+    if result.isError or not expect(text):
+        recorder.fail(tool, text)
+        raise SessionFailed(tool)
+    recorder.latencies[tool].append(elapsed)
+    return text
+
+
+async def _easm_session(session, recorder: Recorder, workload: Dict[str, str], edit_text: str) -> None:
+    path, target = workload["path"], workload["target"]
+    scan = await _call(session, recorder, "scan_dependencies",
+                       {"file_path": path, "target_function": target, "language": workload["language"]},
+                       lambda text: _BASE_HASH.search(text) is not None)
+    found = _DEPENDENCIES.search(scan).group(1).strip() if _DEPENDENCIES.search(scan) else "None"
+    dependencies = [] if found == "None" else [name.strip() for name in found.split(",")]
+    arguments = {"target_function": target, "dependencies": dependencies, "verified_dependencies": dependencies,
+                 "file_path": path, "proposed_header": target}
+    granted = lambda text: "ACCESS GRANTED" in text or "(Safe)" in text  # noqa: E731
+    score = await _call(session, recorder, "calculate_integrity_score", arguments,
+                        lambda text: "STRICT MODE" in text or granted(text))
+    if "STRICT MODE" in score:
+        await _call(session, recorder, "calculate_integrity_score", dict(arguments, user_last_message="ok"), granted)
+    await _call(session, recorder, "commit_safe_edit", {
+        "target_function": target, "file_path": path, "base_hash": _BASE_HASH.search(scan).group(1),
+        "replacements": [{"start_line": 1, "end_line": 0, "text": edit_text}],
+    }, lambda text: "SAFE COMMIT" in text)
+
+
+async def _client(open_session, recorder: Recorder, workload: Dict[str, str], client_id: int, sessions: int,
+                  ready: List[int], clients: int, go: asyncio.Event, timeout: float) -> None:
+    initialized = False
+    try:
+        async with open_session(timeout) as session:
+            initialized = True
+            ready[0] += 1
+            if ready[0] == clients:
+                go.set()
+            await go.wait()
+            for n in range(sessions):
+                edit = f"{COMMENT_PREFIX[workload['language']]} load test: client {client_id}, session {n}"
+                try:
+                    await _easm_session(session, recorder, workload, edit)
+                    recorder.sessions += 1
+                except SessionFailed:
+                    recorder.failed_sessions += 1
+    except Exception as e:
+        if not recorder.first_error:
+            recorder.first_error = f"client {client_id}: {type(e).__name__}: {e}"
+        recorder.failed_sessions += sessions
+    finally:
+        if not initialized:
+            # Клиент, не прошедший рукопожатие, не должен держать остальных у старта.
+            ready[0] += 1
+            if ready[0] == clients:
+                go.set()
+
+
+def _sse_opener(url: str):
+    from mcp import ClientSession
+    from mcp.client.sse import sse_client
+
+    @asynccontextmanager
+    async def open_session(timeout: float):
+        async with sse_client(url, timeout=timeout, sse_read_timeout=timeout) as (read, write):
+            async with ClientSession(read, write, read_timeout_seconds=timedelta(seconds=timeout)) as session:
+                await session.initialize()
+                yield session
+    return open_session
+
+
+def _stdio_opener(env: Dict[str, str], errlog):
+    from mcp import ClientSession
+    from mcp.client.stdio import StdioServerParameters, stdio_client
+
+    params = StdioServerParameters(command=sys.executable, args=[SERVER_SCRIPT], env=env, cwd=ROOT)
+
+    @asynccontextmanager
+    async def open_session(timeout: float):
+        async with stdio_client(params, errlog=errlog) as (read, write):
+            async with ClientSession(read, write, read_timeout_seconds=timedelta(seconds=timeout)) as session:
+                await session.initialize()
+                yield session
+    return open_session
+
+
+def _wait_for_port(port: int, proc: subprocess.Popen, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"SSE server exited with status {proc.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"SSE server did not listen on port {port} within {timeout:.0f}s")
+
+
+def _prepare_workspace(workspace: str, bucket: str, clients: int) -> List[Dict[str, str]]:
+    """One file per client, cycling through the non-HTML corpus shapes of the bucket."""
+    cases = [case for case in all_cases([bucket]) if case.language != "html"]
+    sources = {}
+    workloads = []
+    for client_id in range(clients):
+        case = cases[client_id % len(cases)]
+        if case not in sources:
+            sources[case] = generate(case)
+        path = os.path.join(workspace, f"client{client_id}_{case.language}_{case.shape}{EXTENSIONS[case.language]}")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(sources[case])
+        workloads.append({"path": path, "language": case.language, "target": target_for(case), "case": case.case_id})
+    return workloads
+
+
+def _percentile(ordered: List[float], q: float) -> float:
+    if len(ordered) == 1:
+        return ordered[0]
+    return statistics.quantiles(ordered, n=100, method="inclusive")[round(q * 100) - 1]
+
+
+async def run_transport(transport: str, clients: int, sessions: int, bucket: str, rss_interval: float, timeout: float) -> Dict[str, Any]:
+    workspace = tempfile.mkdtemp(prefix="edit-math-load-")
+    server = None
+    errlog = open(os.path.join(workspace, "server.log"), "w", encoding="utf-8")
+    try:
+        workloads = _prepare_workspace(workspace, bucket, clients)
+        env = _server_env(workspace)
+        if transport == "sse":
+            port = _free_port()
+            server = subprocess.Popen([sys.executable, SERVER_SCRIPT], cwd=ROOT, env=dict(env, PORT=str(port)),
+                                      stdout=errlog, stderr=subprocess.STDOUT)
+            _wait_for_port(port, server, timeout)
+            open_session = _sse_opener(f"http://127.0.0.1:{port}/sse")
+            pids = lambda: [server.pid] + _descendants(server.pid)  # noqa: E731
+        else:
+            open_session = _stdio_opener(env, errlog)
+            pids = lambda: _descendants(os.getpid())  # noqa: E731
+
+        recorder = Recorder()
+        ready, go = [0], asyncio.Event()
+        samples: List[List[float]] = []
+        tasks = [
+            asyncio.create_task(_client(open_session, recorder, workloads[i], i, sessions, ready, clients, go, timeout))
+            for i in range(clients)
+        ]
+        await go.wait()
+        started = time.perf_counter()
+        sampler = asyncio.create_task(_sample_rss(pids, rss_interval, started, samples))
+        await asyncio.gather(*tasks)
+        wall = time.perf_counter() - started
+        sampler.cancel()
+        await asyncio.gather(sampler, return_exceptions=True)
+    finally:
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        errlog.close()
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    calls = sum(len(values) for values in recorder.latencies.values()) + sum(recorder.errors.values())
+    errors = sum(recorder.errors.values())
+    latency = {}
+    for tool in TOOLS:
+        ordered = sorted(recorder.latencies[tool])
+        latency[tool] = {"count": len(ordered), "errors": recorder.errors[tool]}
+        if ordered:
+            latency[tool].update({
+                "mean_s": statistics.fmean(ordered),
+                "p50_s": _percentile(ordered, 0.50),
+                "p95_s": _percentile(ordered, 0.95),
+                "p99_s": _percentile(ordered, 0.99),
+            })
+    result = {
+        "clients": clients,
+        "sessions_per_client": sessions,
+        "sessions_ok": recorder.sessions,
+        "sessions_failed": recorder.failed_sessions,
+        "wall_s": wall,
+        "throughput_sessions_s": recorder.sessions / wall if wall else 0.0,
+        "calls": calls,
+        "errors": errors,
+        "error_rate": errors / calls if calls else 0.0,
+        "latency": latency,
+        "rss_peak_kb": max((sample[1] for sample in samples), default=0),
+        "rss_samples": samples,
+    }
+    if recorder.first_error:
+        result["first_error"] = recorder.first_error
+    return result
+
+
+def _print_result(case_id: str, result: Dict[str, Any]) -> None:
+    print(
+        f"{case_id}: {result['sessions_ok']}/{result['sessions_ok'] + result['sessions_failed']} sessions in "
+        f"{result['wall_s']:.2f}s = {result['throughput_sessions_s']:.1f}/s | calls {result['calls']} | "
+        f"error rate {result['error_rate'] * 100:.2f}% | peak server RSS {result['rss_peak_kb'] / 1024:.1f} MB",
+        flush=True,
+    )
+    for tool, stats in result["latency"].items():
+        if stats["count"]:
+            print(f"  {tool:<28}{stats['count']:>6} calls  p50 {stats['p50_s'] * 1000:>8.1f}ms  "
+                  f"p95 {stats['p95_s'] * 1000:>8.1f}ms  p99 {stats['p99_s'] * 1000:>8.1f}ms  errors {stats['errors']}")
+    if result.get("first_error"):
+        print(f"  first error: {result['first_error']}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--transports", default=",".join(TRANSPORTS), help="comma-separated: sse, stdio")
+    parser.add_argument("--clients", type=int, default=10, help="concurrent MCP clients")
+    parser.add_argument("--sessions", type=int, default=5, help="EASM sessions per client")
+    parser.add_argument("--bucket", default="small", choices=sorted(SIZE_BUCKETS), help="corpus size of the edited files")
+    parser.add_argument("--rss-interval", type=float, default=0.25, help="seconds between server RSS samples")
+    parser.add_argument("--timeout", type=float, default=120.0, help="per-call and server start timeout, seconds")
+    parser.add_argument("--output", default="", help="also write results to this JSON file")
+    args = parser.parse_args()
+
+    transports = [name.strip() for name in args.transports.split(",") if name.strip()]
+    unknown = set(transports) - set(TRANSPORTS)
+    if unknown:
+        parser.error(f"unknown transport(s): {', '.join(sorted(unknown))}")
+
+    results: Dict[str, Dict[str, Any]] = {}
+    for transport in transports:
+        case_id = f"{transport}/{args.clients}x{args.sessions}/{args.bucket}"
+        results[case_id] = asyncio.run(run_transport(transport, args.clients, args.sessions, args.bucket,
+                                                     args.rss_interval, args.timeout))
+        _print_result(case_id, results[case_id])
+
+    if args.output:
+        write_json(args.output, make_document(results, clients=args.clients, sessions=args.sessions, bucket=args.bucket))
+    return 1 if any(result["errors"] for result in results.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""
+Python backend benchmark: `ast` against tree-sitter-python on the Python corpus.
+
+Per case it reports:
+    ast_s / ts_s            cold parse + definition index
+    ast_edit_s / ts_edit_s  rescan after a one-line edit through the parse cache
+                            (ast reparses the whole file, tree-sitter only the edit)
+    defs                    definitions found by ast on the intact file
+    broken_defs             definitions tree-sitter still recovers after a syntax
+                            error is inserted mid-file (ast finds none)
+
+    python -m benchmarks.bench_python
+    python -m benchmarks.bench_python --buckets small,medium --repeats 5 --output python.json
+
+This is a comparison report, not a regression gate: there is no baseline.
+Requires the optional grammar: pip install "mcp-edit-math[python]".
+"""
+
+import argparse
+import ast
+import os
+import sys
+import time
+from typing import Dict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.baseline import make_document, write_json  # noqa: E402
+from benchmarks.corpus import SIZE_BUCKETS, Case, all_cases, generate  # noqa: E402
+
+
+def _best(repeats: int, fn) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def _insert_at_middle_line(source: bytes, text: bytes) -> bytes:
+    middle = source.index(b"\n", len(source) // 2) + 1
+    return source[:middle] + text + source[middle:]
+
+
+def _edit_cost(engine, backend: str, original: bytes, edited: bytes, repeats: int) -> float:
+    """Best time to rescan after an edit: every repeat flips between the two versions of the file."""
+    engine.PYTHON_BACKEND = backend
+    path = os.path.join(ROOT, f"__bench_{backend}.py")
+    engine._parse_python_index(original, path)
+    versions = [edited, original]
+    best = float("inf")
+    for i in range(max(2, repeats)):
+        source = versions[i % 2]
+        started = time.perf_counter()
+        engine._parse_python_index(source, path)
+        best = min(best, time.perf_counter() - started)
+    engine.PARSE_CACHE.clear()
+    return best
+
+
+def run_case(case: Case, repeats: int) -> Dict[str, float]:
+    import mcp_edit_math as engine
+
+    parser = engine.get_parser("python")
+    source = generate(case).encode("utf-8")
+    edited = _insert_at_middle_line(source, b"# edited\n")
+    broken = _insert_at_middle_line(source, b"def broken(:\n")
+    ts_index = lambda src: engine._build_python_ts_index(engine._ts_parse(parser, src))  # noqa: E731
+    return {
+        "size": len(source),
+        "ast_s": _best(repeats, lambda: engine._build_python_index(ast.parse(source))),
+        "ts_s": _best(repeats, lambda: ts_index(source)),
+        "ast_edit_s": _edit_cost(engine, "ast", source, edited, repeats),
+        "ts_edit_s": _edit_cost(engine, "tree-sitter", source, edited, repeats),
+        "defs": len(engine._build_python_index(ast.parse(source)).definitions),
+        "broken_defs": len(ts_index(broken).definitions),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--buckets", default=",".join(SIZE_BUCKETS), help="comma-separated size buckets")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", default="", help="also write results to this JSON file")
+    args = parser.parse_args()
+
+    import mcp_edit_math as engine
+
+    if engine.get_parser("python") is None:
+        print(f"tree-sitter-python is unavailable ({engine.GRAMMAR_ERRORS.get('python')}).")
+        print('Install it with: pip install "mcp-edit-math[python]"')
+        return 1
+
+    cases = [case for case in all_cases(args.buckets.split(",")) if case.language == "python"]
+    print(f"{'case':<26}{'size':>7}  {'ast':>9}{'ts':>9}  {'ast edit':>9}{'ts edit':>9}  {'defs':>6}{'broken':>8}")
+    results = {}
+    for case in cases:
+        row = results[case.case_id] = run_case(case, args.repeats)
+        print(
+            f"{case.case_id:<26}{row['size'] // 1024:>6}K  "
+            f"{row['ast_s'] * 1000:>7.1f}ms{row['ts_s'] * 1000:>7.1f}ms  "
+            f"{row['ast_edit_s'] * 1000:>7.1f}ms{row['ts_edit_s'] * 1000:>7.1f}ms  "
+            f"{row['defs']:>6}{row['broken_defs']:>8}",
+            flush=True,
+        )
+    if args.output:
+        write_json(args.output, make_document(results, repeats=args.repeats))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+"""
+Response format benchmark: the default text output against format="json" for
+scan_dependencies, calculate_integrity_score and commit_safe_edit on the corpus.
+
+Per case and tool it reports:
+    text_b / json_b / debug_b   response size in bytes (json with debug=true for scans)
+    wire_text_b / wire_json_b   the JSON-RPC message the transport sends for it
+                                (FastMCP ships a str result twice: as text content
+                                and as structuredContent)
+    tool_*_s                    best warm call time, caches hot
+    serialize_*_s               building and serializing that JSON-RPC message
+    parse_*_s                   client side: the regexes a text client needs to pull
+                                out the data, against one json.loads
+
+    python -m benchmarks.bench_response
+    python -m benchmarks.bench_response --buckets small,medium --repeats 7 --output response.json
+
+This is a comparison report, not a regression gate: there is no baseline.
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.baseline import make_document, write_json  # noqa: E402
+from benchmarks.corpus import EXTENSIONS, SIZE_BUCKETS, Case, all_cases, generate, target_for  # noqa: E402
+
+# Что текстовый клиент вынужден вытаскивать регулярками из ответа каждого инструмента.
+TEXT_PARSERS = {
+    "scan": (re.compile(r"Found Dependencies: (.*)"), re.compile(r"BASE HASH: (\w+)")),
+    "scan_all": (re.compile(r"^\s*(\S+) \((\w+), line (\d+)\): (.*)$", re.M), re.compile(r"BASE HASH: (\w+)")),
+    "score": (re.compile(r"STRICT MODE|ACCESS GRANTED|\(Safe\)"), re.compile(r"Reason: (.*)")),
+    "commit": (re.compile(r"SAFE COMMIT"), re.compile(r"NEW BASE HASH: (\w+)")),
+}
+
+
+def _best(repeats: int, fn: Callable[[], Any]) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def _wire(text: str) -> str:
+    """The JSON-RPC response the server writes for a tool that returned `text`."""
+    from mcp import types
+
+    result = types.CallToolResult(content=[types.TextContent(type="text", text=text)],
+                                  structuredContent={"result": text}, isError=False)
+    message = types.JSONRPCResponse(jsonrpc="2.0", id=1, result=result.model_dump(by_alias=True, mode="json", exclude_none=True))
+    return message.model_dump_json(by_alias=True, exclude_none=True)
+
+
+def _parse_text(kind: str, text: str) -> None:
+    first, second = TEXT_PARSERS[kind]
+    matches = first.findall(text)
+    second.search(text)
+    if kind == "scan" and matches:
+        [name.strip() for name in matches[0].split(",")]
+
+
+def _row(kind: str, call: Callable[[str], str], repeats: int, debug_call: Callable[[], str] = None) -> Dict[str, float]:
+    text, compact = call("text"), call("json")
+    wire_text, wire_json = _wire(text), _wire(compact)
+    row = {
+        "text_b": len(text.encode("utf-8")),
+        "json_b": len(compact.encode("utf-8")),
+        "wire_text_b": len(wire_text.encode("utf-8")),
+        "wire_json_b": len(wire_json.encode("utf-8")),
+        "tool_text_s": _best(repeats, lambda: call("text")),
+        "tool_json_s": _best(repeats, lambda: call("json")),
+        "serialize_text_s": _best(repeats, lambda: _wire(text)),
+        "serialize_json_s": _best(repeats, lambda: _wire(compact)),
+        "parse_text_s": _best(repeats, lambda: _parse_text(kind, text)),
+        "parse_json_s": _best(repeats, lambda: json.loads(compact)),
+    }
+    if debug_call is not None:
+        row["debug_b"] = len(debug_call().encode("utf-8"))
+    return row
+
+
+def run_case(case: Case, workspace: str, repeats: int) -> Dict[str, Dict[str, float]]:
+    import mcp_edit_math as engine
+
+    path = os.path.join(workspace, case.case_id.replace("/", "_") + EXTENSIONS[case.language])
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(generate(case))
+    target = target_for(case)
+    language = case.language
+    rows = {
+        "scan": _row("scan", lambda fmt: engine.scan_dependencies("", target, path, language, format=fmt), repeats,
+                     lambda: engine.scan_dependencies("", target, path, language, format="json", debug=True)),
+    }
+    if language != "html":
+        rows["scan_all"] = _row("scan_all", lambda fmt: engine.scan_dependencies("", engine.ALL_TARGETS, path, language, format=fmt),
+                                repeats, lambda: engine.scan_dependencies("", engine.ALL_TARGETS, path, language, format="json", debug=True))
+
+    def score(fmt: str) -> str:
+        # Каждый вызов — шаг 1 строгого режима: состояние сбрасывается, как после сканирования.
+        engine.APPROVAL_STATE[engine.get_state_key(path, target)] = "NONE"
+        return engine.calculate_integrity_score(target, ["a", "b"], ["a", "b"], path, format=fmt)
+
+    rows["score"] = _row("score", score, repeats)
+    comment = "#" if language == "python" else "//"
+    edit = [{"start_line": 1, "end_line": 1, "text": f"{comment} bench_response"}]
+    rows["commit"] = _row("commit", lambda fmt: engine.commit_safe_edit(target, path, replacements=edit, force_override=True, format=fmt),
+                          repeats)
+    return rows
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--buckets", default="small,medium", help="comma-separated size buckets")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", default="", help="also write results to this JSON file")
+    args = parser.parse_args()
+
+    unknown = set(args.buckets.split(",")) - set(SIZE_BUCKETS)
+    if unknown:
+        parser.error(f"unknown bucket(s): {', '.join(sorted(unknown))}")
+
+    workspace = tempfile.mkdtemp(prefix="edit-math-response-")
+    results = {}
+    print(f"{'case':<28}{'tool':<10}{'text':>9}{'json':>9}{'debug':>9}{'wire':>8}  "
+          f"{'tool ms':>15}  {'serialize us':>15}  {'parse us':>15}")
+    try:
+        for case in all_cases(args.buckets.split(",")):
+            for tool, row in run_case(case, workspace, args.repeats).items():
+                results[f"{case.case_id}/{tool}"] = row
+                debug = f"{row['debug_b']:>8}B" if "debug_b" in row else f"{'':>9}"
+                print(
+                    f"{case.case_id:<28}{tool:<10}{row['text_b']:>8}B{row['json_b']:>8}B{debug}"
+                    f"{row['wire_json_b'] / row['wire_text_b']:>7.2f}x  "
+                    f"{row['tool_text_s'] * 1000:>7.2f}/{row['tool_json_s'] * 1000:<7.2f}  "
+                    f"{row['serialize_text_s'] * 1e6:>7.1f}/{row['serialize_json_s'] * 1e6:<7.1f}  "
+                    f"{row['parse_text_s'] * 1e6:>7.1f}/{row['parse_json_s'] * 1e6:<7.1f}",
+                    flush=True,
+                )
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    text_wire = sum(row["wire_text_b"] for row in results.values())
+    json_wire = sum(row["wire_json_b"] for row in results.values())
+    print(f"\nwire bytes, all rows: text {text_wire} B, json {json_wire} B ({json_wire / text_wire:.2f}x)")
+    if args.output:
+        write_json(args.output, make_document(results, repeats=args.repeats))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
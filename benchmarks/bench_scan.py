@@ -0,0 +1,210 @@
+"""
+Scan benchmark: parse, index and extraction cost per language, shape and size.
+
+Every case runs in a fresh subprocess, so peak RSS belongs to that case alone
+and no parse or source cache survives between cases. Timings are the best of
+--repeats runs; caches are bypassed (no file_path), so every repeat is cold.
+The definition index is also built once under tracemalloc: the heap it keeps,
+the peak while building it and its live allocation blocks. Python cases use the
+backend the server picks (EDIT_MATH_PYTHON_BACKEND, "auto" by default).
+
+    python -m benchmarks.bench_scan                       # compare with baseline
+    python -m benchmarks.bench_scan --buckets small,medium
+    python -m benchmarks.bench_scan --cases python/ --repeats 5
+    python -m benchmarks.bench_scan --update-baseline     # record a new baseline
+
+Exit status is 1 when any metric regresses past its threshold.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.baseline import compare, load_baseline, make_document, report, update_baseline, write_json  # noqa: E402
+from benchmarks.corpus import SIZE_BUCKETS, Case, all_cases, generate, parse_case_id, target_for  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline_scan.json")
+TIME_METRICS = ("parse_s", "index_s", "extract_s", "scan_s", "scan_auto_s")
+# Память Python-кучи при построении индекса (tracemalloc): сколько держит результат
+# и пик во время построения. Сравнивается с тем же порогом, что и RSS. Число живых блоков
+# (index_blocks) только печатается: оно зависит от аллокатора и версии Python, а не от кода.
+MEMORY_METRICS = ("peak_rss_kb", "index_kb", "index_peak_kb")
+TIME_NOISE_FLOOR_S = 0.005
+# Абсолютный порог шума памяти, КБ: на малых кейсах 1.20x — это единицы килобайт,
+# а арены аллокатора и страницы RSS шагают крупнее.
+MEMORY_NOISE_FLOOR_KB = {"peak_rss_kb": 4096, "index_kb": 64, "index_peak_kb": 256}
+
+
+def _peak_rss_kb() -> int:
+    import resource
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает килобайты, macOS — байты.
+    return usage // 1024 if sys.platform == "darwin" else usage
+
+
+def _best(repeats: int, fn) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def _allocations(fn) -> Dict[str, int]:
+    """Python heap held by fn()'s result, the peak while it ran, and the number of live blocks."""
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        kept = fn()
+        current, peak = tracemalloc.get_traced_memory()
+        blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+    finally:
+        tracemalloc.stop()
+    del kept
+    return {"index_kb": current // 1024, "index_peak_kb": peak // 1024, "index_blocks": blocks}
+
+
+def run_case(case: Case, repeats: int) -> Dict[str, float]:
+    """Measures one case in the current process. Called inside the worker subprocess."""
+    import ast
+
+    import mcp_edit_math as engine
+
+    rss_import_kb = _peak_rss_kb()
+    source = generate(case)
+    source_bytes = source.encode("utf-8")
+    target = target_for(case)
+    lang = case.language
+
+    if lang == "python":
+        # Тот же бэкенд, что выбирает engine (EDIT_MATH_PYTHON_BACKEND, по умолчанию "auto").
+        parser = engine.get_parser("python") if engine.PYTHON_BACKEND != "ast" else None
+        if parser is None:
+            parse = lambda: ast.parse(source_bytes)  # noqa: E731
+            tree = parse()
+            build_index = allocate = lambda: engine._build_python_index(tree)  # noqa: E731
+        else:
+            parse = lambda: engine._ts_parse(parser, source_bytes)  # noqa: E731
+            tree = parse()
+            build_index = allocate = lambda: engine._build_python_ts_index(tree)  # noqa: E731
+        index = build_index()
+        extract = lambda: (  # noqa: E731
+            engine._extract_python_dependencies(source_bytes, target, index=index),
+            engine._extract_python_dependencies(source_bytes, "ENTIRE_FILE", index=index),
+        )
+    elif lang == "html":
+        parse = lambda: engine._ts_parse(engine.get_parser("html"), source_bytes)  # noqa: E731
+        tree = parse()
+        build_index = lambda: None  # noqa: E731
+        extract = lambda: engine._extract_html_dependencies(tree, source_bytes)  # noqa: E731
+        # Встроенные скрипты индексируются внутри извлечения.
+        allocate = extract
+    else:
+        parser = engine.get_parser(lang)
+        parse = lambda: engine._ts_parse(parser, source_bytes)  # noqa: E731
+        tree = parse()
+        build_index = allocate = lambda: engine._build_js_index(tree, lang)  # noqa: E731
+        index = build_index()
+        extract = lambda: (  # noqa: E731
+            engine._extract_dependencies_from_tree(tree, target, lang_key=lang, index=index),
+            engine._extract_dependencies_from_tree(tree, "ENTIRE_FILE", lang_key=lang, index=index),
+        )
+
+    result = {
+        "bytes": len(source_bytes),
+        "parse_s": _best(repeats, parse),
+        "index_s": _best(repeats, build_index),
+        "extract_s": _best(repeats, extract),
+        "scan_s": _best(repeats, lambda: engine._scan_code(source_bytes, target, language=lang)),
+        "scan_auto_s": _best(repeats, lambda: engine._scan_code(source_bytes, target, language="auto")),
+        "rss_import_kb": rss_import_kb,
+    }
+    result["peak_rss_kb"] = _peak_rss_kb()
+    result.update(_allocations(allocate))
+    return result
+
+
+def run_case_subprocess(case: Case, repeats: int, timeout: float) -> Dict[str, float]:
+    command = [sys.executable, "-m", "benchmarks.bench_scan", "--worker", case.case_id, "--repeats", str(repeats)]
+    try:
+        completed = subprocess.run(command, cwd=ROOT, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {"error": f"timed out after {timeout:.0f}s"}
+    if completed.returncode != 0:
+        tail = (completed.stderr or completed.stdout).strip().splitlines()[-1:]
+        return {"error": tail[0] if tail else f"exit code {completed.returncode}"}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def _format_row(case_id: str, result: Dict, previous: Optional[Dict]) -> str:
+    if "error" in result:
+        return f"{case_id:<34} ERROR: {result['error']}"
+
+    def cell(metric: str, scale: float, unit: str) -> str:
+        value = f"{result[metric] * scale:.1f}{unit}"
+        if previous and previous.get(metric):
+            value += f" ({result[metric] / previous[metric]:.2f}x)"
+        return f"{value:<18}"
+
+    return (
+        f"{case_id:<34} {result['bytes'] / 1024:>7.0f}K "
+        f"{cell('parse_s', 1000, 'ms')}{cell('index_s', 1000, 'ms')}{cell('extract_s', 1000, 'ms')}"
+        f"{cell('scan_auto_s', 1000, 'ms')}{cell('peak_rss_kb', 1 / 1024, 'MB')}"
+        f"{cell('index_kb', 1 / 1024, 'MB')}{cell('index_blocks', 1 / 1000, 'k')}"
+    )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--buckets", default=",".join(SIZE_BUCKETS), help="comma-separated size buckets")
+    parser.add_argument("--cases", default="", help="only run case ids containing this substring")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=600.0, help="per-case wall-clock limit, seconds")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--output", default="", help="also write results to this JSON file")
+    parser.add_argument("--time-threshold", type=float, default=1.25, help="allowed slowdown ratio")
+    parser.add_argument("--rss-threshold", type=float, default=1.20, help="allowed peak RSS / index heap growth ratio")
+    parser.add_argument("--worker", default="", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_case(parse_case_id(args.worker), args.repeats)))
+        return 0
+
+    baseline = load_baseline(args.baseline)
+
+    cases = [c for c in all_cases(args.buckets.split(",")) if args.cases in c.case_id]
+    print(f"{'case':<34} {'size':>8} {'parse':<18}{'index':<18}{'extract':<18}{'scan(auto)':<18}{'peak rss':<18}{'index heap':<18}{'blocks':<18}")
+    results = {}
+    for case in cases:
+        results[case.case_id] = run_case_subprocess(case, args.repeats, args.timeout)
+        print(_format_row(case.case_id, results[case.case_id], baseline.get(case.case_id)), flush=True)
+
+    if args.output:
+        write_json(args.output, make_document(results, repeats=args.repeats))
+
+    if args.update_baseline:
+        update_baseline(args.baseline, results, repeats=args.repeats)
+        print(f"\nBaseline written: {args.baseline}")
+        return 0
+
+    if not baseline:
+        print("\nNo baseline found; run with --update-baseline to record one.")
+        return 0
+
+    regressions = compare(results, baseline, TIME_METRICS, args.time_threshold, TIME_NOISE_FLOOR_S,
+                          MEMORY_METRICS, args.rss_threshold, MEMORY_NOISE_FLOOR_KB)
+    return report(regressions, args.baseline)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
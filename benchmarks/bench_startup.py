@@ -0,0 +1,168 @@
+"""
+Cold-start benchmark: process spawn -> import -> first tool response over stdio.
+
+An IDE using the stdio transport starts a fresh server per session, so this
+latency is paid on every session. Each run spawns a new interpreter.
+
+Cases:
+    import              `import mcp_edit_math` alone (in-process import time)
+    stdio/python        initialize + first scan_dependencies of a Python snippet
+    stdio/javascript    initialize + first scan_dependencies of a JS snippet (loads the grammar)
+
+    python -m benchmarks.bench_startup --runs 7
+    python -m benchmarks.bench_startup --update-baseline
+
+Prints medians over --runs; the baseline check uses the best run of each
+metric, which is far less sensitive to scheduler noise. Exit status is 1 on
+regression.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.baseline import compare, load_baseline, make_document, report, update_baseline, write_json  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline_startup.json")
+SERVER_SCRIPT = os.path.join(ROOT, "mcp_edit_math.py")
+# Сравнение с базой — по лучшему из прогонов: медиана старта процесса слишком шумная.
+TIME_METRICS = ("import_min_s", "process_min_s", "initialize_min_s", "first_tool_min_s")
+TIME_NOISE_FLOOR_S = 0.02
+
+SNIPPETS = {
+    "python": ("def handler(request):\n    return render(load(request))\n", "handler"),
+    "javascript": ("function handler(req) { return render(load(req)); }\n", "handler"),
+}
+
+
+def _server_env() -> Dict[str, str]:
+    env = dict(os.environ)
+    env.pop("PORT", None)  # stdio, а не SSE
+    env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    return env
+
+
+def measure_import() -> Dict[str, float]:
+    code = "import time; t = time.perf_counter(); import mcp_edit_math; print(time.perf_counter() - t)"
+    started = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=_server_env(),
+                               capture_output=True, text=True, check=True)
+    return {"import_s": float(completed.stdout.strip().splitlines()[-1]), "process_s": time.perf_counter() - started}
+
+
+def _send(proc: subprocess.Popen, message: Dict) -> None:
+    proc.stdin.write(json.dumps(message) + "\n")
+    proc.stdin.flush()
+
+
+def _receive(proc: subprocess.Popen, request_id: int) -> Dict:
+    while True:
+        line = proc.stdout.readline()
+        if not line:
+            raise RuntimeError(f"server exited: {proc.stderr.read()[-500:]}")
+        message = json.loads(line)
+        if message.get("id") == request_id:
+            return message
+
+
+def measure_stdio(language: str) -> Dict[str, float]:
+    code, target = SNIPPETS[language]
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, SERVER_SCRIPT], cwd=ROOT, env=_server_env(), text=True,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        _send(proc, {"jsonrpc": "2.0", "id": 1, "method": "initialize", "params": {
+            "protocolVersion": "2024-11-05", "capabilities": {},
+            "clientInfo": {"name": "bench_startup", "version": "0"},
+        }})
+        _receive(proc, 1)
+        initialized = time.perf_counter()
+        _send(proc, {"jsonrpc": "2.0", "method": "notifications/initialized"})
+        _send(proc, {"jsonrpc": "2.0", "id": 2, "method": "tools/call", "params": {
+            "name": "scan_dependencies",
+            "arguments": {"code": code, "target_function": target, "language": language},
+        }})
+        response = _receive(proc, 2)
+        responded = time.perf_counter()
+        if "error" in response or response["result"].get("isError"):
+            raise RuntimeError(f"tool call failed: {response}")
+    finally:
+        # EOF на stdin — штатное завершение stdio-сервера (так его закрывает IDE): он успевает
+        # остановить свои воркеры сканирования, и они не отнимают CPU у следующего прогона.
+        proc.stdin.close()
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.terminate()
+            proc.wait(timeout=10)
+    return {"initialize_s": initialized - started, "first_tool_s": responded - started}
+
+
+CASES = {
+    "import": measure_import,
+    "stdio/python": lambda: measure_stdio("python"),
+    "stdio/javascript": lambda: measure_stdio("javascript"),
+}
+
+
+def run_case(name: str, runs: int) -> Dict[str, float]:
+    samples: List[Dict[str, float]] = []
+    try:
+        for _ in range(runs):
+            samples.append(CASES[name]())
+    except Exception as e:
+        return {"error": str(e)}
+    result = {}
+    for metric in samples[0]:
+        values = [sample[metric] for sample in samples]
+        result[metric] = statistics.median(values)
+        result[metric.replace("_s", "_min_s")] = min(values)
+    return result
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--output", default="", help="also write results to this JSON file")
+    parser.add_argument("--time-threshold", type=float, default=1.5, help="allowed slowdown ratio (process start is noisy)")
+    args = parser.parse_args()
+
+    baseline = load_baseline(args.baseline)
+    results = {}
+    for name in CASES:
+        results[name] = run_case(name, args.runs)
+        previous = baseline.get(name, {})
+        cells = []
+        for metric, value in results[name].items():
+            if metric.endswith("_min_s") or metric == "error":
+                continue
+            cell = f"{metric}={value * 1000:.0f}ms"
+            if previous.get(metric):
+                cell += f" ({value / previous[metric]:.2f}x)"
+            cells.append(cell)
+        print(f"{name:<18} {results[name].get('error') or '  '.join(cells)}", flush=True)
+
+    if args.output:
+        write_json(args.output, make_document(results, runs=args.runs))
+    if args.update_baseline:
+        update_baseline(args.baseline, results, runs=args.runs)
+        print(f"\nBaseline written: {args.baseline}")
+        return 0
+    if not baseline:
+        print("\nNo baseline found; run with --update-baseline to record one.")
+        return 0
+    return report(compare(results, baseline, TIME_METRICS, args.time_threshold, TIME_NOISE_FLOOR_S), args.baseline)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+"""
+Micro-benchmark: EASM state transition throughput under contention.
+
+Every worker repeatedly drives keys through NONE -> PENDING -> APPROVED -> NONE
+with compare-and-set transitions. Workers share a small key space, so some
+transitions lose the race; those are counted as conflicts, not errors.
+
+    python -m benchmarks.bench_state --workers 4 --cycles 2000 --keys 8
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mcp_edit_math import MemoryStateBackend, SQLiteStateBackend  # noqa: E402
+
+CYCLE = (("NONE", "PENDING"), ("PENDING", "APPROVED"), ("APPROVED", "NONE"))
+
+
+def _drive(backend, worker_id: int, cycles: int, keys: int):
+    done = conflicts = 0
+    for i in range(cycles):
+        key = f"bench/file_{(worker_id + i) % keys}.js::target"
+        for expected, new_state in CYCLE:
+            if backend.transition(key, expected, new_state):
+                done += 1
+            else:
+                conflicts += 1
+    return done, conflicts
+
+
+def _sqlite_worker(path: str, worker_id: int, cycles: int, keys: int, ready, go, queue) -> None:
+    backend = SQLiteStateBackend(path)
+    ready.put(worker_id)
+    go.wait()
+    started = time.time()
+    done, conflicts = _drive(backend, worker_id, cycles, keys)
+    queue.put((done, conflicts, started, time.time()))
+
+
+def bench_memory(workers: int, cycles: int, keys: int):
+    backend = MemoryStateBackend()
+    results = []
+
+    def run(worker_id):
+        results.append(_drive(backend, worker_id, cycles, keys))
+
+    threads = [threading.Thread(target=run, args=(w,)) for w in range(workers)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - started, results
+
+
+def bench_sqlite(workers: int, cycles: int, keys: int):
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "state.sqlite")
+        SQLiteStateBackend(path)  # создать схему до старта воркеров
+        ready, go, queue = ctx.Queue(), ctx.Event(), ctx.Queue()
+        procs = [ctx.Process(target=_sqlite_worker, args=(path, w, cycles, keys, ready, go, queue)) for w in range(workers)]
+        for p in procs:
+            p.start()
+        # Время старта процессов не входит в замер: все воркеры стартуют по сигналу.
+        for _ in procs:
+            ready.get()
+        go.set()
+        results = [queue.get() for _ in procs]
+        for p in procs:
+            p.join()
+    elapsed = max(r[3] for r in results) - min(r[2] for r in results)
+    return elapsed, results
+
+
+def _report(name: str, elapsed: float, results) -> None:
+    done = sum(r[0] for r in results)
+    conflicts = sum(r[1] for r in results)
+    print(f"{name:<28} {done:>9} ok {conflicts:>9} conflicts {elapsed:>8.3f} s {done / elapsed:>12.0f} transitions/s")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--workers", type=int, default=4)
+    ap.add_argument("--cycles", type=int, default=2000)
+    ap.add_argument("--keys", type=int, default=8, help="size of the shared key space (smaller = more contention)")
+    args = ap.parse_args()
+
+    _report(f"memory ({args.workers} threads)", *bench_memory(args.workers, args.cycles, args.keys))
+    _report(f"sqlite-wal ({args.workers} procs)", *bench_sqlite(args.workers, args.cycles, args.keys))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Deterministic synthetic corpus for the scanning engine.
+
+Every case is generated from (language, shape, size bucket) with a fixed seed,
+so two runs on any machine scan byte-identical inputs.
+
+Shapes:
+    flat        many independent top-level functions
+    nested      deeply nested closures / inner functions
+    wide_class  one class with thousands of methods calling each other
+    minified    a single-line bundle (JS/TS only)
+    template    a large page with inline handlers and scripts (HTML only)
+"""
+
+import random
+from typing import Dict, List, NamedTuple
+
+SIZE_BUCKETS: Dict[str, int] = {
+    "small": 16 * 1024,
+    "medium": 256 * 1024,
+    "large": 2 * 1024 * 1024,
+}
+
+SHAPES: Dict[str, List[str]] = {
+    "javascript": ["flat", "nested", "wide_class", "minified"],
+    "typescript": ["flat", "nested", "wide_class", "minified"],
+    "python": ["flat", "nested", "wide_class"],
+    "html": ["template"],
+}
+
+EXTENSIONS = {"javascript": ".js", "typescript": ".ts", "python": ".py", "html": ".html"}
+
+# Питон-парсер ограничивает глубину вложенности, tree-sitter — нет.
+MAX_NESTING = {"python": 60, "javascript": 400, "typescript": 400}
+
+
+class Case(NamedTuple):
+    language: str
+    shape: str
+    bucket: str
+
+    @property
+    def case_id(self) -> str:
+        return f"{self.language}/{self.shape}/{self.bucket}"
+
+
+def all_cases(buckets: List[str] = None) -> List[Case]:
+    buckets = buckets or list(SIZE_BUCKETS)
+    return [Case(lang, shape, bucket) for lang, shapes in SHAPES.items() for shape in shapes for bucket in buckets]
+
+
+def parse_case_id(case_id: str) -> Case:
+    language, shape, bucket = case_id.split("/")
+    return Case(language, shape, bucket)
+
+
+def _fill(target_size: int, make_unit, separator: str = "\n") -> str:
+    parts: List[str] = []
+    size = 0
+    i = 0
+    while size < target_size:
+        unit = make_unit(i)
+        parts.append(unit)
+        size += len(unit) + len(separator)
+        i += 1
+    return separator.join(parts)
+
+
+def _js_function(rng: random.Random, i: int, typed: bool) -> str:
+    arg = "value: number" if typed else "value"
+    ret = ": number" if typed else ""
+    callee = f"helper{rng.randrange(max(i, 1))}"
+    return (
+        f"function helper{i}({arg}){ret} {{\n"
+        f"  const items = [value, {i}].map(x => x * 2);\n"
+        f"  if (items.length > {rng.randrange(5)}) {{ {callee}(items[0]); }}\n"
+        f"  console.log('helper{i}', items);\n"
+        f"  return service.compute{rng.randrange(50)}(items) + {i};\n"
+        f"}}"
+    )
+
+
+def _js_nested(rng: random.Random, size: int, typed: bool, limit: int) -> str:
+    def block(i: int) -> str:
+        depth = min(limit, 20 + rng.randrange(limit))
+        arg = "(a: number)" if typed else "(a)"
+        opening = "".join(f"const level{d} = {arg} => {{ step{d}(a); " for d in range(depth))
+        closing = "".join(" };" for _ in range(depth))
+        return f"function outer{i}() {{ {opening}return a;{closing} }}"
+    return _fill(size, block)
+
+
+def _js_wide_class(rng: random.Random, size: int, typed: bool) -> str:
+    arg = "input: string" if typed else "input"
+    methods: List[str] = []
+    total = 0
+    i = 0
+    while total < size:
+        other = rng.randrange(max(i, 1))
+        method = f"  method{i}({arg}) {{ this.method{other}(input); this.store.save{i % 17}(input); return transform{i % 31}(input); }}"
+        methods.append(method)
+        total += len(method) + 1
+        i += 1
+    return "class Service {\n" + "\n".join(methods) + "\n}\n"
+
+
+def _js_minified(rng: random.Random, size: int, typed: bool) -> str:
+    # Однострочный бандл: короткие имена, без пробелов и переводов строк.
+    def unit(i: int) -> str:
+        arg = "a:any" if typed else "a"
+        return f"function m{i}({arg}){{var b=m{rng.randrange(max(i, 1))}(a),c=b?x{i % 97}(b):y.z{i % 13}(a);return c&&w(c)}}"
+    return _fill(size, unit, separator=";")
+
+
+def _python_flat(rng: random.Random, size: int) -> str:
+    def unit(i: int) -> str:
+        return (
+            f"def helper{i}(value):\n"
+            f"    items = [v * 2 for v in (value, {i})]\n"
+            f"    if len(items) > {rng.randrange(5)}:\n"
+            f"        helper{rng.randrange(max(i, 1))}(items[0])\n"
+            f"    print('helper{i}', items)\n"
+            f"    return service.compute{rng.randrange(50)}(items) + {i}\n"
+        )
+    return _fill(size, unit)
+
+
+def _python_nested(rng: random.Random, size: int, limit: int) -> str:
+    def unit(i: int) -> str:
+        depth = min(limit, 10 + rng.randrange(limit))
+        lines = [f"def outer{i}(a):"]
+        for d in range(depth):
+            indent = "    " * (d + 1)
+            lines.append(f"{indent}def level{d}(a):")
+            lines.append(f"{indent}    step{d}(a)")
+        lines.append("    " * (depth + 1) + "return a")
+        lines.append("    return a")
+        return "\n".join(lines) + "\n"
+    return _fill(size, unit)
+
+
+def _python_wide_class(rng: random.Random, size: int) -> str:
+    methods: List[str] = []
+    total = 0
+    i = 0
+    while total < size:
+        method = (
+            f"    def method{i}(self, data):\n"
+            f"        self.method{rng.randrange(max(i, 1))}(data)\n"
+            f"        return transform{i % 31}(self.store.save{i % 17}(data))\n"
+        )
+        methods.append(method)
+        total += len(method)
+        i += 1
+    return "class Service:\n" + "".join(methods)
+
+
+def _html_template(rng: random.Random, size: int) -> str:
+    def unit(i: int) -> str:
+        handler = f"handle{rng.randrange(200)}"
+        return (
+            f'<section id="block{i}" class="card">\n'
+            f'  <button onclick="{handler}(event, {i})" onmouseover="track{i % 23}()">Item {i}</button>\n'
+            f'  <script>function inline{i}() {{ render{i % 41}(document.getElementById("block{i}")); }}</script>\n'
+            f'  <script src="/static/chunk{i % 11}.js"></script>\n'
+            f"</section>"
+        )
+    body = _fill(size, unit)
+    return f"<!DOCTYPE html>\n<html>\n<head><title>Benchmark</title></head>\n<body>\n{body}\n</body>\n</html>\n"
+
+
+def generate(case: Case, seed: int = 0) -> str:
+    """Returns the source text for a case; identical for identical (case, seed)."""
+    rng = random.Random(f"{case.case_id}:{seed}")
+    size = SIZE_BUCKETS[case.bucket]
+    typed = case.language == "typescript"
+    if case.language in ("javascript", "typescript"):
+        if case.shape == "flat":
+            return _fill(size, lambda i: _js_function(rng, i, typed))
+        if case.shape == "nested":
+            return _js_nested(rng, size, typed, MAX_NESTING[case.language])
+        if case.shape == "wide_class":
+            return _js_wide_class(rng, size, typed)
+        if case.shape == "minified":
+            return _js_minified(rng, size, typed)
+    if case.language == "python":
+        if case.shape == "flat":
+            return _python_flat(rng, size)
+        if case.shape == "nested":
+            return _python_nested(rng, size, MAX_NESTING["python"])
+        if case.shape == "wide_class":
+            return _python_wide_class(rng, size)
+    if case.language == "html" and case.shape == "template":
+        return _html_template(rng, size)
+    raise ValueError(f"Unknown benchmark case: {case.case_id}")
+
+
+def target_for(case: Case) -> str:
+    """A definition that exists in the generated source, for target-scan timings."""
+    if case.shape == "wide_class":
+        return "method1"
+    if case.shape == "nested":
+        return "outer0"
+    if case.shape == "minified":
+        return "m1"
+    return "helper1" if case.language != "html" else "ENTIRE_FILE"
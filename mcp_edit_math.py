@@ -24,24 +24,405 @@ VERSION: 1.4.1 (Optional target_function for full file scanning)
 
 from mcp.server.fastmcp import FastMCP
 import os
+import re
+from array import array
 import traceback
 import ast
-from typing import List, Dict, Set, Tuple, Optional, Union
+import asyncio
+import bisect
+import difflib
+import functools
+import hashlib
+import importlib
+import inspect
+import itertools
+import json
+import mmap
+import multiprocessing
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, CancelledError, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, List, Dict, Sequence, Set, Tuple, Optional, Union
 
 # --- БЛОК ИНИЦИАЛИЗАЦИИ TREE-SITTER ---
+# Без tree-sitter сервер работает в режиме "только Python" (модуль ast).
+# Пакеты грамматик импортируются лениво, при первом запросе языка.
 try:
-    from tree_sitter import Language, Parser
-    import tree_sitter_javascript
-    import tree_sitter_typescript
-    import tree_sitter_html
+    from tree_sitter import Language, Parser, Range
+    TREE_SITTER_AVAILABLE = True
 except ImportError:
-    raise ImportError("Run: pip install tree-sitter==0.21.3 tree-sitter-javascript==0.21.0 tree-sitter-typescript==0.21.0 tree-sitter-html==0.20.3")
+    Language = Parser = Range = None
+    TREE_SITTER_AVAILABLE = False
+
+TREE_SITTER_INSTALL_HINT = "pip install tree-sitter==0.21.3 tree-sitter-javascript==0.21.0 tree-sitter-typescript==0.21.0 tree-sitter-html==0.20.3"
 
 mcp = FastMCP("EditMathSupervisor")
 
+# --- МЕТРИКИ ---
+# Счетчики и гистограммы времени по инструментам и фазам (parse, index, extract, wrapper...).
+# Запись — словарь под одной блокировкой; при EDIT_MATH_METRICS=0 таймеры не создаются вовсе.
+METRICS_ENABLED = os.environ.get("EDIT_MATH_METRICS", "1").strip().lower() not in ("0", "false", "off", "no")
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRIC_PREFIX = "edit_math_"
+
+class _Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(METRIC_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+class _Timer:
+    __slots__ = ("registry", "name", "labels", "started")
+
+    def __init__(self, registry: "MetricsRegistry", name: str, labels: Dict[str, str]):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, time.perf_counter() - self.started, **self.labels)
+        return False
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+class MetricsRegistry:
+    """In-process counters and latency histograms, keyed by (name, sorted labels)."""
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, tuple], float] = {}
+        self._histograms: Dict[Tuple[str, tuple], _Histogram] = {}
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram()
+            histogram.observe(seconds)
+
+    def timer(self, name: str, **labels: str):
+        """Context manager that observes its wall-clock duration into histogram `name`."""
+        return _Timer(self, name, labels) if self.enabled else _NULL_TIMER
+
+    def phase(self, phase: str, language: str = ""):
+        return self.timer("phase_duration_seconds", phase=phase, language=language)
+
+    def drain(self) -> Dict[str, list]:
+        """Returns and resets everything recorded so far (worker processes hand this to the parent)."""
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            histograms, self._histograms = self._histograms, {}
+        return {
+            "counters": [(name, labels, value) for (name, labels), value in counters.items()],
+            "histograms": [(name, labels, h.counts, h.total, h.count) for (name, labels), h in histograms.items()],
+        }
+
+    def merge(self, drained: Dict[str, list]) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            for name, labels, value in drained["counters"]:
+                key = (name, tuple(labels))
+                self._counters[key] = self._counters.get(key, 0) + value
+            for name, labels, counts, total, count in drained["histograms"]:
+                key = (name, tuple(labels))
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = _Histogram()
+                histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+                histogram.total += total
+                histogram.count += count
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = list(self._counters.items())
+            histograms = [(key, list(h.counts), h.total, h.count) for key, h in self._histograms.items()]
+        result: Dict[str, Any] = {
+            "enabled": self.enabled,
+            "uptime_seconds": round(time.time() - self.started, 3),
+            "counters": {},
+            "histograms": {},
+        }
+        for (name, labels), value in sorted(counters):
+            result["counters"].setdefault(name, []).append({"labels": dict(labels), "value": value})
+        for (name, labels), counts, total, count in sorted(histograms, key=lambda item: item[0]):
+            cumulative, buckets = 0, {}
+            for bound, bucket_count in zip(METRIC_BUCKETS + (float("inf"),), counts):
+                cumulative += bucket_count
+                buckets["+Inf" if bound == float("inf") else str(bound)] = cumulative
+            result["histograms"].setdefault(name, []).append({
+                "labels": dict(labels), "count": count, "sum": round(total, 6), "buckets": buckets,
+            })
+        return result
+
+def _prometheus_escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _prometheus_labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_prometheus_escape(v)}"' for k, v in labels.items()) + "}"
+
+def render_prometheus(snapshot: Dict[str, Any], gauges: Dict[str, List[Tuple[Dict[str, Any], float]]]) -> str:
+    """Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for name, series in snapshot["counters"].items():
+        lines.append(f"# TYPE {METRIC_PREFIX}{name} counter")
+        for entry in series:
+            lines.append(f"{METRIC_PREFIX}{name}{_prometheus_labels(entry['labels'])} {entry['value']}")
+    for name, series in snapshot["histograms"].items():
+        lines.append(f"# TYPE {METRIC_PREFIX}{name} histogram")
+        for entry in series:
+            for bound, cumulative in entry["buckets"].items():
+                labels = dict(entry["labels"], le=bound)
+                lines.append(f"{METRIC_PREFIX}{name}_bucket{_prometheus_labels(labels)} {cumulative}")
+            lines.append(f"{METRIC_PREFIX}{name}_sum{_prometheus_labels(entry['labels'])} {entry['sum']}")
+            lines.append(f"{METRIC_PREFIX}{name}_count{_prometheus_labels(entry['labels'])} {entry['count']}")
+    for name, series in gauges.items():
+        lines.append(f"# TYPE {METRIC_PREFIX}{name} gauge")
+        for labels, value in series:
+            lines.append(f"{METRIC_PREFIX}{name}{_prometheus_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+METRICS = MetricsRegistry(METRICS_ENABLED)
+
 # МАШИНА СОСТОЯНИЙ
 # Ключ теперь уникален: "path/to/file.js::functionName" -> "PENDING"/"APPROVED"
-APPROVAL_STATE: Dict[str, str] = {}
+# "NONE" — состояние по умолчанию: оно не хранится, поэтому хранилище не растет
+# от каждого сканирования. Истекшие записи тоже читаются как "NONE" (fail closed).
+CACHE_DIR = os.environ.get("EDIT_MATH_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "mcp-edit-math"))
+STATE_TTL_SECONDS = float(os.environ.get("EDIT_MATH_STATE_TTL", "3600"))
+STATE_MAX_ENTRIES = int(os.environ.get("EDIT_MATH_STATE_MAX_ENTRIES", "10000"))
+
+class ApprovalStateBackend:
+    """
+    Storage for EASM states. Subclasses implement get/set/transition;
+    the mapping-style helpers keep call sites as plain `STATE[key] = value`.
+    """
+
+    def get(self, key: str, default: str = "NONE") -> str:
+        raise NotImplementedError
+
+    def set(self, key: str, state: str) -> None:
+        raise NotImplementedError
+
+    def transition(self, key: str, expected: str, new_state: str) -> bool:
+        """Atomically moves key from `expected` to `new_state`; False if the current state differs."""
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+    def __getitem__(self, key: str) -> str:
+        return self.get(key)
+
+    def __setitem__(self, key: str, state: str) -> None:
+        self.set(key, state)
+
+class MemoryStateBackend(ApprovalStateBackend):
+    """Per-process store with TTL expiry and LRU eviction."""
+
+    def __init__(self, max_entries: int = STATE_MAX_ENTRIES, ttl_seconds: float = STATE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _current(self, key: str) -> str:
+        entry = self._entries.get(key)
+        if entry is None:
+            return "NONE"
+        state, updated_at = entry
+        if self.ttl_seconds and time.monotonic() - updated_at > self.ttl_seconds:
+            del self._entries[key]
+            return "NONE"
+        return state
+
+    def _write(self, key: str, state: str) -> None:
+        if state == "NONE":
+            self._entries.pop(key, None)
+            return
+        self._entries[key] = (state, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key: str, default: str = "NONE") -> str:
+        with self._lock:
+            state = self._current(key)
+        return default if state == "NONE" else state
+
+    def set(self, key: str, state: str) -> None:
+        with self._lock:
+            self._write(key, state)
+
+    def transition(self, key: str, expected: str, new_state: str) -> bool:
+        with self._lock:
+            if self._current(key) != expected:
+                return False
+            self._write(key, new_state)
+            return True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+class SQLiteStateBackend(ApprovalStateBackend):
+    """
+    Shared store for several server processes (e.g. SSE workers behind a load balancer).
+    WAL mode lets readers proceed during writes; transitions run in BEGIN IMMEDIATE transactions.
+    """
+
+    PURGE_EVERY = 256
+
+    def __init__(self, path: str, ttl_seconds: float = STATE_TTL_SECONDS):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._local = threading.local()
+        self._writes = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS approval_state ("
+            "key TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3-соединения нельзя разделять между потоками: по одному на поток.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA busy_timeout=30000")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _cutoff(self) -> float:
+        return time.time() - self.ttl_seconds if self.ttl_seconds else float("-inf")
+
+    def _read(self, conn: sqlite3.Connection, key: str) -> str:
+        row = conn.execute(
+            "SELECT state FROM approval_state WHERE key = ? AND updated_at >= ?", (key, self._cutoff())
+        ).fetchone()
+        return row[0] if row else "NONE"
+
+    def _write(self, conn: sqlite3.Connection, key: str, state: str) -> None:
+        if state == "NONE":
+            conn.execute("DELETE FROM approval_state WHERE key = ?", (key,))
+        else:
+            conn.execute(
+                "INSERT INTO approval_state (key, state, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                (key, state, time.time()),
+            )
+        self._writes += 1
+        if self.ttl_seconds and self._writes % self.PURGE_EVERY == 0:
+            conn.execute("DELETE FROM approval_state WHERE updated_at < ?", (self._cutoff(),))
+
+    def get(self, key: str, default: str = "NONE") -> str:
+        state = self._read(self._conn(), key)
+        return default if state == "NONE" else state
+
+    def set(self, key: str, state: str) -> None:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._write(conn, key, state)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def transition(self, key: str, expected: str, new_state: str) -> bool:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self._read(conn, key) != expected:
+                conn.execute("ROLLBACK")
+                return False
+            self._write(conn, key, new_state)
+            conn.execute("COMMIT")
+            return True
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def clear(self) -> None:
+        self._conn().execute("DELETE FROM approval_state")
+
+    def __len__(self) -> int:
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM approval_state WHERE updated_at >= ?", (self._cutoff(),)
+        ).fetchone()[0]
+
+def create_state_backend(kind: str = "") -> ApprovalStateBackend:
+    """Backend from EDIT_MATH_STATE_BACKEND: "memory" (default) or "sqlite" (path in EDIT_MATH_STATE_PATH)."""
+    kind = (kind or os.environ.get("EDIT_MATH_STATE_BACKEND", "memory")).lower()
+    if kind == "sqlite":
+        path = os.environ.get("EDIT_MATH_STATE_PATH") or os.path.join(CACHE_DIR, "approval_state.sqlite")
+        return SQLiteStateBackend(path)
+    if kind == "memory":
+        return MemoryStateBackend()
+    raise ValueError(f"Unknown EDIT_MATH_STATE_BACKEND: {kind}")
+
+APPROVAL_STATE: ApprovalStateBackend = create_state_backend()
+
+def _record_transition(old_state: str, new_state: str) -> None:
+    METRICS.inc("state_transitions_total", from_state=old_state, to_state=new_state)
+
+def _grant(state_key: str, expected: str, new_state: str) -> bool:
+    """
+    Compare-and-set of an approval. Every write that grants or restores access goes through it:
+    a rescan (possibly in another process) between our read and our write must not be overwritten.
+    """
+    if not APPROVAL_STATE.transition(state_key, expected, new_state):
+        METRICS.inc("state_conflicts_total", to_state=new_state)
+        return False
+    _record_transition(expected, new_state)
+    return True
 
 def get_state_key(file_path: str, target_function: str) -> str:
     """Создает уникальный ключ для состояния, привязанный к файлу."""
@@ -51,263 +432,1756 @@ def get_state_key(file_path: str, target_function: str) -> str:
     norm_path = os.path.normpath(file_path).lower()
     return f"{norm_path}::{target_function}"
 
-# Глобальные переменные для парсеров
-parser_js = None
-parser_ts = None
-parser_html = None
-JS_LANGUAGE = None
-TS_LANGUAGE = None
+def _reset_scan_state(state_key: str) -> None:
+    """A rescan revokes the target's approval and the approval of every changeset that includes it."""
+    APPROVAL_STATE[state_key] = "NONE"
+    linked = APPROVAL_STATE.get(_changeset_link_key(state_key), "NONE")
+    if linked != "NONE":
+        for changeset_id in json.loads(linked):
+            APPROVAL_STATE[_changeset_state_key(changeset_id)] = "NONE"
 
-def init_parsers():
-    """Инициализация парсеров с явной обработкой каждого языка."""
-    global parser_js, parser_ts, parser_html, JS_LANGUAGE, TS_LANGUAGE
-    
-    def make_language(ptr, name):
-        try:
-            return Language(ptr, name)
-        except TypeError:
-            return Language(ptr)
-        except Exception:
-            return ptr
+# Запросы tree-sitter компилируются один раз на язык при инициализации.
+# Обход выполняется в C, без рекурсии Python по node.child(i).
+JS_QUERY_SOURCES = {
+    "declarations": """
+        (class_declaration) @def
+        (function_declaration) @def
+        (method_definition) @def
+        (lexical_declaration (variable_declarator) @def)
+    """,
+    "calls": """
+        (call_expression function: [(identifier) (member_expression)] @callee)
+    """,
+}
+# Индекс определений строится за один проход запроса: объявления и вызовы вместе.
+JS_QUERY_SOURCES["index"] = JS_QUERY_SOURCES["declarations"] + JS_QUERY_SOURCES["calls"]
+PY_QUERY_SOURCES = {
+    "index": """
+        (decorated_definition) @def
+        (function_definition) @def
+        (class_definition) @def
+        (call function: [(identifier) (attribute)] @callee)
+    """,
+}
+HTML_QUERY_SOURCES = {
+    "attributes": "(attribute (attribute_name) @name) @attribute",
+    "scripts": "(script_element) @script",
+}
+QUERIES: Dict[str, Dict[str, Any]] = {}
 
+def _compile_queries(language, lang_key: str, sources: Dict[str, str]) -> None:
     try:
-        # 1. JavaScript
-        js_ptr = tree_sitter_javascript.language()
-        JS_LANGUAGE = make_language(js_ptr, "javascript")
-        parser_js = Parser()
-        parser_js.set_language(JS_LANGUAGE)
-        
-        # 2. TypeScript
-        ts_ptr = tree_sitter_typescript.language_typescript()
-        TS_LANGUAGE = make_language(ts_ptr, "typescript")
-        parser_ts = Parser()
-        parser_ts.set_language(TS_LANGUAGE)
-
-        # 3. HTML
-        html_ptr = tree_sitter_html.language()
-        html_lang = make_language(html_ptr, "html")
-        parser_html = Parser()
-        parser_html.set_language(html_lang)
-        
+        QUERIES[lang_key] = {name: language.query(src) for name, src in sources.items()}
     except Exception as e:
-        print(f"CRITICAL ERROR initializing Tree-sitter: {e}")
-        traceback.print_exc()
+        # Без запросов экстракторы переходят на итеративный обход TreeCursor.
+        # stdout занят протоколом stdio, поэтому предупреждение — в stderr.
+        print(f"WARNING: Tree-sitter queries unavailable for {lang_key}: {e}", file=sys.stderr)
+
+# Грамматики загружаются при первом обращении к языку: (пакет, фабрика указателя на язык).
+# Сервер, который видит только Python, не платит за JS/TS/HTML при старте.
+GRAMMARS = {
+    "javascript": ("tree_sitter_javascript", "language"),
+    "typescript": ("tree_sitter_typescript", "language_typescript"),
+    "html": ("tree_sitter_html", "language"),
+    # Необязательный бэкенд Python (pip install "mcp-edit-math[python]"), см. PYTHON_BACKEND.
+    "python": ("tree_sitter_python", "language"),
+}
+GRAMMAR_QUERY_SOURCES = {
+    "javascript": JS_QUERY_SOURCES, "typescript": JS_QUERY_SOURCES, "html": HTML_QUERY_SOURCES, "python": PY_QUERY_SOURCES,
+}
+
+_PARSERS: Dict[str, Any] = {}
+GRAMMAR_ERRORS: Dict[str, str] = {}
+_GRAMMAR_LOCK = threading.Lock()
 
-init_parsers()
+def _make_language(ptr, name):
+    try:
+        return Language(ptr, name)
+    except TypeError:
+        return Language(ptr)
+    except Exception:
+        return ptr
+
+def get_parser(lang_key: str):
+    """Returns the tree-sitter parser for lang_key, loading the grammar on first use. None if it cannot be loaded."""
+    parser = _PARSERS.get(lang_key)
+    if parser is not None or lang_key in GRAMMAR_ERRORS:
+        return parser
+    with _GRAMMAR_LOCK:
+        if lang_key in _PARSERS or lang_key in GRAMMAR_ERRORS:
+            return _PARSERS.get(lang_key)
+        with METRICS.phase("grammar_load", lang_key):
+            try:
+                if not TREE_SITTER_AVAILABLE:
+                    raise ImportError("tree-sitter is not installed")
+                package, factory = GRAMMARS[lang_key]
+                language = _make_language(getattr(importlib.import_module(package), factory)(), lang_key)
+                parser = Parser()
+                parser.set_language(language)
+            except Exception as e:
+                GRAMMAR_ERRORS[lang_key] = f"{type(e).__name__}: {e}"
+                return None
+            _compile_queries(language, lang_key, GRAMMAR_QUERY_SOURCES[lang_key])
+            _PARSERS[lang_key] = parser
+        return parser
+
+def _grammar_unavailable(lang_key: str) -> str:
+    return (f"❌ ERROR: {lang_key} analysis is unavailable ({GRAMMAR_ERRORS.get(lang_key, 'grammar not loaded')}). "
+            f"The server is running in Python-only mode. Install: {TREE_SITTER_INSTALL_HINT}")
+
+def init_parsers():
+    """Loads every grammar now instead of on first use (worker processes warm up with it)."""
+    for lang_key in GRAMMARS:
+        get_parser(lang_key)
 
 # -------------------------------------------------------
 
+# --- КЭШ ДЕРЕВЬЕВ РАЗБОРА ---
+# Агенты сканируют один и тот же файл много раз за цикл EASM.
+# Деревья кэшируются по (file_path, язык) и сверяются по хэшу содержимого;
+# при изменении файла tree-sitter перепарсивает только отредактированный участок.
+PARSE_CACHE_MAX_BYTES = int(os.environ.get("EDIT_MATH_PARSE_CACHE_BYTES", str(512 * 1024 * 1024)))
+PARSE_CACHE_MAX_ENTRIES = int(os.environ.get("EDIT_MATH_PARSE_CACHE_ENTRIES", "256"))
+# Оценка памяти записи в байтах на байт исходника. Дерево tree-sitter на корпусе бенчмарка
+# занимает 45-90x исходника (RSS), дерево ast — 14-83x; индекс определений — 1-11x.
+TREE_BYTES_PER_SOURCE_BYTE = 64
+ATTACHMENT_BYTES_PER_SOURCE_BYTE = 8
+
+def _content_hash(source: bytes) -> str:
+    return hashlib.blake2b(source, digest_size=16).hexdigest()
+
+def _byte_to_point(source: bytes, offset: int) -> Tuple[int, int]:
+    """Converts a byte offset into a tree-sitter (row, column) point."""
+    row = source.count(b"\n", 0, offset)
+    line_start = source.rfind(b"\n", 0, offset) + 1
+    return row, offset - line_start
+
+def _common_prefix_len(a: bytes, b: bytes) -> int:
+    # Бинарный поиск по срезам: сравнение выполняется в C, а не побайтово в Python.
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def _common_suffix_len(a: bytes, b: bytes, limit: int) -> int:
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:] == b[len(b) - mid:]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def _compute_source_edit(old: bytes, new: bytes) -> Dict[str, Any]:
+    """Describes the single contiguous region that differs between two buffers, in Tree.edit terms."""
+    prefix = _common_prefix_len(old, new)
+    suffix = _common_suffix_len(old, new, min(len(old), len(new)) - prefix)
+    old_end = len(old) - suffix
+    new_end = len(new) - suffix
+    return {
+        "start_byte": prefix,
+        "old_end_byte": old_end,
+        "new_end_byte": new_end,
+        "start_point": _byte_to_point(new, prefix),
+        "old_end_point": _byte_to_point(old, old_end),
+        "new_end_point": _byte_to_point(new, new_end),
+    }
+
+class _CachedParse:
+    __slots__ = ("source", "digest", "tree", "attachments", "charge")
+
+    def __init__(self, source: bytes, digest: str, tree: Any):
+        self.source = source
+        self.digest = digest
+        self.tree = tree
+        # Производные данные дерева (например, индекс определений); живут и умирают вместе с ним.
+        self.attachments: Dict[str, Any] = {}
+        self.charge = len(source) * (1 + TREE_BYTES_PER_SOURCE_BYTE)
+
+class ParseTreeCache:
+    """
+    Bounded LRU of parse trees keyed by (file_path, language).
+    Each entry is charged its source buffer plus an estimate for the tree and every
+    attachment, all proportional to the source size; the entry count is capped too.
+    """
+
+    def __init__(self, max_bytes: int, max_entries: int = PARSE_CACHE_MAX_ENTRIES):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], _CachedParse]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.incremental = 0
+        self.evictions = 0
+
+    def parse(
+        self,
+        key: Tuple[str, str],
+        source: bytes,
+        parse_fn: Callable[[bytes, Any], Any],
+        copy_fn: Optional[Callable[[bytes, Any], Any]] = None,
+    ) -> Tuple[Any, str]:
+        """
+        Returns (tree, status), status being one of "hit", "incremental", "miss".
+        parse_fn(source, old_tree) must build the tree; old_tree is None on a cold parse.
+        copy_fn(old_source, old_tree) returns an independent copy of a cached tree; without
+        it every change is a cold parse.
+        """
+        digest = _content_hash(source)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.digest == digest:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.tree, "hit"
+            if entry is not None:
+                self._drop(key)
+
+        old_tree = None
+        if entry is not None and copy_fn is not None:
+            # Кэшированное дерево может в этот момент обходить другой поток, а Tree.edit
+            # сдвигает его узлы на месте: правится копия.
+            old_tree = copy_fn(entry.source, entry.tree)
+            old_tree.edit(**_compute_source_edit(entry.source, source))
+
+        tree = parse_fn(source, old_tree)
+        with self._lock:
+            if old_tree is not None:
+                self.incremental += 1
+            else:
+                self.misses += 1
+            self._store(key, _CachedParse(source, digest, tree))
+        return tree, "incremental" if old_tree is not None else "miss"
+
+    def attachment(self, key: Tuple[str, str], tree: Any, name: str, build: Callable[[], Any]) -> Any:
+        """Returns data derived from `tree`, building it once while that tree is the cached one for `key`."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.tree is tree and name in entry.attachments:
+                return entry.attachments[name]
+        value = build()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.tree is tree and name not in entry.attachments:
+                entry.attachments[name] = value
+                charge = len(entry.source) * ATTACHMENT_BYTES_PER_SOURCE_BYTE
+                entry.charge += charge
+                self._bytes += charge
+                self._evict()
+        return value
+
+    def _drop(self, key: Tuple[str, str]) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.charge
+
+    def _store(self, key: Tuple[str, str], entry: _CachedParse) -> None:
+        self._drop(key)
+        if entry.charge > self.max_bytes:
+            return
+        self._entries[key] = entry
+        self._bytes += entry.charge
+        self._evict()
+
+    def _evict(self) -> None:
+        while self._entries and (self._bytes > self.max_bytes or len(self._entries) > self.max_entries):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.charge
+            self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "incremental": self.incremental,
+                "evictions": self.evictions,
+            }
+
+PARSE_CACHE = ParseTreeCache(PARSE_CACHE_MAX_BYTES)
+
+# Объекты Parser не потокобезопасны, а инструменты выполняются в пуле потоков.
+_PARSER_LOCK = threading.Lock()
+
+def _ts_parse(parser, source: bytes, old_tree: Any = None):
+    with _PARSER_LOCK:
+        return parser.parse(source, old_tree) if old_tree is not None else parser.parse(source)
+
+def _ts_copy(parser, source: bytes, tree: Any):
+    """
+    Independent copy of `tree`, parsed from `source`. The binding has no Tree.copy; a reparse
+    against the unedited tree reuses all of it, and Tree.edit clones shared subtrees before
+    changing them, so the original stays intact.
+    """
+    with _PARSER_LOCK:
+        parser.set_included_ranges(tree.included_ranges)
+        try:
+            return parser.parse(source, tree)
+        finally:
+            parser.set_included_ranges([])
+
+def _record_parse(lang_key: str, size: int, status: str, started: float) -> None:
+    METRICS.inc("parse_requests_total", language=lang_key, cache=status)
+    if status != "hit":
+        METRICS.inc("parsed_bytes_total", size, language=lang_key)
+        METRICS.observe("phase_duration_seconds", time.perf_counter() - started, phase="parse", language=lang_key)
+
+def _parse_cached(parser, lang_key: str, source: bytes, file_path: str) -> Tuple[Any, str]:
+    """Parses with tree-sitter through PARSE_CACHE. Anonymous snippets (no file_path) bypass the cache."""
+    started = time.perf_counter()
+    if not file_path:
+        tree, status = _ts_parse(parser, source), "uncached"
+    else:
+        key = (os.path.normpath(file_path).lower(), lang_key)
+        tree, status = PARSE_CACHE.parse(key, source, lambda src, old_tree: _ts_parse(parser, src, old_tree),
+                                         lambda src, tree: _ts_copy(parser, src, tree))
+    _record_parse(lang_key, len(source), status, started)
+    return tree, status
+
+def _parse_python_cached(source: bytes, file_path: str) -> Tuple[ast.AST, str]:
+    """ast has no incremental mode, so only exact content hits are reused. Raises SyntaxError."""
+    started = time.perf_counter()
+    if not file_path:
+        tree, status = ast.parse(source), "uncached"
+    else:
+        key = (os.path.normpath(file_path).lower(), "python")
+        tree, status = PARSE_CACHE.parse(key, source, lambda src, _old: ast.parse(src))
+    _record_parse("python", len(source), status, started)
+    return tree, status
+
+def _ts_parse_ranges(parser, source: bytes, ranges: List[Any], old_tree: Any = None):
+    """Parses only `ranges` of source (byte offsets stay those of the full buffer), then restores full-document parsing."""
+    with _PARSER_LOCK:
+        parser.set_included_ranges(ranges)
+        try:
+            return parser.parse(source, old_tree) if old_tree is not None else parser.parse(source)
+        finally:
+            parser.set_included_ranges([])
+
+# Стоимость разбора по included ranges в tree-sitter растет быстрее линейной от числа
+# диапазонов (16k обработчиков: 1.1 с против 0.13 с для той же склеенной строки),
+# поэтому фрагменты разбираются пачками фиксированного размера.
+EMBEDDED_RANGES_PER_PARSE = 512
+
+def _parse_embedded(lang_key: str, source: bytes, nodes: List[Any], file_path: str, cache_lang: str) -> Tuple[Any, str]:
+    """Parses code embedded in a host document (inline scripts, handlers) in place, cached under `cache_lang`."""
+    parser = get_parser(lang_key)
+    ranges = [Range(n.start_point, n.end_point, n.start_byte, n.end_byte) for n in nodes]
+    started = time.perf_counter()
+    if not file_path:
+        tree, status = _ts_parse_ranges(parser, source, ranges), "uncached"
+    else:
+        key = (os.path.normpath(file_path).lower(), cache_lang)
+        tree, status = PARSE_CACHE.parse(key, source, lambda src, old_tree: _ts_parse_ranges(parser, src, ranges, old_tree),
+                                         lambda src, tree: _ts_copy(parser, src, tree))
+    _record_parse(f"{lang_key}@html", sum(n.end_byte - n.start_byte for n in nodes), status, started)
+    return tree, status
+
+# --- ЧТЕНИЕ ФАЙЛОВ С ДИСКА ---
+# Если передан только file_path, сервер читает файл сам: код не гоняется через
+# транспорт MCP и не перекодируется. Содержимое кэшируется по (inode, mtime, size),
+# поэтому неизмененный файл не перечитывается.
+SOURCE_CACHE_MAX_BYTES = int(os.environ.get("EDIT_MATH_SOURCE_CACHE_BYTES", str(64 * 1024 * 1024)))
+MMAP_THRESHOLD_BYTES = int(os.environ.get("EDIT_MATH_MMAP_BYTES", str(1024 * 1024)))
+
+class SourceFileCache:
+    """Bounded LRU of file contents keyed by real path and validated by (st_ino, st_mtime_ns, st_size)."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[Tuple[int, int, int], bytes]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def read(self, file_path: str) -> bytes:
+        real_path = os.path.realpath(file_path)
+        st = os.stat(real_path)
+        stat_key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            entry = self._entries.get(real_path)
+            if entry is not None and entry[0] == stat_key:
+                self._entries.move_to_end(real_path)
+                self.hits += 1
+                return entry[1]
+
+        data = _read_file_bytes(real_path, st.st_size)
+        with self._lock:
+            self.misses += 1
+            old = self._entries.pop(real_path, None)
+            if old is not None:
+                self._bytes -= len(old[1])
+            if len(data) <= self.max_bytes:
+                self._entries[real_path] = (stat_key, data)
+                self._bytes += len(data)
+                while self._bytes > self.max_bytes:
+                    _, (_, evicted) = self._entries.popitem(last=False)
+                    self._bytes -= len(evicted)
+        return data
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
+
+def _read_file_bytes(path: str, size: int) -> bytes:
+    """Large files are memory-mapped and copied once into bytes, skipping buffered read chunks."""
+    with open(path, "rb") as f:
+        if size < MMAP_THRESHOLD_BYTES:
+            return f.read()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return mapped[:]
+
+SOURCE_CACHE = SourceFileCache(SOURCE_CACHE_MAX_BYTES)
+
+def _parse_cache_summary(status: str) -> str:
+    stats = PARSE_CACHE.stats()
+    return (
+        f"Parse Cache: {status} (hits={stats['hits']}, incremental={stats['incremental']}, "
+        f"misses={stats['misses']}, entries={stats['entries']}, bytes={stats['bytes']}/{stats['max_bytes']})"
+    )
+
+def _iter_nodes(node):
+    """Pre-order traversal with a TreeCursor: constant Python stack depth regardless of nesting."""
+    cursor = node.walk()
+    descending = True
+    while True:
+        if descending:
+            yield cursor.node
+            if cursor.goto_first_child():
+                continue
+        if cursor.goto_next_sibling():
+            descending = True
+        elif cursor.goto_parent():
+            descending = False
+        else:
+            return
+
+def _capture_bounds(byte_range: Optional[Tuple[int, int]]) -> Dict[str, int]:
+    """Query.captures keyword arguments restricting matches to nodes that intersect byte_range."""
+    return {"start_byte": byte_range[0], "end_byte": byte_range[1]} if byte_range else {}
+
+def _query_nodes(node, lang_key: str, query_name: str, fallback_types: Set[str]):
+    """Nodes captured by a precompiled query, in document order; TreeCursor scan if the query is unavailable."""
+    query = QUERIES.get(lang_key, {}).get(query_name)
+    if query is not None:
+        return [captured for captured, _ in query.captures(node)]
+    return [n for n in _iter_nodes(node) if n.type in fallback_types]
+
+def _iter_js_definitions(root_node, lang_key: str):
+    """
+    Yields (name_node, declaration_node, scan_node) for class/function/method declarations and
+    lexical variable declarators. scan_node is what a target scan covers (method body, declarator value).
+    """
+    for node in _query_nodes(root_node, lang_key, "declarations", JS_DEFINITION_TYPES):
+        if node.type == 'lexical_declaration':
+            continue
+        if node.type == 'variable_declarator' and (not node.parent or node.parent.type != 'lexical_declaration'):
+            continue
+        name_node, scan_node = _js_definition_parts(node)
+        yield name_node, node, scan_node
+
+JS_DEFINITION_TYPES = {"class_declaration", "function_declaration", "method_definition", "variable_declarator"}
+
 def has_syntax_errors(tree) -> bool:
     if not tree: return False
     root = tree.root_node
     return root.has_error
 
+# --- ИНДЕКС ОПРЕДЕЛЕНИЙ ФАЙЛА ---
+# Один проход по файлу записывает все функции, классы, методы и объявления
+# со стрелочными функциями вместе с их вызовами. Поиск любого target_function
+# в неизмененном файле — это обращение к словарю, без повторного обхода дерева.
+ALL_TARGETS = "ALL_TARGETS"
+
+class _Definition:
+    __slots__ = ("name", "kind", "line", "start_byte", "end_byte", "scan_type", "_all_calls", "_first_call", "_last_call")
+
+    def __init__(self, name: str, kind: str, line: int, start_byte: int, end_byte: int, scan_type: str):
+        self.name = name
+        self.kind = kind
+        self.line = line
+        self.start_byte = start_byte
+        self.end_byte = end_byte
+        self.scan_type = scan_type
+        # Вызовы определения идут в all_calls файла подряд (порядок документа), поэтому
+        # храним только границы отрезка: копия списка в каждом объемлющем определении
+        # умножала память индекса на глубину вложенности.
+        self._all_calls: List[Tuple[str, str]] = []
+        self._first_call = self._last_call = 0
+
+    @property
+    def calls(self) -> List[Tuple[str, str]]:
+        """Сырые вызовы (имя, вид): "plain" — f(), "self" — this.f()/self.f(), "member" — obj.f()."""
+        return self._all_calls[self._first_call:self._last_call]
+
+class _CallNames(dict):
+    """(raw name bytes, kind) -> shared (name, kind) tuple: each distinct callee of a file is decoded once."""
+    __slots__ = ()
+
+    def __missing__(self, key: Tuple[bytes, str]) -> Tuple[str, str]:
+        call = self[key] = (key[0].decode('utf8'), key[1])
+        return call
+
+class FileDefinitionIndex:
+    """Every definition of one file with its raw call sites; `by_name` keeps the first definition per name."""
+
+    __slots__ = ("definitions", "by_name", "all_calls", "module_calls")
+
+    def __init__(self):
+        self.definitions: List[_Definition] = []
+        self.by_name: Dict[str, _Definition] = {}
+        self.all_calls: List[Tuple[str, str]] = []
+        self.module_calls: List[Tuple[str, str]] = []
+
+    def add(self, definition: _Definition) -> None:
+        self.definitions.append(definition)
+        self.by_name.setdefault(definition.name, definition)
+
+    def bind_calls(self, positions: Sequence[int]) -> None:
+        """Points each definition at the calls inside its byte range; positions are the call start bytes of all_calls."""
+        for definition in self.definitions:
+            definition._all_calls = self.all_calls
+            definition._first_call = bisect.bisect_left(positions, definition.start_byte)
+            definition._last_call = bisect.bisect_left(positions, definition.end_byte)
+
+def _index_cached(tree: Any, lang_key: str, file_path: str, build: Callable[[], FileDefinitionIndex]) -> FileDefinitionIndex:
+    def timed_build() -> FileDefinitionIndex:
+        with METRICS.phase("index", lang_key):
+            return build()
+    if not file_path:
+        return timed_build()
+    return PARSE_CACHE.attachment((os.path.normpath(file_path).lower(), lang_key), tree, "definitions", timed_build)
+
 # --- ЛОГИКА PYTHON (AST) ---
-def _extract_python_dependencies(code: str, target_name: str, ignore_custom: Optional[List[str]] = None) -> Tuple[Set[str], List[str]]:
+PYTHON_IGNORE = frozenset({
+    "print", "len", "str", "int", "float", "bool", "list", "dict", "set", "tuple",
+    "range", "enumerate", "zip", "map", "filter", "sum", "min", "max", "abs",
+    "isinstance", "issubclass", "type", "super", "getattr", "setattr", "hasattr",
+    "open", "dir", "id", "input", "repr", "round", "sorted", "reversed",
+    "__init__", "__str__", "__repr__", "self"
+})
+
+class _PythonIndexer(ast.NodeVisitor):
+    """Single visitor pass collecting definitions and the calls made inside each of them."""
+
+    def __init__(self):
+        self.index = FileDefinitionIndex()
+        self._stack: List[_Definition] = []
+        self._ranked: Dict[str, Tuple[int, int, int]] = {}
+        self._calls: Dict[Tuple[str, str], Tuple[str, str]] = {}
+
+    def _visit_definition(self, node) -> None:
+        # Байтовые диапазоны нужны только деревьям tree-sitter; для ast достаточно строки.
+        definition = _Definition(node.name, type(node).__name__, node.lineno, 0, 0, type(node).__name__)
+        self.index.definitions.append(definition)
+        # ast.walk (BFS) находил самое неглубокое определение — сохраняем этот приоритет.
+        rank = (len(self._stack), node.lineno, node.col_offset)
+        if definition.name not in self._ranked or rank < self._ranked[definition.name]:
+            self._ranked[definition.name] = rank
+            self.index.by_name[definition.name] = definition
+        # Вызовы, посещенные внутри определения, идут в all_calls подряд.
+        definition._all_calls = self.index.all_calls
+        definition._first_call = len(self.index.all_calls)
+        self._stack.append(definition)
+        self.generic_visit(node)
+        self._stack.pop()
+        definition._last_call = len(self.index.all_calls)
+
+    visit_FunctionDef = _visit_definition
+    visit_AsyncFunctionDef = _visit_definition
+    visit_ClassDef = _visit_definition
+
+    def visit_Call(self, node: ast.Call) -> None:
+        call = None
+        if isinstance(node.func, ast.Name):
+            call = (node.func.id, "plain")
+        elif isinstance(node.func, ast.Attribute):
+            is_self = isinstance(node.func.value, ast.Name) and node.func.value.id == 'self'
+            call = (node.func.attr, "self" if is_self else "member")
+        if call:
+            call = self._calls.setdefault(call, call)
+            self.index.all_calls.append(call)
+            if not self._stack:
+                self.index.module_calls.append(call)
+        self.generic_visit(node)
+
+def _build_python_index(tree: ast.AST) -> FileDefinitionIndex:
+    indexer = _PythonIndexer()
+    indexer.visit(tree)
+    return indexer.index
+
+PY_TS_DEFINITION_KINDS = {"function_definition": "FunctionDef", "class_definition": "ClassDef"}
+
+def _classify_python_ts_call(func_node, names: _CallNames) -> Optional[Tuple[str, str]]:
+    if func_node.type == 'identifier':
+        return names[(func_node.text, "plain")]
+    if func_node.type == 'attribute':
+        attr_node = func_node.child_by_field_name('attribute')
+        if attr_node is None:
+            return None
+        obj_node = func_node.child_by_field_name('object')
+        is_self = obj_node is not None and obj_node.type == 'identifier' and obj_node.text == b'self'
+        return names[(attr_node.text, "self" if is_self else "member")]
+    return None
+
+def _build_python_ts_index(tree, byte_range: Optional[Tuple[int, int]] = None) -> FileDefinitionIndex:
+    """
+    tree-sitter-python counterpart of _PythonIndexer: same kinds, call kinds and
+    shallowest-first `by_name`. Definitions inside ERROR nodes are still indexed,
+    so a half-edited file yields partial results instead of nothing.
+    byte_range limits the pass to captures intersecting it (enclosing definitions included).
+    """
+    index = FileDefinitionIndex()
+    stack: List[_Definition] = []
+    ranked: Dict[str, Tuple[int, int, int]] = {}
+    names = _CallNames()
+    positions = array("q")
+    decorated_start = -1
+    query = QUERIES.get("python", {}).get("index")
+    if query is not None:
+        captures = query.captures(tree.root_node, **_capture_bounds(byte_range))
+    else:
+        captures = []
+        for node in _iter_nodes(tree.root_node):
+            if byte_range and (node.end_byte <= byte_range[0] or node.start_byte >= byte_range[1]):
+                continue
+            if node.type in PY_TS_DEFINITION_KINDS or node.type == 'decorated_definition':
+                captures.append((node, "def"))
+            elif node.type == 'call' and node.child_by_field_name('function') is not None:
+                captures.append((node.child_by_field_name('function'), "callee"))
+    for node, capture in captures:
+        position = node.start_byte
+        while stack and stack[-1].end_byte <= position:
+            stack.pop()
+        if capture == "def":
+            # Как и в ast, вызовы декораторов принадлежат декорированному определению,
+            # поэтому диапазон начинается с decorated_definition, а строка — со слова def/class.
+            # Вложенное определение приходит следующим захватом; node.parent здесь не годится —
+            # в tree-sitter 0.21 он спускается от корня, а вложенность бывает глубокой.
+            if node.start_byte == decorated_start:
+                continue
+            span = node
+            if node.type == 'decorated_definition':
+                node = node.child_by_field_name('definition')
+                if node is None or node.type not in PY_TS_DEFINITION_KINDS:
+                    continue
+                decorated_start = node.start_byte
+            name_node = node.child_by_field_name('name')
+            if name_node is None:
+                continue
+            kind = PY_TS_DEFINITION_KINDS[node.type]
+            if kind == "FunctionDef" and node.child_count and node.children[0].type == 'async':
+                kind = "AsyncFunctionDef"
+            definition = _Definition(name_node.text.decode('utf8'), kind, node.start_point[0] + 1, span.start_byte, span.end_byte, kind)
+            index.definitions.append(definition)
+            rank = (len(stack), node.start_point[0], node.start_point[1])
+            if definition.name not in ranked or rank < ranked[definition.name]:
+                ranked[definition.name] = rank
+                index.by_name[definition.name] = definition
+            stack.append(definition)
+            continue
+
+        call = _classify_python_ts_call(node, names)
+        if call is None:
+            continue
+        index.all_calls.append(call)
+        positions.append(position)
+        if not stack:
+            index.module_calls.append(call)
+    index.bind_calls(positions)
+    return index
+
+# --- БЭКЕНД PYTHON ---
+# "ast" — стандартная библиотека, только точные попадания в кэш. "tree-sitter" — tree-sitter-python:
+# инкрементальный перепарсинг через PARSE_CACHE и частичный результат при синтаксических ошибках;
+# на корпусе benchmarks/bench_python он и при холодном разборе в ~2 раза быстрее ast.
+# "auto" (по умолчанию) — tree-sitter-python, если он установлен, иначе ast.
+# Индексы обоих бэкендов на корректном коде совпадают.
+PYTHON_BACKEND = os.environ.get("EDIT_MATH_PYTHON_BACKEND", "auto").lower()
+if PYTHON_BACKEND not in ("auto", "ast", "tree-sitter"):
+    raise ValueError(f"Unknown EDIT_MATH_PYTHON_BACKEND: {PYTHON_BACKEND}")
+
+def _parse_python_index(source: bytes, file_path: str, tolerant: bool = True) -> Tuple[Any, FileDefinitionIndex, str, str]:
+    """
+    (tree, definition index, cache status, cache language) of Python source: one parse, one pass.
+    The cache language is "python" for ast trees and "python@ts" for tree-sitter ones.
+    tolerant=False rejects sources with syntax errors (language probing).
+    Raises SyntaxError (or ValueError for null bytes) when no backend accepts the source.
+    """
+    parser = get_parser("python") if PYTHON_BACKEND != "ast" else None
+    if parser is None:
+        tree, status = _parse_python_cached(source, file_path)
+        return tree, _index_cached(tree, "python", file_path, lambda: _build_python_index(tree)), status, "python"
+    tree, status = _parse_cached(parser, "python@ts", source, file_path)
+    if not tolerant and tree.root_node.has_error:
+        raise SyntaxError("tree-sitter-python found syntax errors")
+    return tree, _index_cached(tree, "python@ts", file_path, lambda: _build_python_ts_index(tree)), status, "python@ts"
+
+def _python_partial_log(tree: Any) -> List[str]:
+    if isinstance(tree, ast.AST) or not tree.root_node.has_error:
+        return []
+    return ["⚠️ Syntax errors in source: partial results (tree-sitter-python)"]
+
+def _filter_python_calls(calls: List[Tuple[str, str]], target_name: str, ignore: Set[str], logs: List[str]) -> Set[str]:
     dependencies = set()
+    for call_name, kind in calls:
+        if kind == "self":
+            logs.append(f"Found self call: {call_name}")
+        if call_name not in ignore and call_name != target_name:
+            dependencies.add(call_name)
+    return dependencies
+
+def _extract_python_dependencies(code: Union[str, bytes], target_name: str, ignore_custom: Optional[List[str]] = None, tree: Optional[ast.AST] = None, index: Optional[FileDefinitionIndex] = None) -> Tuple[Set[str], List[str]]:
     logs = []
-    try:
-        tree = ast.parse(code)
-    except SyntaxError as e:
-        return set(), [f"Python Syntax Error: {e}"]
+    if index is None:
+        if tree is None:
+            try:
+                tree = ast.parse(code)
+            except SyntaxError as e:
+                return set(), [f"Python Syntax Error: {e}"]
+        index = _build_python_index(tree)
 
-    target_node = None
-    
     if target_name == "ENTIRE_FILE":
-        target_node = tree
+        calls = index.all_calls
         logs.append("✅ Scanning ENTIRE FILE (Python)")
     else:
-        for node in ast.walk(tree):
-            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
-                if node.name == target_name:
-                    target_node = node
-                    break
-        
-        if target_node:
-            logs.append(f"✅ Found Python target: {type(target_node).__name__}")
+        target = index.by_name.get(target_name)
+        if target:
+            calls = target.calls
+            logs.append(f"✅ Found Python target: {target.kind}")
         else:
             logs.append("❌ Target node NOT found. Scanning entire snippet.")
-            target_node = tree
-
-    IGNORE_PYTHON = {
-        "print", "len", "str", "int", "float", "bool", "list", "dict", "set", "tuple",
-        "range", "enumerate", "zip", "map", "filter", "sum", "min", "max", "abs",
-        "isinstance", "issubclass", "type", "super", "getattr", "setattr", "hasattr",
-        "open", "dir", "id", "input", "repr", "round", "sorted", "reversed",
-        "__init__", "__str__", "__repr__", "self"
-    }
-    if ignore_custom:
-        IGNORE_PYTHON.update(ignore_custom)
-
-    for node in ast.walk(target_node):
-        call_name = None
-        if isinstance(node, ast.Call):
-            if isinstance(node.func, ast.Name):
-                call_name = node.func.id
-            elif isinstance(node.func, ast.Attribute):
-                call_name = node.func.attr
-                if isinstance(node.func.value, ast.Name) and node.func.value.id == 'self':
-                    logs.append(f"Found self call: {call_name}")
-        
-        if call_name:
-            if call_name not in IGNORE_PYTHON and call_name != target_name:
-                dependencies.add(call_name)
+            calls = index.all_calls
 
-    return dependencies, logs
+    ignore = set(PYTHON_IGNORE)
+    if ignore_custom:
+        ignore.update(ignore_custom)
+    return _filter_python_calls(calls, target_name, ignore, logs), logs
 
 # --- ЛОГИКА JS/TS (Tree-sitter) ---
-def _extract_dependencies_from_tree(tree, target_name: str, ignore_custom: Optional[List[str]] = None) -> Tuple[Set[str], List[str]]:
-    if not tree: return set(), ["Error: Tree is None"]
-    root_node = tree.root_node
-    dependencies = set()
-    logs = []
+JS_IGNORE_GLOBALS = frozenset({
+    "console", "Math", "JSON", "Date", "Object", "Array", "Promise", "Error",
+    "parseInt", "parseFloat", "setTimeout", "setInterval", "alert", "confirm",
+    "require", "window", "document", "history", "navigator", "location"
+})
 
-    def find_target_node(node, name):
-        if node.type == 'class_declaration':
-            name_node = node.child_by_field_name('name')
-            if name_node and name_node.text.decode('utf8') == name: return node
-        if node.type == 'function_declaration':
-            name_node = node.child_by_field_name('name')
-            if name_node and name_node.text.decode('utf8') == name: return node
-        elif node.type == 'method_definition':
-            name_node = node.child_by_field_name('name')
-            if name_node and name_node.text.decode('utf8') == name: return node.child_by_field_name('body')
-        elif node.type == 'lexical_declaration':
-            for i in range(node.child_count):
-                child = node.child(i)
-                if child.type == 'variable_declarator':
-                    name_node = child.child_by_field_name('name')
-                    if name_node and name_node.text.decode('utf8') == name: return child.child_by_field_name('value')
-        for i in range(node.child_count):
-            res = find_target_node(node.child(i), name)
-            if res: return res
+JS_IGNORE_METHODS = frozenset({
+    "log", "error", "warn", "info", "debug",
+    "push", "pop", "shift", "unshift", "splice", "slice", "join", "split",
+    "map", "filter", "reduce", "forEach", "find", "some", "every",
+    "toString", "toFixed", "replace", "replaceAll", "trim",
+    "querySelector", "querySelectorAll", "getElementById", "addEventListener",
+    "remove", "add", "has", "get", "set", "keys", "values", "entries",
+    "now", "abs", "round", "floor", "ceil", "min", "max", "random",
+    "then", "catch", "finally", "length", "subscribe", "unsubscribe"
+})
+
+def _classify_js_call(func_node, names: _CallNames) -> Optional[Tuple[str, str]]:
+    """(name, kind) for the `function` child of a call_expression, or None for calls we do not track."""
+    if func_node is None:
         return None
+    if func_node.type == 'identifier':
+        return names[(func_node.text, "plain")]
+    if func_node.type == 'member_expression':
+        prop_node = func_node.child_by_field_name('property')
+        if prop_node is None:
+            return None
+        # Объект вызова (может быть огромным выражением) не материализуется — достаточно его типа.
+        obj_node = func_node.child_by_field_name('object')
+        kind = "self" if obj_node is not None and obj_node.type == 'this' else "member"
+        return names[(prop_node.text, kind)]
+    return None
+
+def _iter_js_index_captures(root_node, lang_key: str, byte_range: Optional[Tuple[int, int]] = None):
+    """(node, "def" | "callee") in document order from the combined index query, or a TreeCursor scan."""
+    query = QUERIES.get(lang_key, {}).get("index")
+    if query is not None:
+        return query.captures(root_node, **_capture_bounds(byte_range))
+    captures = []
+    for node in _iter_nodes(root_node):
+        if byte_range and (node.end_byte <= byte_range[0] or node.start_byte >= byte_range[1]):
+            continue
+        if node.type in JS_DEFINITION_TYPES:
+            if node.type != 'variable_declarator' or (node.parent and node.parent.type == 'lexical_declaration'):
+                captures.append((node, "def"))
+        elif node.type == 'call_expression':
+            func_node = node.child_by_field_name('function')
+            if func_node is not None:
+                captures.append((func_node, "callee"))
+    return captures
+
+def _js_definition_parts(node):
+    """(name_node, scan_node) of a declaration: what find-target matched and which subtree a target scan covers."""
+    if node.type == 'variable_declarator':
+        return node.child_by_field_name('name'), node.child_by_field_name('value')
+    if node.type == 'method_definition':
+        return node.child_by_field_name('name'), node.child_by_field_name('body')
+    return node.child_by_field_name('name'), node
+
+def _build_js_index(tree, lang_key: str, byte_range: Optional[Tuple[int, int]] = None) -> FileDefinitionIndex:
+    """
+    One query walk over the file. Captures arrive in document order and definition
+    scan ranges nest, so a stack of open ranges tells which calls are module-level;
+    each definition's calls are the run of all_calls inside its scan range.
+    byte_range limits the walk to captures intersecting it (enclosing definitions included).
+    """
+    index = FileDefinitionIndex()
+    stack: List[_Definition] = []
+    names = _CallNames()
+    positions = array("q")
+    for node, capture in _iter_js_index_captures(tree.root_node, lang_key, byte_range):
+        position = node.start_byte
+        while stack and stack[-1].end_byte <= position:
+            stack.pop()
+        if capture == "def":
+            name_node, scan_node = _js_definition_parts(node)
+            if name_node is None or scan_node is None:
+                continue
+            definition = _Definition(
+                name_node.text.decode('utf8'), node.type, node.start_point[0] + 1,
+                scan_node.start_byte, scan_node.end_byte, scan_node.type,
+            )
+            index.add(definition)
+            stack.append(definition)
+            continue
+
+        call = _classify_js_call(node, names)
+        if call is None:
+            continue
+        index.all_calls.append(call)
+        positions.append(position)
+        # Вызов может стоять до начала тела открытого определения (например, в параметрах метода);
+        # вложенные определения начинаются не раньше внешнего, поэтому достаточно проверить дно стека.
+        if not stack or stack[0].start_byte > position:
+            index.module_calls.append(call)
+    index.bind_calls(positions)
+    return index
+
+def _filter_js_calls(calls: List[Tuple[str, str]], target_name: str, ignore_globals: Set[str], ignore_methods: Set[str]) -> Set[str]:
+    dependencies = set()
+    for call_name, kind in calls:
+        if kind == "member" and call_name in ignore_methods:
+            continue
+        if call_name not in ignore_globals and call_name != target_name:
+            dependencies.add(call_name)
+    return dependencies
+
+def _js_ignore_sets(ignore_custom: Optional[List[str]]) -> Tuple[Set[str], Set[str]]:
+    ignore_globals = set(JS_IGNORE_GLOBALS)
+    ignore_methods = set(JS_IGNORE_METHODS)
+    if ignore_custom:
+        ignore_globals.update(ignore_custom)
+        ignore_methods.update(ignore_custom)
+    return ignore_globals, ignore_methods
+
+def _extract_dependencies_from_tree(tree, target_name: str, ignore_custom: Optional[List[str]] = None, lang_key: str = "javascript", index: Optional[FileDefinitionIndex] = None) -> Tuple[Set[str], List[str]]:
+    if not tree: return set(), ["Error: Tree is None"]
+    logs = []
+    if index is None:
+        index = _build_js_index(tree, lang_key)
 
-    target_node = None
     if target_name == "ENTIRE_FILE":
-        target_node = root_node
+        calls = index.all_calls
         logs.append("✅ Scanning ENTIRE FILE (JS/TS)")
     else:
-        target_node = find_target_node(root_node, target_name)
-        if target_node:
-            logs.append(f"✅ Found target node type: {target_node.type}")
+        target = index.by_name.get(target_name)
+        if target:
+            calls = target.calls
+            logs.append(f"✅ Found target node type: {target.scan_type}")
         else:
             logs.append("❌ Target node NOT found. Scanning root.")
-            target_node = root_node
+            calls = index.all_calls
 
-    IGNORE_LIST = {
-        "console", "Math", "JSON", "Date", "Object", "Array", "Promise", "Error",
-        "parseInt", "parseFloat", "setTimeout", "setInterval", "alert", "confirm",
-        "require", "window", "document", "history", "navigator", "location"
-    }
-    
-    IGNORE_METHODS = {
-        "log", "error", "warn", "info", "debug",
-        "push", "pop", "shift", "unshift", "splice", "slice", "join", "split",
-        "map", "filter", "reduce", "forEach", "find", "some", "every",
-        "toString", "toFixed", "replace", "replaceAll", "trim",
-        "querySelector", "querySelectorAll", "getElementById", "addEventListener",
-        "remove", "add", "has", "get", "set", "keys", "values", "entries",
-        "now", "abs", "round", "floor", "ceil", "min", "max", "random",
-        "then", "catch", "finally", "length", "subscribe", "unsubscribe"
-    }
+    ignore_globals, ignore_methods = _js_ignore_sets(ignore_custom)
+    return _filter_js_calls(calls, target_name, ignore_globals, ignore_methods), logs
+
+def _js_all_targets(index: FileDefinitionIndex, ignore_custom: Optional[List[str]] = None) -> List[Tuple[_Definition, List[str]]]:
+    """Dependency map for every definition of the file, in document order."""
+    ignore_globals, ignore_methods = _js_ignore_sets(ignore_custom)
+    return [
+        (definition, sorted(_filter_js_calls(definition.calls, definition.name, ignore_globals, ignore_methods)))
+        for definition in index.definitions
+    ]
 
+def _python_all_targets(index: FileDefinitionIndex, ignore_custom: Optional[List[str]] = None) -> List[Tuple[_Definition, List[str]]]:
+    ignore = set(PYTHON_IGNORE)
     if ignore_custom:
-        IGNORE_LIST.update(ignore_custom)
-        IGNORE_METHODS.update(ignore_custom)
+        ignore.update(ignore_custom)
+    return [
+        (definition, sorted(_filter_python_calls(definition.calls, definition.name, ignore, [])))
+        for definition in index.definitions
+    ]
 
-    def find_calls(node):
-        if node.type == 'call_expression':
-            func_node = node.child_by_field_name('function')
-            call_name = None
-            
-            if func_node.type == 'identifier':
-                call_name = func_node.text.decode('utf8')
-            elif func_node.type == 'member_expression':
-                prop_node = func_node.child_by_field_name('property')
-                obj_node = func_node.child_by_field_name('object')
-                if prop_node:
-                    method_name = prop_node.text.decode('utf8')
-                    obj_name = obj_node.text.decode('utf8') if obj_node else "unknown"
-                    
-                    if (obj_node.type == 'this') or (obj_name == 'this'):
-                        call_name = method_name
-                    elif method_name not in IGNORE_METHODS:
-                        call_name = method_name
-            
-            if call_name:
-                if call_name not in IGNORE_LIST and call_name != target_name:
-                    dependencies.add(call_name)
+def _format_all_targets(logs_prefix: str, entries: List[Tuple[_Definition, List[str]]], base_hash: str, logs: List[str]) -> str:
+    lines = [
+        f"{definition.name} ({definition.kind}, line {definition.line}): {', '.join(deps) if deps else 'None'}"
+        for definition, deps in entries
+    ]
+    targets_output = "\n        ".join(lines) if lines else "None"
+    return f"""
+        [ACCESS REVOKED] {logs_prefix} Analysis for ALL TARGETS:
+        --------------------------------
+        Targets: {len(entries)}
+        {targets_output}
+        BASE HASH: {base_hash}
+        
+        DEBUG INFO:
+        {chr(10).join(logs[:15])}
+        """
 
-        for i in range(node.child_count):
-            find_calls(node.child(i))
+ALL_TARGETS_FIELDS = ("name", "kind", "line", "dependencies")
 
-    find_calls(target_node)
-    return dependencies, logs
+def _all_targets_json(entries: List[Tuple[_Definition, List[str]]]) -> List[list]:
+    # Строки-массивы, а не объекты: ключи, повторенные на каждую функцию, раздували бы ответ.
+    # Зависимости — одной строкой через запятую: кавычки вокруг каждого имени транспорт экранирует
+    # дважды (text + structuredContent), и на больших файлах JSON выходил длиннее текста.
+    return [[definition.name, definition.kind, definition.line, ",".join(deps)] for definition, deps in entries]
 
 # --- ЛОГИКА HTML ---
-def _extract_html_dependencies(tree) -> Tuple[Set[str], List[str]]:
+# Встроенные <script> и обработчики on* разбираются на месте: парсер JS/TS получает
+# included ranges поверх исходного буфера, без копирования подстрок. Все фрагменты
+# одного языка на странице — один проход парсера.
+# Обработчики соседних атрибутов склеиваются в одну программу; незавершенный
+# обработчик (`if (x)`) может поглотить следующий, но вызовы сохраняют исходные
+# смещения, поэтому каждый вызов относится к фрагменту, в котором он стоит.
+# Имена атрибутов и типы скриптов сравниваются как байты, без декодирования.
+HTML_JS_SCRIPT_TYPES = frozenset({
+    b"", b"module", b"js", b"jsx", b"javascript", b"text/javascript", b"application/javascript",
+    b"text/ecmascript", b"application/ecmascript", b"text/jsx", b"text/babel",
+})
+HTML_TS_SCRIPT_TYPES = frozenset({b"ts", b"tsx", b"typescript", b"text/typescript", b"application/typescript", b"application/x-typescript"})
+_NON_SPACE = re.compile(rb"\S")
+
+class _HtmlRegions:
+    """Script sources and embedded code of one page; handler and script nodes are raw value/body nodes."""
+    __slots__ = ("script_srcs", "handlers", "scripts")
+
+    def __init__(self):
+        self.script_srcs: List[str] = []
+        # (имя атрибута в байтах, узел значения): имя декодируется, только если попадает в лог.
+        self.handlers: List[Tuple[bytes, Any]] = []
+        self.scripts: Dict[str, List[Any]] = {"javascript": [], "typescript": []}
+
+def _attribute_parts(attribute) -> Tuple[Optional[bytes], Any]:
+    """(lower-case name bytes, value node without quotes) of an HTML attribute."""
+    name, value = None, None
+    for child in attribute.children:
+        if child.type == 'attribute_name':
+            name = child.text.lower()
+        elif child.type == 'attribute_value':
+            value = child
+        elif child.type == 'quoted_attribute_value':
+            value = next((c for c in child.children if c.type == 'attribute_value'), None)
+    return name, value
+
+def _collect_html_regions(root_node, source: bytes) -> _HtmlRegions:
+    regions = _HtmlRegions()
+    for node in _query_nodes(root_node, "html", "attributes", {"attribute"}):
+        if node.type != 'attribute':
+            continue
+        name, value = _attribute_parts(node)
+        if name and value is not None and name.startswith(b'on'):
+            regions.handlers.append((name, value))
+
+    for script in _query_nodes(root_node, "html", "scripts", {"script_element"}):
+        attributes = {}
+        body = None
+        for child in script.children:
+            if child.type == 'start_tag':
+                for attribute in child.children:
+                    if attribute.type == 'attribute':
+                        name, value = _attribute_parts(attribute)
+                        if name:
+                            attributes[name] = value.text.strip() if value is not None else b""
+            elif child.type == 'raw_text':
+                body = child
+        if attributes.get(b"src"):
+            regions.script_srcs.append(attributes[b"src"].decode('utf8'))
+        # Пустое тело проверяется регулярным выражением по исходному буферу, без копии текста скрипта.
+        if body is None or not _NON_SPACE.search(source, body.start_byte, body.end_byte):
+            continue
+        script_type = (attributes.get(b"lang") or attributes.get(b"type", b"")).lower()
+        if script_type in HTML_TS_SCRIPT_TYPES:
+            regions.scripts["typescript"].append(body)
+        elif script_type in HTML_JS_SCRIPT_TYPES:
+            regions.scripts["javascript"].append(body)
+    return regions
+
+def _embedded_calls(tree, lang_key: str, nodes: List[Any]) -> List[Tuple[int, str, str]]:
+    """(fragment position, name, kind) for every call of an embedded tree, attributed by byte offset."""
+    starts = [n.start_byte for n in nodes]
+    names = _CallNames()
+    calls = []
+    for node in _query_nodes(tree.root_node, lang_key, "calls", {"call_expression"}):
+        func_node = node.child_by_field_name('function') if node.type == 'call_expression' else node
+        parsed = _classify_js_call(func_node, names)
+        if parsed is None:
+            continue
+        position = bisect.bisect_right(starts, func_node.start_byte) - 1
+        if position >= 0 and func_node.start_byte < nodes[position].end_byte:
+            calls.append((position, parsed[0], parsed[1]))
+    return calls
+
+def _iter_html_embedded(regions: _HtmlRegions, source: bytes, file_path: str):
+    """
+    Yields (lang_key, cache_lang, fragments, tree, cache_status) per batch of embedded code;
+    fragments are (node, handler_name) pairs in document order, handler_name is None for scripts.
+    """
+    for lang_key, scripts in regions.scripts.items():
+        fragments = [(node, None) for node in scripts]
+        if lang_key == "javascript":
+            fragments.extend((node, name) for name, node in regions.handlers)
+        if not fragments:
+            continue
+        if get_parser(lang_key) is None:
+            yield lang_key, "", fragments, None, "unavailable"
+            continue
+        fragments.sort(key=lambda fragment: fragment[0].start_byte)
+        for start in range(0, len(fragments), EMBEDDED_RANGES_PER_PARSE):
+            batch = fragments[start:start + EMBEDDED_RANGES_PER_PARSE]
+            cache_lang = f"{lang_key}@html" + (f"#{start // EMBEDDED_RANGES_PER_PARSE}" if start else "")
+            tree, status = _parse_embedded(lang_key, source, [node for node, _ in batch], file_path, cache_lang)
+            yield lang_key, cache_lang, batch, tree, status
+
+def _local_script_path(page_dir: str, src: str) -> Optional[str]:
+    """Local file for a `src`, or None. Only files under the page directory are read: `../` or a symlink out of it is refused."""
+    src = src.split("#", 1)[0].split("?", 1)[0]
+    if not src or "://" in src or src.startswith(("//", "data:", "blob:")):
+        return None
+    root = os.path.realpath(page_dir)
+    candidate = os.path.realpath(os.path.join(root, src.lstrip("/")))
+    if os.path.commonpath([root, candidate]) != root:
+        return None
+    return candidate if os.path.isfile(candidate) else None
+
+def _extract_html_dependencies(
+    tree,
+    source: bytes,
+    file_path: str = "",
+    ignore_custom: Optional[List[str]] = None,
+    resolve_scripts: bool = False
+) -> Tuple[Set[str], List[str]]:
+    """
+    One report per page: script files (FILE), calls made by event handlers (EVENT) and
+    by inline scripts (CALL). With resolve_scripts, local `src` files are scanned too and
+    their calls merged in as CALL.
+    """
     if not tree: return set(), ["Error: HTML Tree is None"]
-    root_node = tree.root_node
     dependencies = set()
     logs = []
-    
+
     logs.append("Scanning HTML structure...")
+    regions = _collect_html_regions(tree.root_node, source)
+    for src in regions.script_srcs:
+        dependencies.add(f"FILE: {src}")
+        logs.append(f"Found script: {src}")
 
-    def traverse(node):
-        if node.type == 'attribute':
-            attr_name = None
-            attr_value = None
-            
-            for i in range(node.child_count):
-                child = node.child(i)
-                if child.type == 'attribute_name':
-                    attr_name = child.text.decode('utf8')
-                elif child.type == 'quoted_attribute_value' or child.type == 'attribute_value':
-                    attr_value = child.text.decode('utf8').strip('"\'')
-
-            if attr_name and attr_value:
-                if attr_name == 'src':
-                    parent = node.parent
-                    if parent and (parent.type == 'script_start_tag' or parent.type == 'script_element'):
-                        dependencies.add(f"FILE: {attr_value}")
-                        logs.append(f"Found script: {attr_value}")
-                
-                elif attr_name.startswith('on'):
-                    func_name = attr_value.split('(')[0].strip()
-                    if func_name:
-                        dependencies.add(f"EVENT: {func_name}")
-                        logs.append(f"Found event: {attr_name} -> {func_name}")
-
-        for i in range(node.child_count):
-            traverse(node.child(i))
-
-    traverse(root_node)
+    ignore_globals, ignore_methods = _js_ignore_sets(ignore_custom)
+    defined_in: Dict[str, str] = {}
+    events: Set[str] = set()
+    passes: Dict[str, List[Any]] = {}
+    for lang_key, cache_lang, fragments, embedded, status in _iter_html_embedded(regions, source, file_path):
+        if embedded is None:
+            logs.append(f"Inline {lang_key} skipped: {GRAMMAR_ERRORS.get(lang_key, 'grammar unavailable')}")
+            continue
+        handler_calls: Dict[int, List[str]] = {}
+        with METRICS.phase("extract", f"{lang_key}@html"):
+            for position, name, kind in _embedded_calls(embedded, lang_key, [node for node, _ in fragments]):
+                if (kind == "member" and name in ignore_methods) or name in ignore_globals:
+                    continue
+                if fragments[position][1] is not None:
+                    handler_calls.setdefault(position, []).append(name)
+                else:
+                    dependencies.add(f"CALL: {name}")
+            inline_index = _index_cached(embedded, cache_lang, file_path, lambda: _build_js_index(embedded, lang_key))
+        for definition in inline_index.definitions:
+            defined_in.setdefault(definition.name, "inline script")
+
+        for position, (node, handler_name) in enumerate(fragments):
+            if handler_name is None:
+                continue
+            names = handler_calls.get(position)
+            if not names and embedded.root_node.has_error:
+                # Фрагмент не разобрался — как раньше, берем первый токен значения.
+                paren = source.find(b"(", node.start_byte, node.end_byte)
+                first = source[node.start_byte:paren if paren >= 0 else node.end_byte].strip().decode('utf8')
+                names = [first] if first else []
+            for name in names or []:
+                events.add(name)
+                dependencies.add(f"EVENT: {name}")
+            if names:
+                logs.append(f"Found event: {handler_name.decode('utf8')} -> {', '.join(names)}")
+        counts = passes.setdefault(lang_key, [0, 0, 0, set()])
+        scripts = sum(1 for _, handler_name in fragments if handler_name is None)
+        counts[0] += scripts
+        counts[1] += len(fragments) - scripts
+        counts[2] += 1
+        counts[3].add(status)
+    for lang_key, (scripts, handlers, parses, statuses) in passes.items():
+        logs.append(f"Inline {lang_key}: {scripts} script(s), {handlers} handler(s) in {parses} parse(s) ({', '.join(sorted(statuses))})")
+
+    if resolve_scripts and file_path:
+        page_dir = os.path.dirname(os.path.abspath(file_path))
+        for src in regions.script_srcs:
+            local_path = _local_script_path(page_dir, src)
+            lang_key = INDEX_LANGUAGES.get(os.path.splitext(local_path or "")[1].lower())
+            if not local_path or lang_key not in ("javascript", "typescript"):
+                logs.append(f"Not resolved: {src}")
+                continue
+            if get_parser(lang_key) is None:
+                logs.append(f"Not resolved: {src} ({lang_key} grammar unavailable)")
+                continue
+            try:
+                script_source = SOURCE_CACHE.read(local_path)
+            except OSError as e:
+                logs.append(f"Not resolved: {src} ({e})")
+                continue
+            script_tree, status = _parse_cached(get_parser(lang_key), lang_key, script_source, local_path)
+            script_index = _index_cached(script_tree, lang_key, local_path, lambda: _build_js_index(script_tree, lang_key))
+            calls = _filter_js_calls(script_index.all_calls, "", ignore_globals, ignore_methods)
+            dependencies.update(f"CALL: {name}" for name in calls)
+            for definition in script_index.definitions:
+                defined_in.setdefault(definition.name, src)
+            logs.append(f"Resolved script {src}: {len(script_index.definitions)} definitions, {len(calls)} calls (parse: {status})")
+
+    if defined_in:
+        for name in sorted(events):
+            logs.append(f"Handler {name}: {'defined in ' + defined_in[name] if name in defined_in else 'not defined on this page'}")
     return dependencies, logs
 
+# --- ИЗОЛИРОВАННЫЕ ВОРКЕРЫ СКАНИРОВАНИЯ ---
+# Один патологический вход (мегабайт минифицированного JS, глубокая вложенность, огромный
+# шаблон) не должен вешать весь сервер. scan_dependencies выполняется в процессах-воркерах
+# под надзором: превысивший лимит времени или памяти воркер убивается и заменяется,
+# а вызывающий сразу получает отказ. Здоровые воркеры живут дальше вместе со своими кэшами.
+SCAN_SANDBOX_ENABLED = os.environ.get("EDIT_MATH_SCAN_SANDBOX", "1").strip().lower() not in ("0", "false", "off", "no")
+# Минимум два воркера даже на одном CPU: пока один упирается в лимит, второй обслуживает остальных.
+SCAN_WORKERS = int(os.environ.get("EDIT_MATH_SCAN_WORKERS", "0")) or min(4, max(2, os.cpu_count() or 1))
+SCAN_WARM_WORKERS = int(os.environ.get("EDIT_MATH_SCAN_WARM_WORKERS", "2"))
+SCAN_TIMEOUT_SECONDS = float(os.environ.get("EDIT_MATH_SCAN_TIMEOUT", "30"))
+SCAN_MAX_RSS_BYTES = int(float(os.environ.get("EDIT_MATH_SCAN_MAX_RSS_MB", "1024")) * 1024 * 1024)
+SCAN_START_TIMEOUT_SECONDS = 60.0
+SCAN_POLL_SECONDS = 0.02
+SCAN_AFFINITY_KEYS = 64
+
+class ScanTooExpensive(Exception):
+    """A sandboxed scan overran its limits (or crashed its worker) and was stopped."""
+
+    def __init__(self, reason: str, detail: str):
+        super().__init__(detail)
+        self.reason = reason
+
+def _scan_worker_main(conn) -> None:
+    # В stdio-режиме stdout воркера — это канал протокола MCP.
+    sys.stdout = sys.stderr
+    init_parsers()
+    conn.send(("ready", os.getpid()))
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, OSError):
+            return
+        if task is None:
+            return
+        fn, args = task
+        try:
+            reply = (True, fn(*args))
+        except BaseException as e:
+            reply = (False, f"{type(e).__name__}: {e}")
+        conn.send(reply)
+
+def _process_rss_bytes(pid: int) -> int:
+    """Resident set size from /proc; 0 where it is unavailable (the memory limit is then not enforced)."""
+    try:
+        with open(f"/proc/{pid}/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return 0
+
+class _ScanWorker:
+    def __init__(self, context):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_scan_worker_main, args=(child,), name="edit-math-scan", daemon=True)
+        self.process.start()
+        child.close()
+        self.ready = False
+        self.tasks = 0
+        # Файлы, недавно разобранные этим воркером: повторный скан идет туда же,
+        # где дерево уже в кэше и перепарсится инкрементально.
+        self.recent: "OrderedDict[str, None]" = OrderedDict()
+
+    def wait_ready(self) -> None:
+        if self.ready:
+            return
+        try:
+            if not self.conn.poll(SCAN_START_TIMEOUT_SECONDS):
+                raise RuntimeError(f"Scan worker did not start within {SCAN_START_TIMEOUT_SECONDS:.0f}s.")
+            self.conn.recv()
+        except (EOFError, OSError):
+            raise RuntimeError(f"Scan worker exited during startup (exit code {self.process.exitcode}).")
+        self.ready = True
+
+    def remember(self, key: str) -> None:
+        if key:
+            self.recent[key] = None
+            self.recent.move_to_end(key)
+            while len(self.recent) > SCAN_AFFINITY_KEYS:
+                self.recent.popitem(last=False)
+
+    def stop(self) -> None:
+        try:
+            self.process.kill()
+            self.process.join(5)
+        except (OSError, ValueError):
+            pass
+        self.conn.close()
+
+class ScanSupervisor:
+    """Pool of supervised scan processes with a wall-clock and an RSS limit per request."""
+
+    def __init__(self, workers: int, timeout: float, max_rss_bytes: int):
+        self.size = max(1, workers)
+        self.timeout = timeout
+        self.max_rss_bytes = max_rss_bytes
+        self._context = multiprocessing.get_context("spawn")
+        self._cond = threading.Condition()
+        self._idle: List[_ScanWorker] = []
+        self._alive = 0
+        self.kills: Dict[str, int] = {}
+        self.recycled = 0
+        # Хотя бы один воркер успел стартовать (до этого мелкие сканирования идут в процессе сервера).
+        self.warmed = False
+
+    def prewarm(self, count: int) -> None:
+        """Keeps at least `count` workers alive, so scans do not pay the interpreter startup."""
+        with self._cond:
+            count = max(0, min(count, self.size) - self._alive)
+        self._spawn(count)
+
+    def _spawn(self, count: int) -> None:
+        """Starts workers in the background, one after another; each joins the pool once it is ready."""
+        with self._cond:
+            count = max(0, min(count, self.size - self._alive))
+            self._alive += count
+        if count:
+            threading.Thread(target=self._start_workers, args=(count,), name="edit-math-scan-spawn", daemon=True).start()
+
+    def _start_workers(self, count: int) -> None:
+        # По одному: на маленькой машине параллельный импорт воркеров отнимает CPU у самого сервера.
+        for _ in range(count):
+            worker = None
+            try:
+                worker = _ScanWorker(self._context)
+                worker.wait_ready()
+                self.warmed = True
+            except BaseException:
+                if worker is not None:
+                    worker.stop()
+                worker = None
+            with self._cond:
+                if worker is None:
+                    self._alive -= 1
+                else:
+                    self._idle.append(worker)
+                self._cond.notify()
+
+    def _acquire(self, key: str) -> _ScanWorker:
+        with self._cond:
+            while not self._idle and self._alive >= self.size:
+                self._cond.wait()
+            if self._idle:
+                for i in range(len(self._idle) - 1, -1, -1):
+                    if key and key in self._idle[i].recent:
+                        return self._idle.pop(i)
+                return self._idle.pop()
+            self._alive += 1
+        try:
+            return _ScanWorker(self._context)
+        except BaseException:
+            self._release(None)
+            raise
+
+    def _release(self, worker: Optional[_ScanWorker]) -> None:
+        with self._cond:
+            if worker is not None:
+                self._idle.append(worker)
+            else:
+                self._alive -= 1
+            self._cond.notify()
+
+    def _replace(self, worker: _ScanWorker, reason: str) -> None:
+        worker.stop()
+        with self._cond:
+            self._alive -= 1
+        # Замена стартует сразу, чтобы следующий скан получил уже прогретый процесс.
+        self._spawn(1)
+        METRICS.inc("scan_worker_kills_total", reason=reason)
+
+    def run(self, fn: Callable, *args, key: str = "") -> Any:
+        worker = self._acquire(key)
+        try:
+            worker.wait_ready()
+        except BaseException:
+            self._replace(worker, "start")
+            raise
+        self.warmed = True
+        reason, detail = "", ""
+        try:
+            worker.conn.send((fn, args))
+            deadline = time.monotonic() + self.timeout
+            while not worker.conn.poll(SCAN_POLL_SECONDS):
+                if not worker.process.is_alive():
+                    reason, detail = "crash", f"the scan worker died (exit code {worker.process.exitcode})"
+                elif time.monotonic() > deadline:
+                    reason, detail = "timeout", f"the scan ran longer than {self.timeout:g}s"
+                elif self.max_rss_bytes and _process_rss_bytes(worker.process.pid) > self.max_rss_bytes:
+                    reason, detail = "memory", f"the scan worker grew past {self.max_rss_bytes // (1024 * 1024)} MB"
+                if reason:
+                    break
+            if not reason:
+                ok, payload = worker.conn.recv()
+        except (EOFError, OSError):
+            worker.process.join(1)
+            reason, detail = "crash", f"the scan worker died (exit code {worker.process.exitcode})"
+        if reason:
+            with self._cond:
+                self.kills[reason] = self.kills.get(reason, 0) + 1
+            self._replace(worker, reason)
+            raise ScanTooExpensive(reason, detail)
+
+        worker.tasks += 1
+        worker.remember(key)
+        if self.max_rss_bytes and _process_rss_bytes(worker.process.pid) > self.max_rss_bytes:
+            # Скан уложился, но процесс не вернул память: заменяем его заранее.
+            with self._cond:
+                self.recycled += 1
+            self._replace(worker, "recycle")
+        else:
+            self._release(worker)
+        if not ok:
+            raise RuntimeError(f"Scan worker failed: {payload}")
+        return payload
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            stats = {"limit": self.size, "alive": self._alive, "idle": len(self._idle), "recycled": self.recycled}
+            stats.update({f"killed_{reason}": count for reason, count in sorted(self.kills.items())})
+        return stats
+
+SCAN_SANDBOX = ScanSupervisor(SCAN_WORKERS, SCAN_TIMEOUT_SECONDS, SCAN_MAX_RSS_BYTES)
+
+def _sandbox_key(file_path: str) -> str:
+    """Affinity key: requests for one file go to the worker whose caches already hold it."""
+    return os.path.normpath(file_path).lower() if file_path else ""
+
+# --- АСИНХРОННОЕ ИСПОЛНЕНИЕ ИНСТРУМЕНТОВ ---
+# В SSE-режиме один тяжелый разбор не должен блокировать остальных клиентов.
+# Инструменты регистрируются как async-обертки: короткие вызовы идут в пул потоков
+# (полоса "io"), сканирования — в изолированные воркеры (полоса "sandbox"), а при выключенной
+# изоляции большие сканирования — в пул процессов (полоса "heavy"), чтобы не держать GIL.
+# Функции модуля остаются синхронными для прямых вызовов.
+TOOL_MAX_CONCURRENCY = int(os.environ.get("EDIT_MATH_MAX_CONCURRENCY", "8"))
+HEAVY_MAX_CONCURRENCY = int(os.environ.get("EDIT_MATH_HEAVY_CONCURRENCY", "0")) or min(8, os.cpu_count() or 1)
+OFFLOAD_SCAN_BYTES = int(os.environ.get("EDIT_MATH_OFFLOAD_BYTES", str(256 * 1024)))
+
+class _ExecutorLane:
+    """Bounded lane: at most `limit` calls run at once, the rest wait in a FIFO queue."""
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = max(1, limit)
+        self.in_flight = 0
+        self.queued = 0
+        self.peak_queued = 0
+        self.completed = 0
+        self._loop = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.limit)
+        return self._semaphore
+
+    async def run(self, executor, fn: Callable, *args, **kwargs):
+        # Счетчики меняются только в потоке event loop, блокировки не нужны.
+        semaphore = self._get_semaphore()
+        self.queued += 1
+        self.peak_queued = max(self.peak_queued, self.queued)
+        try:
+            await semaphore.acquire()
+        finally:
+            self.queued -= 1
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+            semaphore.release()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queued,
+            "peak_queue_depth": self.peak_queued,
+            "completed": self.completed,
+        }
+
+class ToolExecutor:
+    def __init__(self, io_limit: int, heavy_limit: int):
+        self._threads = ThreadPoolExecutor(max_workers=max(1, io_limit), thread_name_prefix="edit-math")
+        # Потоки полосы sandbox только ждут ответа воркера, сам разбор идет в процессах SCAN_SANDBOX.
+        self._sandbox_threads = ThreadPoolExecutor(max_workers=SCAN_SANDBOX.size, thread_name_prefix="edit-math-sandbox")
+        self.lanes = {
+            "io": _ExecutorLane("io", io_limit),
+            "heavy": _ExecutorLane("heavy", heavy_limit),
+            "sandbox": _ExecutorLane("sandbox", SCAN_SANDBOX.size),
+        }
+
+    async def run(self, lane: str, fn: Callable, *args, **kwargs):
+        if lane == "sandbox":
+            return await self.lanes["sandbox"].run(self._sandbox_threads, SCAN_SANDBOX.run, fn, *args, **kwargs)
+        if lane == "heavy":
+            pool = _get_batch_pool()
+            try:
+                return await self.lanes["heavy"].run(pool, fn, *args, **kwargs)
+            except BrokenProcessPool:
+                # Пул процессов упал — пересоздадим его при следующем вызове, а этот выполним в потоке.
+                _discard_batch_pool(pool)
+        return await self.lanes["io"].run(self._threads, fn, *args, **kwargs)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {name: lane.stats() for name, lane in self.lanes.items()}
+
+TOOL_EXECUTOR = ToolExecutor(TOOL_MAX_CONCURRENCY, HEAVY_MAX_CONCURRENCY)
+
+def _async_tool(offload: Optional[Callable[[Dict[str, Any]], Optional[Tuple[str, Callable, tuple, str]]]] = None):
+    """
+    Registers fn as an async MCP tool that runs on TOOL_EXECUTOR and returns fn unchanged.
+    offload(arguments) runs on the event loop and may return (lane, picklable_fn, args, affinity_key)
+    to run the call in a worker process instead ("heavy" or "sandbox").
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+        tool_name = fn.__name__
+
+        @functools.wraps(fn)
+        async def runner(*args, **kwargs):
+            started = time.perf_counter()
+            lane = "io"
+            try:
+                if offload is not None:
+                    bound = signature.bind(*args, **kwargs)
+                    bound.apply_defaults()
+                    heavy = offload(bound.arguments)
+                    if heavy is not None:
+                        lane, heavy_fn, heavy_args, key = heavy
+                        extra = {"key": key} if lane == "sandbox" else {}
+                        try:
+                            result, drained = await TOOL_EXECUTOR.run(lane, _run_with_metrics, heavy_fn, *heavy_args, **extra)
+                        except ScanTooExpensive as e:
+                            return _scan_too_expensive(bound.arguments, e, started)
+                        if drained:
+                            METRICS.merge(drained)
+                        return result
+                return await TOOL_EXECUTOR.run("io", fn, *args, **kwargs)
+            except Exception:
+                METRICS.inc("tool_errors_total", tool=tool_name)
+                raise
+            finally:
+                METRICS.observe("tool_duration_seconds", time.perf_counter() - started, tool=tool_name, lane=lane)
+
+        mcp.tool()(runner)
+        return fn
+    return decorator
+
+def _run_with_metrics(fn: Callable, *args) -> Tuple[Any, Optional[Dict[str, list]]]:
+    """Runs fn and, inside a worker process, returns the metrics it recorded so the server can merge them."""
+    result = fn(*args)
+    if multiprocessing.parent_process() is None:
+        return result, None
+    return result, METRICS.drain()
+
+def _offload_scan(arguments: Dict[str, Any]) -> Optional[Tuple[str, Callable, tuple, str]]:
+    if _bad_format(arguments["format"]):
+        return None
+    size = len(arguments["code"])
+    if not size and arguments["file_path"]:
+        try:
+            size = os.stat(arguments["file_path"]).st_size
+        except OSError:
+            return None
+    if SCAN_SANDBOX_ENABLED:
+        # Воркеры поднимаются с первым сканированием, а не при старте: импорт в них
+        # не конкурирует за CPU с рукопожатием MCP. Упавшие за это время заменяются.
+        SCAN_SANDBOX.prewarm(SCAN_WARM_WORKERS)
+    if SCAN_SANDBOX_ENABLED and SCAN_SANDBOX.warmed:
+        lane = "sandbox"
+    elif size >= OFFLOAD_SCAN_BYTES:
+        lane = "sandbox" if SCAN_SANDBOX_ENABLED else "heavy"
+    else:
+        # Пока ни один воркер не поднялся, мелкий скан не ждет его старта, а идет в процессе, как раньше.
+        return None
+    # Сброс состояния — в родительском процессе, воркер только анализирует код.
+    _reset_scan_state(get_state_key(arguments["file_path"], arguments["target_function"]))
+    METRICS.inc("state_resets_total")
+    return lane, _scan_code, (arguments["code"], arguments["target_function"], arguments["file_path"],
+                              arguments["language"], arguments["ignore_custom"], arguments["resolve_scripts"],
+                              arguments["format"], arguments["debug"]), _sandbox_key(arguments["file_path"])
+
+def _scan_too_expensive(arguments: Dict[str, Any], error: ScanTooExpensive, started: float) -> str:
+    target = arguments.get("target_function") or "ENTIRE_FILE"
+    if arguments.get("format") == "json":
+        state = APPROVAL_STATE.get(get_state_key(arguments.get("file_path") or "", target), "NONE")
+        return _json_response({"ok": False, "state": state, "error": "scan_too_expensive", "reason": error.reason,
+                               "detail": str(error), "elapsed_ms": _elapsed_ms(started)})
+    where = f" in '{arguments['file_path']}'" if arguments.get("file_path") else ""
+    return f"""
+        ⛔ SCAN TOO EXPENSIVE: Analysis of '{target}'{where} was stopped: {error}.
+        The scan worker was replaced; other clients were not affected.
+        No dependencies were reported and edit access stays revoked.
+        Scan a smaller target, split the file, or raise EDIT_MATH_SCAN_TIMEOUT / EDIT_MATH_SCAN_MAX_RSS_MB.
+        """
+
+def _state_changed(state_key: str, as_json: bool = False, started: float = 0.0) -> str:
+    """Refusal when the approval state changed between reading and writing it (a rescan or another client)."""
+    state = APPROVAL_STATE.get(state_key, "NONE")
+    if as_json:
+        return _json_response({"ok": False, "state": state, "scope": state_key, "error": "state_changed",
+                               "action": "rescan", "elapsed_ms": _elapsed_ms(started)})
+    return (
+        "⛔ ACCESS DENIED.\n"
+        f"The approval state of '{state_key}' changed during this call (now: {state}).\n"
+        "Rescan and repeat the evaluation."
+    )
+
 def _user_confirmed(user_last_message: str) -> bool:
     return user_last_message.strip().lower() == "ok"
 
-@mcp.tool()
+# --- КОМПАКТНЫЙ ОТВЕТ (format="json") ---
+# Текстовый ответ рассчитан на чтение моделью: баннеры, SUGGESTED INDEX, отладочные логи.
+# format="json" отдает только данные одной строкой без отступов; логи — лишь при debug=true.
+# Общие поля: ok, state (состояние одобрения после вызова), elapsed_ms и error при отказе.
+RESPONSE_FORMATS = ("text", "json")
+
+def _json_response(payload: Dict[str, Any]) -> str:
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+
+def _elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 3)
+
+def _bad_format(response_format: str) -> Optional[str]:
+    if response_format in RESPONSE_FORMATS:
+        return None
+    return f"❌ ERROR: Unknown format '{response_format}'. Use one of: {', '.join(RESPONSE_FORMATS)}."
+
+def _scan_json(started: float, fields: Dict[str, Any], logs: List[str], debug: bool) -> str:
+    payload = {"ok": True, "state": "NONE"}
+    payload.update(fields)
+    payload["elapsed_ms"] = _elapsed_ms(started)
+    if debug:
+        payload["logs"] = logs
+    return _json_response(payload)
+
+def _scan_error(message: str, as_json: bool) -> str:
+    if not as_json:
+        return message
+    return _json_response({"ok": False, "state": "NONE", "error": message.replace("❌ ERROR: ", "", 1)})
+
+# --- ОПРЕДЕЛЕНИЕ ЯЗЫКА (language="auto") ---
+# Сначала дешевые признаки: расширение, shebang, modeline/прагмы и токены в первых
+# DETECT_SNIFF_BYTES байтах. Разбор нужен только для выбора между JS и TS без расширения:
+# JS разбирается первым и при чистом дереве TS уже не нужен; оба дерева строятся лишь
+# в действительно неоднозначном случае. Разобранное дерево идет дальше в извлечение.
+# Решение кэшируется по пути и сверяется с хэшем содержимого.
+DETECT_SNIFF_BYTES = 4096
+DETECTION_CACHE_MAX = 4096
+DETECT_EXTENSIONS = {".pyi": "python", ".pyw": "python", ".xhtml": "html", ".es6": "javascript"}
+DETECT_INTERPRETERS = {
+    "python": "python", "pypy": "python",
+    "node": "javascript", "nodejs": "javascript", "bun": "javascript",
+    "ts-node": "typescript", "tsx": "typescript",
+    # Deno исполняет и JS, и TS — выбор оставляем разбору.
+    "deno": "js",
+}
+DETECT_MODES = {"python": "python", "js": "javascript", "javascript": "javascript", "typescript": "typescript", "html": "html"}
+
+_SHEBANG = re.compile(rb"#![ \t]*\S*?(?:/env(?:[ \t]+-S)?[ \t]+)?(?:\S*/)?([A-Za-z][\w-]*?)[\d.]*(?:[ \t]|$)", re.M)
+_MODELINE = re.compile(rb"-\*-.*?\bmode:[ \t]*([\w-]+)|\b(?:vim?|ex):.*?\b(?:ft|filetype)=(\w+)", re.I)
+_CODING_COOKIE = re.compile(rb"^[ \t\f]*#.*?coding[:=]", re.M)
+_HTML_SNIFF = re.compile(rb"\A(?:\xef\xbb\xbf)?\s*(?:<!--.*?-->\s*)*<(?:!doctype\s+html|html|head|body)\b", re.I | re.S)
+_JS_PRAGMA = re.compile(rb"\A\s*(?://[ \t]*@ts-(?:check|nocheck)|/\*\*?\s*@jsx|(['\"])use strict\1)")
+_PY_SIGNALS = re.compile(
+    rb"^[ \t]*(?:(?:async[ \t]+)?def[ \t]+\w+[ \t]*\(.*\)[ \t]*(?:->.*)?:|class[ \t]+\w+[ \t]*(?:\(.*\))?[ \t]*:"
+    rb"|from[ \t]+[\w.]+[ \t]+import[ \t]|import[ \t]+[\w.]+(?:[ \t]+as[ \t]+\w+)?(?:[ \t]*,[ \t]*[\w.]+)*[ \t]*$"
+    rb"|elif[ \t].*:|except\b.*:|if[ \t]+__name__[ \t]*==)",
+    re.M,
+)
+_JS_SIGNALS = re.compile(
+    rb"(?:^|[;{}(\s])(?:function[\s*(]|(?:const|let|var)[ \t]+[\w$\[{]|export[ \t]+(?:default|const|function|class|interface|type)\b"
+    rb"|import[ \t].*?\bfrom[ \t]*['\"]|require\(|module\.exports|=>)|;[ \t]*$",
+    re.M,
+)
+# Прежний признак Python для кода без других сигналов.
+_PY_KEYWORDS = re.compile(rb"def |import |class ")
+
+_DETECTIONS: "OrderedDict[str, Tuple[str, str, str]]" = OrderedDict()
+_DETECTIONS_LOCK = threading.Lock()
+
+def _cheap_language(code_bytes: bytes, file_path: str) -> Tuple[Optional[str], str]:
+    """
+    Language from the path and the first DETECT_SNIFF_BYTES, without parsing: (language, method).
+    "js" means JavaScript or TypeScript, left to the parser; None means no usable signal.
+    """
+    extension = os.path.splitext(file_path)[1].lower() if file_path else ""
+    language = INDEX_LANGUAGES.get(extension) or DETECT_EXTENSIONS.get(extension)
+    if language:
+        return language, "extension"
+    prefix = code_bytes[:DETECT_SNIFF_BYTES]
+    if prefix.startswith(b"#!"):
+        match = _SHEBANG.match(prefix)
+        language = DETECT_INTERPRETERS.get(match.group(1).decode("ascii").lower()) if match else None
+        if language:
+            return language, "shebang"
+    head = b"\n".join(prefix.split(b"\n", 2)[:2])
+    match = _MODELINE.search(head)
+    if match:
+        language = DETECT_MODES.get((match.group(1) or match.group(2)).decode("ascii").lower())
+        if language:
+            return language, "pragma"
+    if _CODING_COOKIE.match(head):
+        return "python", "pragma"
+    if _HTML_SNIFF.match(prefix):
+        return "html", "sniff"
+    if _JS_PRAGMA.match(prefix):
+        return "js", "pragma"
+    python_signals = len(_PY_SIGNALS.findall(prefix))
+    js_signals = len(_JS_SIGNALS.findall(prefix))
+    if python_signals and not js_signals:
+        return "python", "sniff"
+    if js_signals and not python_signals:
+        return "js", "sniff"
+    return None, "sniff"
+
+def _probe_parse(lang_key: str, code_bytes: bytes, file_path: str, parsed: Dict[str, Any]) -> Optional[bool]:
+    """Parses for detection and keeps the tree in `parsed` for extraction. True if it has errors; None without a grammar."""
+    parser = get_parser(lang_key)
+    if parser is None:
+        return None
+    with METRICS.phase("auto_probe", lang_key):
+        parsed[lang_key] = _parse_cached(parser, lang_key, code_bytes, file_path)
+        return has_syntax_errors(parsed[lang_key][0])
+
+def _detect_language(code_bytes: bytes, file_path: str, digest: str, parsed: Dict[str, Any]) -> Tuple[str, str]:
+    """
+    (language, method) for language="auto". language is "python", "html", "javascript",
+    "typescript" or "ambiguous" (JS fails, TS parses: the user must choose). Trees and the
+    Python index built on the way are left in `parsed`, keyed by language.
+    """
+    key = os.path.normpath(file_path).lower() if file_path else ""
+    if key:
+        with _DETECTIONS_LOCK:
+            cached = _DETECTIONS.get(key)
+            if cached is not None and cached[0] == digest:
+                _DETECTIONS.move_to_end(key)
+                METRICS.inc("language_detection_total", method="cache")
+                return cached[1], cached[2]
+
+    language, method = _cheap_language(code_bytes, file_path)
+    if language == "javascript" and method != "sniff":
+        # JS по расширению, но с ошибками разбора: если это валидный TS, спрашиваем, как и раньше.
+        if _probe_parse("javascript", code_bytes, file_path, parsed) and _probe_parse("typescript", code_bytes, file_path, parsed) is False:
+            language = "ambiguous"
+    elif language in ("js", None) or (language == "python" and method == "sniff"):
+        if language == "python" or (language is None and _PY_KEYWORDS.search(code_bytes)):
+            try:
+                with METRICS.phase("auto_probe", "python"):
+                    parsed["python"] = _parse_python_index(code_bytes, file_path, tolerant=False)
+                language = "python"
+            except Exception:
+                language = None
+        if language != "python":
+            if language is None:
+                method = "parse"
+            js_errors = _probe_parse("javascript", code_bytes, file_path, parsed)
+            if not js_errors:
+                language = "javascript"
+            else:
+                ts_errors = _probe_parse("typescript", code_bytes, file_path, parsed)
+                if ts_errors is False:
+                    language = "ambiguous"
+                else:
+                    language, method = "typescript", "fallback"
+
+    METRICS.inc("language_detection_total", method=method)
+    if key:
+        with _DETECTIONS_LOCK:
+            _DETECTIONS[key] = (digest, language, method)
+            _DETECTIONS.move_to_end(key)
+            while len(_DETECTIONS) > DETECTION_CACHE_MAX:
+                _DETECTIONS.popitem(last=False)
+    return language, method
+
+
+@_async_tool(offload=_offload_scan)
 def scan_dependencies(
-    code: str, 
+    code: str = "", 
     target_function: str = "ENTIRE_FILE",
     file_path: str = "",  # <--- НОВЫЙ АРГУМЕНТ
     language: str = "auto", 
-    ignore_custom: Union[List[str], str, None] = None
+    ignore_custom: Union[List[str], str, None] = None,
+    resolve_scripts: bool = False,
+    format: str = "text",
+    debug: bool = False
 ) -> str:
     """
     Scans code for dependencies.
     Args:
+        code: Source to scan. Leave empty to let the server read `file_path` from disk (preferred for large files).
         file_path: Path to the file being scanned (required for security scoping).
+        resolve_scripts: HTML only. Also scan local `<script src>` files under the page's directory and merge their calls.
+        format: "text" (default) or "json": one compact object with dependencies, base_hash, state, cache and timing.
+        debug: JSON only. Include the analysis logs.
     """
+    # СБРОС СОСТОЯНИЯ ДЛЯ КОНКРЕТНОГО ФАЙЛА
+    _reset_scan_state(get_state_key(file_path, target_function))
+    METRICS.inc("state_resets_total")
+    return _bad_format(format) or _scan_code(code, target_function, file_path, language, ignore_custom, resolve_scripts, format, debug)
+
+def _scan_code(
+    code: Union[str, bytes],
+    target_function: str = "ENTIRE_FILE",
+    file_path: str = "",
+    language: str = "auto",
+    ignore_custom: Union[List[str], str, None] = None,
+    resolve_scripts: bool = False,
+    response_format: str = "text",
+    debug: bool = False
+) -> str:
+    """Dependency analysis without touching APPROVAL_STATE, so it can also run in worker processes."""
+    started = time.perf_counter()
+    as_json = response_format == "json"
     try:
-        if parser_js is None: return "CRITICAL ERROR: Tree-sitter parsers failed to initialize."
-        
-        # СБРОС СОСТОЯНИЯ ДЛЯ КОНКРЕТНОГО ФАЙЛА
-        state_key = get_state_key(file_path, target_function)
-        APPROVAL_STATE[state_key] = "NONE"
-        
         normalized_ignore = []
         if isinstance(ignore_custom, list):
             normalized_ignore = ignore_custom
@@ -315,16 +2189,71 @@ def scan_dependencies(
             normalized_ignore = [ignore_custom]
         
         lang_lower = language.lower()
+        if code:
+            code_bytes = code if isinstance(code, bytes) else bytes(code, "utf8")
+        elif file_path:
+            try:
+                with METRICS.phase("read"):
+                    code_bytes = SOURCE_CACHE.read(file_path)
+            except OSError as e:
+                return _scan_error(f"❌ ERROR: Cannot read '{file_path}': {e}", as_json)
+        else:
+            return _scan_error("❌ ERROR: Provide `code` or a `file_path` the server can read.", as_json)
+        with METRICS.phase("hash"):
+            base_hash = _file_hash(code_bytes)
+        detection = "auto" if lang_lower == "auto" else "explicit"
+        parsed: Dict[str, Any] = {}
+        method = ""
+        if lang_lower == "auto":
+            with METRICS.phase("detect"):
+                lang_lower, method = _detect_language(code_bytes, file_path, base_hash, parsed)
+            if lang_lower == "ambiguous":
+                METRICS.inc("language_detected_total", language="ambiguous", detection=detection)
+                if as_json:
+                    return _json_response({"ok": False, "state": "NONE", "error": "ambiguous_language",
+                                           "ask_user": "Is this JavaScript or TypeScript?"})
+                return """
+                🛑 AMBIGUITY DETECTED
+                ---------------------
+                The code looks like TypeScript. Please ASK THE USER: "Is this JavaScript or TypeScript?"
+                """
+        auto_prefix = "Auto-Detected " if detection == "auto" else ""
+        detect_logs = [f"Language detected by {method}."] if method else []
         
         # --- PYTHON ---
         if lang_lower == "python" or lang_lower == "py":
-            deps, logs = _extract_python_dependencies(code, target_function, normalized_ignore)
+            try:
+                py_tree, py_index, cache_status, _ = parsed.get("python") or _parse_python_index(code_bytes, file_path)
+                partial_logs = _python_partial_log(py_tree)
+            except (SyntaxError, ValueError) as e:
+                py_index, cache_status, partial_logs = None, "miss", [f"Python Syntax Error: {e}"]
+            METRICS.inc("language_detected_total", language="python", detection=detection)
+            partial_logs[:0] = detect_logs
+            if target_function == ALL_TARGETS and py_index:
+                entries = _python_all_targets(py_index, normalized_ignore)
+                if as_json:
+                    return _scan_json(started, {"target": ALL_TARGETS, "language": "python", "detected_by": method or None,
+                                                "target_fields": ALL_TARGETS_FIELDS, "targets": _all_targets_json(entries), "base_hash": base_hash,
+                                                "cache": {"parse": cache_status}}, partial_logs, debug)
+                return _format_all_targets(auto_prefix + "Python", entries, base_hash, [_parse_cache_summary(cache_status)] + partial_logs)
+            if py_index is None:
+                deps, logs = set(), partial_logs
+            else:
+                with METRICS.phase("extract", "python"):
+                    deps, logs = _extract_python_dependencies(code_bytes, target_function, normalized_ignore, index=py_index)
+                logs[:0] = partial_logs
             sorted_deps = sorted(list(deps))
+            if as_json:
+                return _scan_json(started, {"target": target_function, "language": "python", "detected_by": method or None,
+                                            "dependencies": sorted_deps, "base_hash": base_hash,
+                                            "cache": {"parse": cache_status}}, logs, debug)
+            logs.insert(0, _parse_cache_summary(cache_status))
             return f"""
-            [ACCESS REVOKED] Python Analysis for '{target_function}':
+            [ACCESS REVOKED] {auto_prefix}Python Analysis for '{target_function}':
             --------------------------------
             Found Dependencies: {', '.join(sorted_deps) if sorted_deps else 'None'}
             SUGGESTED INDEX: {target_function + ("_" + "_".join(sorted_deps) if sorted_deps else "")}
+            BASE HASH: {base_hash}
             
             DEBUG INFO:
             {chr(10).join(logs[:15])}
@@ -332,76 +2261,85 @@ def scan_dependencies(
 
         # --- HTML ---
         if lang_lower == "html":
-            if not parser_html: return "Error: HTML parser not initialized."
-            tree = parser_html.parse(bytes(code, "utf8"))
-            deps, logs = _extract_html_dependencies(tree)
+            parser_html = get_parser("html")
+            if parser_html is None: return _scan_error(_grammar_unavailable("html"), as_json)
+            tree, cache_status = _parse_cached(parser_html, "html", code_bytes, file_path)
+            METRICS.inc("language_detected_total", language="html", detection=detection)
+            with METRICS.phase("extract", "html"):
+                deps, logs = _extract_html_dependencies(tree, code_bytes, file_path, normalized_ignore, resolve_scripts)
             sorted_deps = sorted(list(deps))
+            if as_json:
+                return _scan_json(started, {"target": target_function, "language": "html", "detected_by": method or None,
+                                            "dependencies": sorted_deps, "base_hash": base_hash,
+                                            "cache": {"parse": cache_status}}, detect_logs + logs, debug)
+            logs.append(_parse_cache_summary(cache_status))
+            logs[:0] = detect_logs
             return f"""
-            [ACCESS REVOKED] HTML Analysis for '{target_function}':
+            [ACCESS REVOKED] {auto_prefix}HTML Analysis for '{target_function}':
             --------------------------------
             Found Dependencies: {', '.join(sorted_deps) if sorted_deps else 'None'}
+            BASE HASH: {base_hash}
             DEBUG INFO:
             {chr(10).join(logs)}
             """
 
         # --- JS / TS ---
-        selected_parser = parser_js
+        selected_lang = "javascript"
         logs_prefix = "JavaScript"
 
-        if lang_lower == "auto":
-            if "def " in code or "import " in code or "class " in code:
-                 try:
-                     ast.parse(code)
-                     deps, logs = _extract_python_dependencies(code, target_function, normalized_ignore)
-                     sorted_deps = sorted(list(deps))
-                     return f"""
-                     [ACCESS REVOKED] Auto-Detected Python Analysis for '{target_function}':
-                     --------------------------------
-                     Found Dependencies: {', '.join(sorted_deps) if sorted_deps else 'None'}
-                     SUGGESTED INDEX: {target_function + ("_" + "_".join(sorted_deps) if sorted_deps else "")}
-                     """
-                 except:
-                     pass
-
-            tree_js = parser_js.parse(bytes(code, "utf8"))
-            js_errors = has_syntax_errors(tree_js)
-            tree_ts = parser_ts.parse(bytes(code, "utf8"))
-            ts_errors = has_syntax_errors(tree_ts)
-            
-            if js_errors and not ts_errors:
-                return """
-                🛑 AMBIGUITY DETECTED
-                ---------------------
-                The code looks like TypeScript. Please ASK THE USER: "Is this JavaScript or TypeScript?"
-                """
-            elif not js_errors:
-                selected_parser = parser_js
+        if detection == "auto":
+            selected_lang = lang_lower
+            if selected_lang == "javascript":
                 logs_prefix = "Auto-Detected JS"
-            else:
-                selected_parser = parser_ts
+            elif method == "fallback":
                 logs_prefix = "Auto-Detected TS (Fallback)"
-                
+            else:
+                logs_prefix = "Auto-Detected TS"
         elif lang_lower in ["ts", "typescript", "tsx"]:
-            selected_parser = parser_ts
+            selected_lang = "typescript"
             logs_prefix = "TypeScript"
-        elif lang_lower == "python":
-            return "Python support via AST module is available in v4.3 if needed."
 
-        tree_raw = selected_parser.parse(bytes(code, "utf8"))
-        deps, logs = _extract_dependencies_from_tree(tree_raw, target_function, normalized_ignore)
+        # Парсер нужен и Auto-Wrapper, даже если дерево уже построено при определении языка.
+        selected_parser = get_parser(selected_lang)
+        if selected_parser is None:
+            return _scan_error(_grammar_unavailable(selected_lang), as_json)
+        if selected_lang in parsed:
+            # Дерево уже построено при определении языка — повторно не разбираем.
+            tree_raw, cache_status = parsed[selected_lang]
+        else:
+            tree_raw, cache_status = _parse_cached(selected_parser, selected_lang, code_bytes, file_path)
+        js_index = _index_cached(tree_raw, selected_lang, file_path, lambda: _build_js_index(tree_raw, selected_lang))
+        METRICS.inc("language_detected_total", language=selected_lang, detection=detection)
+        if target_function == ALL_TARGETS:
+            entries = _js_all_targets(js_index, normalized_ignore)
+            if as_json:
+                return _scan_json(started, {"target": ALL_TARGETS, "language": selected_lang, "detected_by": method or None,
+                                            "target_fields": ALL_TARGETS_FIELDS, "targets": _all_targets_json(entries), "base_hash": base_hash,
+                                            "cache": {"parse": cache_status}}, detect_logs, debug)
+            return _format_all_targets(logs_prefix, entries, base_hash, [_parse_cache_summary(cache_status)] + detect_logs)
+        with METRICS.phase("extract", selected_lang):
+            deps, logs = _extract_dependencies_from_tree(tree_raw, target_function, normalized_ignore, selected_lang, index=js_index)
+        logs[:0] = [_parse_cache_summary(cache_status)] + detect_logs
         
         used_wrapper = False
         if not deps and target_function != "ENTIRE_FILE":
             logs.append("--- Attempting Auto-Wrapper ---")
-            wrapped_code = f"class AutoWrapper {{ {code} }}"
-            tree_wrapped = selected_parser.parse(bytes(wrapped_code, "utf8"))
-            deps_wrapped, logs_wrapped = _extract_dependencies_from_tree(tree_wrapped, target_function, normalized_ignore)
+            with METRICS.phase("wrapper", selected_lang):
+                wrapped_code = b"class AutoWrapper { " + code_bytes + b" }"
+                tree_wrapped = _ts_parse(selected_parser, wrapped_code)
+                deps_wrapped, logs_wrapped = _extract_dependencies_from_tree(tree_wrapped, target_function, normalized_ignore, selected_lang)
+            METRICS.inc("parsed_bytes_total", len(wrapped_code), language=selected_lang)
             if deps_wrapped:
                 deps = deps_wrapped
                 logs.extend(logs_wrapped)
                 used_wrapper = True
+            METRICS.inc("wrapper_fallbacks_total", language=selected_lang, result="used" if used_wrapper else "empty")
 
         sorted_deps = sorted(list(deps))
+        if as_json:
+            return _scan_json(started, {"target": target_function, "language": selected_lang, "detected_by": method or None,
+                                        "dependencies": sorted_deps, "base_hash": base_hash, "wrapper": used_wrapper,
+                                        "cache": {"parse": cache_status}}, logs, debug)
         index_str = target_function + ("_" + "_".join(sorted_deps) if sorted_deps else "")
         
         debug_output = "\n    ".join(logs[:15])
@@ -411,6 +2349,7 @@ def scan_dependencies(
         --------------------------------
         Found Dependencies: {', '.join(sorted_deps) if sorted_deps else 'None'}
         SUGGESTED INDEX: {index_str}
+        BASE HASH: {base_hash}
         
         DEBUG INFO:
         Wrapper Used: {used_wrapper}
@@ -419,9 +2358,157 @@ def scan_dependencies(
         ...
         """
     except Exception as e:
+        if as_json:
+            payload = {"ok": False, "state": "NONE", "error": f"Internal server error during scanning: {e}"}
+            if debug:
+                payload["traceback"] = traceback.format_exc()
+            return _json_response(payload)
         return f"INTERNAL SERVER ERROR during scanning: {str(e)}\nTraceback: {traceback.format_exc()}"
 
-@mcp.tool()
+# --- ПАКЕТНОЕ СКАНИРОВАНИЕ (ПУЛ ПРОЦЕССОВ) ---
+# Рефакторинг на десятки функций не должен стоить десятков последовательных вызовов.
+# Воркеры поднимаются через spawn (сервер многопоточный, fork небезопасен)
+# и инициализируют парсеры один раз при старте. Пул один на процесс и фиксированного
+# размера: его делят пакеты и полоса heavy, поэтому вызов ограничивает только свои задачи.
+BATCH_MAX_WORKERS = int(os.environ.get("EDIT_MATH_BATCH_WORKERS", "0")) or min(8, os.cpu_count() or 1)
+
+_BATCH_POOL: Optional[ProcessPoolExecutor] = None
+_BATCH_POOL_LOCK = threading.Lock()
+
+def _init_batch_worker() -> None:
+    init_parsers()
+
+def _get_batch_pool() -> ProcessPoolExecutor:
+    global _BATCH_POOL
+    with _BATCH_POOL_LOCK:
+        if _BATCH_POOL is None:
+            _BATCH_POOL = ProcessPoolExecutor(
+                max_workers=BATCH_MAX_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_batch_worker,
+            )
+        return _BATCH_POOL
+
+def _discard_batch_pool(pool: ProcessPoolExecutor) -> None:
+    """Forgets a broken pool. Only the caller that saw it break does this, and no one's futures are cancelled."""
+    global _BATCH_POOL
+    with _BATCH_POOL_LOCK:
+        if _BATCH_POOL is pool:
+            _BATCH_POOL = None
+    pool.shutdown(wait=False)
+
+def _map_limited(pool: ProcessPoolExecutor, fn: Callable, items: List[Any], limit: int) -> List[Any]:
+    """Like pool.map, in order, but with at most `limit` of these items submitted at once."""
+    futures: List[Future] = []
+    in_flight: Set[Future] = set()
+    try:
+        for item in items:
+            if len(in_flight) >= limit:
+                _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            future = pool.submit(fn, item)
+            futures.append(future)
+            in_flight.add(future)
+        return [future.result() for future in futures]
+    finally:
+        # Отменяются только собственные задачи этого вызова (после ошибки).
+        for future in futures:
+            future.cancel()
+
+def _scan_batch_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Runs one batch entry; reads the file from disk when no code is supplied."""
+    file_path = item.get("file_path") or ""
+    target_function = item.get("target_function") or "ENTIRE_FILE"
+    result = {
+        "file_path": file_path,
+        "target_function": target_function,
+        "state_key": get_state_key(file_path, target_function),
+    }
+    code = item.get("code")
+    if not code:
+        if not file_path:
+            result["error"] = "Either 'code' or 'file_path' is required."
+            return result
+        try:
+            code = SOURCE_CACHE.read(file_path)
+        except OSError as e:
+            result["error"] = f"Cannot read file: {e}"
+            return result
+    result["result"] = _scan_code(code, target_function, file_path, item.get("language") or "auto", item.get("ignore_custom"),
+                                  bool(item.get("resolve_scripts")))
+    return result
+
+@_async_tool()
+def scan_dependencies_batch(
+    items: List[Dict[str, Any]],
+    max_workers: int = 0
+) -> List[Dict[str, Any]]:
+    """
+    Scans many targets in one call, fanned out across a process pool.
+    Args:
+        items: Entries with `file_path`, `target_function` and optionally `code`, `language`, `ignore_custom`,
+               `resolve_scripts`.
+               When `code` is omitted the server reads `file_path` from disk.
+        max_workers: Most items of this call scanned at once. The process pool is shared and keeps its size
+                     (EDIT_MATH_BATCH_WORKERS or min(8, CPU count)), which also caps this value.
+    Returns one result per item, in input order.
+    """
+    # СБРОС СОСТОЯНИЯ для каждого отсканированного ключа, как в scan_dependencies
+    for item in items:
+        _reset_scan_state(get_state_key(item.get("file_path") or "", item.get("target_function") or "ENTIRE_FILE"))
+    METRICS.inc("state_resets_total", len(items))
+
+    workers = max(1, min(max_workers or BATCH_MAX_WORKERS, BATCH_MAX_WORKERS, len(items)))
+    if workers == 1:
+        return [_scan_batch_item(item) for item in items]
+
+    pool = _get_batch_pool()
+    try:
+        results = []
+        for result, drained in _map_limited(pool, functools.partial(_run_with_metrics, _scan_batch_item), items, workers):
+            if drained:
+                METRICS.merge(drained)
+            results.append(result)
+        return results
+    except (BrokenProcessPool, CancelledError) as e:
+        if isinstance(e, BrokenProcessPool):
+            _discard_batch_pool(pool)
+        return [
+            {
+                "file_path": item.get("file_path") or "",
+                "target_function": item.get("target_function") or "ENTIRE_FILE",
+                "state_key": get_state_key(item.get("file_path") or "", item.get("target_function") or "ENTIRE_FILE"),
+                "error": f"Worker pool failed: {e or type(e).__name__}",
+            }
+            for item in items
+        ]
+
+INTEGRITY_PASS_SCORE = 0.99
+
+def _confirmation_reasons(target_function: str, dependencies: List[str], proposed_header: str, breaking_change_description: str) -> List[str]:
+    """Why an edit needs the user's confirmation; empty when it is safe as is."""
+    reasons = []
+    if dependencies:
+        reasons.append(f"Dependencies: {len(dependencies)}")
+    if breaking_change_description:
+        reasons.append("Breaking change declared")
+    if proposed_header and target_function not in proposed_header and target_function != "ENTIRE_FILE":
+        reasons.append("Renaming detected")
+    return reasons
+
+def _integrity_score(dependencies: List[str], verified_dependencies: List[str]) -> Tuple[float, List[str]]:
+    """Half the score for the confirmation itself, the other half shared by the verified dependencies: (score, missing)."""
+    BASE_WEIGHT = 0.5
+    REMAINING_WEIGHT = 0.5
+    if not dependencies:
+        return 1.0, []
+    weight_per_dep = REMAINING_WEIGHT / len(dependencies)
+    current_score = BASE_WEIGHT
+    for dep in dependencies:
+        if dep in verified_dependencies:
+            current_score += weight_per_dep
+    return current_score, [d for d in dependencies if d not in verified_dependencies]
+
+@_async_tool()
 def calculate_integrity_score(
     target_function: str,
     dependencies: List[str],
@@ -429,26 +2516,25 @@ def calculate_integrity_score(
     file_path: str = "",
     proposed_header: str = "",
     breaking_change_description: str = "",
-    user_last_message: str = ""   # ← ВАЖНО
+    user_last_message: str = "",   # ← ВАЖНО
+    format: str = "text"
 ) -> str:
     """
     Calculates Integrity Score.
     Uses State Machine + Scoped Security (file-bound).
+    format: "text" (default) or "json": one compact object with ok, state, score and what is missing.
     """
+    started = time.perf_counter()
+    if _bad_format(format):
+        return _bad_format(format)
+    as_json = format == "json"
 
     deps_safe = dependencies or []
     verified_safe = verified_dependencies or []
 
-    # 1. Auto-detect renaming
-    is_renaming = False
-    if proposed_header:
-        if target_function not in proposed_header and target_function != "ENTIRE_FILE":
-            is_renaming = True
-
-    # 2. Do we need confirmation?
-    needs_confirmation = bool(
-        deps_safe or breaking_change_description or is_renaming
-    )
+    # 1-2. Auto-detect renaming; do we need confirmation?
+    reasons = _confirmation_reasons(target_function, deps_safe, proposed_header, breaking_change_description)
+    needs_confirmation = bool(reasons)
 
     # 3. State machine (scoped)
     state_key = get_state_key(file_path, target_function)
@@ -456,16 +2542,16 @@ def calculate_integrity_score(
 
     # --- STEP 1: enter strict mode ---
     if needs_confirmation and current_state == "NONE":
-        APPROVAL_STATE[state_key] = "PENDING"
-
-        reasons = []
-        if deps_safe:
-            reasons.append(f"Dependencies: {len(deps_safe)}")
-        if breaking_change_description:
-            reasons.append("Breaking change declared")
-        if is_renaming:
-            reasons.append("Renaming detected")
+        if not _grant(state_key, "NONE", "PENDING"):
+            return _state_changed(state_key, as_json, started)
 
+        if as_json:
+            return _json_response({
+                "ok": False, "state": "PENDING", "scope": state_key, "reasons": reasons, "action": "ask_user",
+                "instruction": "Stop. Explain the plan to the user, ask them to type 'ok', then call again "
+                               "with their full last message as user_last_message.",
+                "elapsed_ms": _elapsed_ms(started),
+            })
         return f"""
 ✋ STRICT MODE INTERVENTION (Step 1/2)
 -------------------------------------
@@ -486,6 +2572,10 @@ INSTRUCTION FOR AI:
     # --- STEP 2: waiting for confirmation ---
     if current_state == "PENDING":
         if not _user_confirmed(user_last_message):
+            if as_json:
+                return _json_response({"ok": False, "state": "PENDING", "scope": state_key, "action": "ask_user",
+                                       "error": "The last user message is not exactly 'ok'.",
+                                       "elapsed_ms": _elapsed_ms(started)})
             return (
                 "⛔ ACCESS DENIED.\n"
                 "Waiting for explicit user confirmation.\n"
@@ -493,31 +2583,30 @@ INSTRUCTION FOR AI:
             )
 
     # 4. Score calculation
-    if not deps_safe and not is_renaming and not breaking_change_description:
-        APPROVAL_STATE[state_key] = "APPROVED"
+    if not needs_confirmation:
+        if not _grant(state_key, current_state, "APPROVED"):
+            return _state_changed(state_key, as_json, started)
+        if as_json:
+            return _json_response({"ok": True, "state": "APPROVED", "scope": state_key, "score": 1.0,
+                                   "elapsed_ms": _elapsed_ms(started)})
         return f"Score: 1.0 (Safe). Edit to '{target_function}' is allowed."
 
-    BASE_WEIGHT = 0.5
-    REMAINING_WEIGHT = 0.5
-    count_deps = len(deps_safe)
+    current_score, missing = _integrity_score(deps_safe, verified_safe)
 
-    if count_deps == 0:
-        current_score = 1.0
-    else:
-        weight_per_dep = REMAINING_WEIGHT / count_deps
-        current_score = BASE_WEIGHT
-        for dep in deps_safe:
-            if dep in verified_safe:
-                current_score += weight_per_dep
-
-    if current_score >= 0.99:
-        APPROVAL_STATE[state_key] = "APPROVED"
+    if current_score >= INTEGRITY_PASS_SCORE:
+        if not _grant(state_key, current_state, "APPROVED"):
+            return _state_changed(state_key, as_json, started)
+        if as_json:
+            return _json_response({"ok": True, "state": "APPROVED", "scope": state_key, "score": round(current_score, 4),
+                                   "confirmed": True, "elapsed_ms": _elapsed_ms(started)})
         return (
             f"Integrity Score: {current_score:.4f} / 1.0\n"
             "STATUS: ✅ ACCESS GRANTED (User Confirmed)"
         )
 
-    missing = [d for d in deps_safe if d not in verified_safe]
+    if as_json:
+        return _json_response({"ok": False, "state": current_state, "scope": state_key, "score": round(current_score, 4),
+                               "missing": missing, "elapsed_ms": _elapsed_ms(started)})
     return (
         f"Integrity Score: {current_score:.4f} / 1.0\n"
         "STATUS: ⛔ ACCESS DENIED\n"
@@ -525,29 +2614,1519 @@ INSTRUCTION FOR AI:
     )
 
 
-@mcp.tool()
-def commit_safe_edit(target_function: str, file_path: str, full_file_content: str, force_override: bool = False) -> str:
+# --- ЗАПИСЬ ФАЙЛОВ (ПАТЧИ И АТОМАРНОСТЬ) ---
+class PatchError(ValueError):
+    """Raised when a diff or range replacement does not apply to the file on disk."""
+
+def _file_hash(data: bytes) -> str:
+    """SHA-256 of file content, reported by scans as BASE HASH and checked by commits."""
+    return hashlib.sha256(data).hexdigest()
+
+def _stage_file(path: str, data: bytes) -> str:
+    """Writes data to a synced temp file next to path (same filesystem, so a rename publishes it) and returns its path."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+    except BaseException:
+        _discard_staged(tmp_path)
+        raise
+    return tmp_path
+
+def _discard_staged(tmp_path: str) -> None:
+    try:
+        os.unlink(tmp_path)
+    except OSError:
+        pass
+
+def _fsync_directory(directory: str) -> None:
+    try:
+        # fsync каталога делает сам rename устойчивым к сбою питания.
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+
+def _atomic_write(path: str, data: bytes) -> None:
+    """Temp file in the same directory + fsync + rename: readers see either the old or the new file."""
+    tmp_path = _stage_file(path, data)
+    try:
+        os.replace(tmp_path, path)
+    except BaseException:
+        _discard_staged(tmp_path)
+        raise
+    _fsync_directory(os.path.dirname(os.path.abspath(path)))
+
+def _split_lines(text: str) -> List[str]:
+    """Like splitlines(keepends=True), but only "\n" ends a line (no \x0c, \u2028, ...), matching diff tools."""
+    parts = text.split("\n")
+    lines = [part + "\n" for part in parts[:-1]]
+    if parts[-1]:
+        lines.append(parts[-1])
+    return lines
+
+def _detect_newline(text: str) -> str:
+    return "\r\n" if "\r\n" in text else "\n"
+
+def _apply_unified_diff(original: str, patch: str) -> str:
+    """
+    Applies a unified diff (one file). Hunks are located at their stated line first,
+    then at the nearest position where their context and removed lines match.
+    """
+    lines = _split_lines(original)
+    hunks = []
+    current = None
+    old_left = new_left = 0
+    for raw in patch.splitlines():
+        if current is not None and raw.startswith("\\"):
+            # "\ No newline at end of file" относится к предыдущей строке.
+            if current["lines"]:
+                op, text = current["lines"][-1]
+                current["lines"][-1] = (op, text.rstrip("\r\n"))
+            continue
+        if old_left > 0 or new_left > 0:
+            op, text = (raw[0], raw[1:]) if raw else (" ", "")
+            if op not in (" ", "-", "+"):
+                raise PatchError(f"Unexpected line in hunk: {raw[:80]!r}")
+            current["lines"].append((op, text + "\n"))
+            if op != "+":
+                old_left -= 1
+            if op != "-":
+                new_left -= 1
+            continue
+        if raw.startswith("@@"):
+            match = re.match(r"@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@", raw)
+            if not match:
+                raise PatchError(f"Malformed hunk header: {raw[:80]!r}")
+            old_left = int(match.group(2) if match.group(2) is not None else 1)
+            new_left = int(match.group(4) if match.group(4) is not None else 1)
+            current = {"old_start": int(match.group(1)), "lines": []}
+            hunks.append(current)
+        # Заголовки (diff/index/---/+++) и текст между хунками пропускаются.
+    if not hunks:
+        raise PatchError("Patch contains no hunks.")
+    if old_left > 0 or new_left > 0:
+        raise PatchError("Patch is truncated: the last hunk is incomplete.")
+
+    newline = _detect_newline(original)
+    result: List[str] = []
+    cursor = 0
+    for number, hunk in enumerate(hunks, 1):
+        old_block = [text for op, text in hunk["lines"] if op != "+"]
+        new_block = [text.replace("\n", newline) if text.endswith("\n") else text for op, text in hunk["lines"] if op != "-"]
+        expected = max(hunk["old_start"] - 1, 0) if old_block else hunk["old_start"]
+
+        def matches_at(pos: int) -> bool:
+            if pos < cursor or pos + len(old_block) > len(lines):
+                return False
+            return all(lines[pos + i].rstrip("\r\n") == old.rstrip("\r\n") for i, old in enumerate(old_block))
+
+        position = None
+        for delta in range(0, len(lines) + 1):
+            for candidate in (expected - delta, expected + delta):
+                if matches_at(candidate):
+                    position = candidate
+                    break
+            if position is not None:
+                break
+        if position is None:
+            raise PatchError(f"Hunk #{number} (line {hunk['old_start']}) does not match the file on disk.")
+
+        result.extend(lines[cursor:position])
+        result.extend(new_block)
+        cursor = position + len(old_block)
+    result.extend(lines[cursor:])
+    return "".join(result)
+
+def _apply_range_replacements(original: str, replacements: List[Dict[str, Any]]) -> str:
+    """
+    Replaces whole line ranges: {"start_line": 1-based, "end_line": inclusive, "text": str}.
+    end_line = start_line - 1 inserts before start_line. Ranges must not overlap.
+    """
+    lines = _split_lines(original)
+    newline = _detect_newline(original)
+    parsed = []
+    for item in replacements:
+        try:
+            start = int(item["start_line"])
+            end = int(item.get("end_line", start))
+        except (KeyError, TypeError, ValueError):
+            raise PatchError(f"Invalid replacement: {item!r}")
+        if start < 1 or end < start - 1 or end > len(lines):
+            raise PatchError(f"Replacement range {start}-{end} is outside the file (1-{len(lines)}).")
+        parsed.append((start, end, str(item.get("text", ""))))
+    parsed.sort()
+    for (_s1, e1, _t1), (s2, _e2, _t2) in zip(parsed, parsed[1:]):
+        if s2 <= e1:
+            raise PatchError(f"Replacement ranges overlap at line {s2}.")
+
+    for start, end, text in reversed(parsed):
+        new_lines = [line.rstrip("\n") + newline for line in _split_lines(text.replace("\r\n", "\n"))]
+        touches_eof = end == len(lines) and lines and not lines[-1].endswith(("\n", "\r"))
+        if touches_eof and new_lines:
+            new_lines[-1] = new_lines[-1][:-len(newline)]
+        lines[start - 1:end] = new_lines
+    return "".join(lines)
+
+class StaleFileError(ValueError):
+    """Raised when the file on disk no longer matches the BASE HASH it was scanned with."""
+
+def _edit_mode(full_file_content: Optional[str], patch: str, replacements: Optional[List[Dict[str, Any]]]) -> Optional[str]:
+    """"full", "patch" or "replacements"; None unless exactly one of them is given."""
+    modes = [name for name, value in (("full", full_file_content is not None), ("patch", bool(patch)), ("replacements", bool(replacements))) if value]
+    return modes[0] if len(modes) == 1 else None
+
+def _prepare_edit(
+    file_path: str,
+    mode: str,
+    full_file_content: Optional[str],
+    patch: str,
+    replacements: Optional[List[Dict[str, Any]]],
+    base_hash: str,
+    keep_original: bool = False,
+) -> Tuple[bytes, int, Optional[bytes]]:
+    """
+    New content of file_path for one edit: (data, bytes transferred, content on disk).
+    The file is read only when the mode or base_hash needs it, or keep_original is set
+    (a missing file then yields None). Raises StaleFileError, PatchError or OSError.
+    """
+    on_disk = None
+    if mode != "full" or base_hash:
+        with open(file_path, "rb") as f:
+            on_disk = f.read()
+        if base_hash and _file_hash(on_disk) != base_hash.strip().lower():
+            raise StaleFileError(f"File '{file_path}' changed since it was scanned (base hash mismatch). Rescan and retry.")
+    elif keep_original and os.path.exists(file_path):
+        with open(file_path, "rb") as f:
+            on_disk = f.read()
+
+    # Содержимое кодируется ровно один раз; в режиме full переданные байты и есть записанные.
+    if mode == "full":
+        data = full_file_content.encode("utf-8")
+        transferred = len(data)
+    elif mode == "patch":
+        data = _apply_unified_diff(on_disk.decode("utf-8"), patch).encode("utf-8")
+        transferred = len(patch.encode("utf-8"))
+    else:
+        data = _apply_range_replacements(on_disk.decode("utf-8"), replacements).encode("utf-8")
+        transferred = len(json.dumps(replacements).encode("utf-8"))
+    return data, transferred, on_disk
+
+# --- ПРОВЕРКА ПОСЛЕ ЗАПИСИ (verify=True) ---
+# Новое содержимое перепарсивается инкрементально от дерева, закэшированного при
+# сканировании. Tree.changed_ranges вместе с областью текстовой правки дают измененные
+# участки. Для каждого участка по цепочке предков находятся объемлющие определения, и
+# заново извлекаются только они (запросы индекса, ограниченные диапазоном байтов).
+# Стоимость пропорциональна правке, а не файлу.
+VERIFY_LANGUAGES = {"javascript": "javascript", "typescript": "typescript", "python": "python@ts"}
+VERIFY_DEFINITION_TYPES = {
+    "javascript": JS_DEFINITION_TYPES,
+    "typescript": JS_DEFINITION_TYPES,
+    "python@ts": set(PY_TS_DEFINITION_KINDS),
+}
+
+def _merge_ranges(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    merged: List[Tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def _edit_hunks(old_source: bytes, new_source: bytes, edit: Dict[str, Any]) -> List[Tuple[int, int, int, int]]:
+    """
+    (old_start, old_end, new_start, new_end) of each differing run inside the edited region.
+    The region runs from the first to the last differing byte, so two edits far apart span
+    everything between them; a line diff of the region alone separates them again. Each run is
+    then narrowed to its differing bytes.
+    """
+    start, old_end, new_end = edit["start_byte"], edit["old_end_byte"], edit["new_end_byte"]
+    old_lines = old_source[start:old_end].splitlines(keepends=True)
+    new_lines = new_source[start:new_end].splitlines(keepends=True)
+    if len(old_lines) <= 1 or len(new_lines) <= 1:
+        runs = [(start, old_end, start, new_end)]
+    else:
+        old_offsets = list(itertools.accumulate((len(line) for line in old_lines), initial=start))
+        new_offsets = list(itertools.accumulate((len(line) for line in new_lines), initial=start))
+        matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+        runs = [
+            (old_offsets[i1], old_offsets[i2], new_offsets[j1], new_offsets[j2])
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != "equal"
+        ]
+    hunks = []
+    for old_start, old_stop, new_start, new_stop in runs:
+        old_part, new_part = old_source[old_start:old_stop], new_source[new_start:new_stop]
+        prefix = _common_prefix_len(old_part, new_part)
+        suffix = _common_suffix_len(old_part, new_part, min(len(old_part), len(new_part)) - prefix)
+        hunks.append((old_start + prefix, old_stop - suffix, new_start + prefix, new_stop - suffix))
+    return hunks
+
+def _old_position(hunks: List[Tuple[int, int, int, int]], position: int) -> int:
+    """Byte offset before the edit of an unchanged new-buffer position."""
+    shift = 0
+    for old_start, old_end, new_start, new_end in hunks:
+        if new_end > position:
+            break
+        shift = new_end - old_end
+    return position - shift
+
+def _enclosing_definitions(root_node, start: int, end: int, cache_lang: str) -> List[Tuple[Any, Any]]:
+    """
+    (definition node, span node) of every definition enclosing [start, end), outermost first.
+    A decorated Python definition encloses its decorators: its span node is the decorated_definition.
+    """
+    # TreeCursor.goto_first_child_for_byte в py-tree-sitter 0.21 ненадежен (сообщает False, но сдвигается),
+    # поэтому цепочка строится от наименьшего охватывающего узла; node.parent идет в C от корня.
+    definition_types = VERIFY_DEFINITION_TYPES[cache_lang]
+    chain = []
+    node = root_node.descendant_for_byte_range(start, end)
+    while node is not None:
+        chain.append(node)
+        node = node.parent
+    chain.reverse()
+    path: List[Tuple[Any, Any]] = []
+    decorated = None
+    for parent, node in zip([None] + chain, chain):
+        if node.type == 'decorated_definition':
+            # Декоратор — не потомок function_definition, а его сосед внутри decorated_definition.
+            decorated = node.child_by_field_name('definition')
+            if decorated is not None and decorated.type in definition_types:
+                path.append((decorated, node))
+            continue
+        if decorated is not None and node.start_byte == decorated.start_byte and node.type == decorated.type:
+            continue
+        if node.type in definition_types and (node.type != 'variable_declarator' or parent.type == 'lexical_declaration'):
+            path.append((node, node))
+    return path
+
+def _definition_name(node) -> str:
+    name_node = _js_definition_parts(node)[0] if node.type in JS_DEFINITION_TYPES else node.child_by_field_name('name')
+    return name_node.text.decode('utf8') if name_node is not None else "<anonymous>"
+
+def _dependency_filter(cache_lang: str) -> Callable[[List[Tuple[str, str]], str], Set[str]]:
+    if cache_lang == "python@ts":
+        return lambda calls, name: _filter_python_calls(calls, name, set(PYTHON_IGNORE), [])
+    ignore_globals, ignore_methods = _js_ignore_sets(None)
+    return lambda calls, name: _filter_js_calls(calls, name, ignore_globals, ignore_methods)
+
+def _old_definition(old_index: FileDefinitionIndex, name: str, old_start: int) -> Optional[_Definition]:
+    """The definition that started at old_start before the edit; the first one with that name otherwise."""
+    definitions = old_index.definitions
+    position = bisect.bisect_left(definitions, old_start, key=lambda d: d.start_byte)
+    while position < len(definitions) and definitions[position].start_byte == old_start:
+        if definitions[position].name == name:
+            return definitions[position]
+        position += 1
+    return old_index.by_name.get(name)
+
+def _verify_commit(file_path: str, old_source: bytes, new_source: bytes, targets: Set[str]) -> List[str]:
+    """
+    Report lines on what a written edit changed: edits outside the approved targets and
+    callees the changed definitions did not call before.
+    """
+    detected, _ = _cheap_language(new_source, file_path)
+    cache_lang = VERIFY_LANGUAGES.get(detected or "")
+    parser = get_parser("python" if cache_lang == "python@ts" else cache_lang) if cache_lang else None
+    if parser is None or (cache_lang == "python@ts" and PYTHON_BACKEND == "ast"):
+        METRICS.inc("commit_verifications_total", outcome="unavailable")
+        return ["VERIFICATION: unavailable (needs a JS, TS or tree-sitter-python file)."]
+
+    with METRICS.phase("verify", cache_lang):
+        build = (lambda tree, byte_range=None: _build_python_ts_index(tree, byte_range)) if cache_lang == "python@ts" \
+            else (lambda tree, byte_range=None: _build_js_index(tree, cache_lang, byte_range))
+        # Дерево старого содержимого обычно уже в кэше после сканирования (hit),
+        # и его индекс берется оттуда же; иначе это единственный полный разбор.
+        old_tree, old_status = _parse_cached(parser, cache_lang, old_source, file_path)
+        old_index = _index_cached(old_tree, cache_lang, file_path, lambda: build(old_tree))
+        edit = _compute_source_edit(old_source, new_source)
+        edited: Dict[str, Any] = {}
+
+        def reparse(source: bytes, previous: Any) -> Any:
+            edited["tree"] = previous
+            return _ts_parse(parser, source, previous)
+
+        started = time.perf_counter()
+        key = (os.path.normpath(file_path).lower(), cache_lang)
+        new_tree, new_status = PARSE_CACHE.parse(key, new_source, reparse, lambda src, tree: _ts_copy(parser, src, tree))
+        _record_parse(cache_lang, len(new_source), new_status, started)
+        hunks = _edit_hunks(old_source, new_source, edit)
+        changed = []
+        for _, _, new_start, new_end in hunks:
+            # Пробелы вокруг вставки принадлежат объемлющей области, а не правленому коду.
+            text = new_source[new_start:new_end]
+            if text.strip():
+                new_start += len(text) - len(text.lstrip())
+                new_end = new_start + len(text.strip())
+            changed.append((new_start, new_end))
+        if edited.get("tree") is not None:
+            # Внутри правленой области changed_ranges повторяют ее целиком; снаружи они
+            # ловят структурные последствия (например, незакрытый комментарий).
+            for r in edited["tree"].changed_ranges(new_tree):
+                if r.start_byte < edit["start_byte"]:
+                    changed.append((r.start_byte, min(r.end_byte, edit["start_byte"])))
+                if r.end_byte > edit["new_end_byte"]:
+                    changed.append((max(r.start_byte, edit["new_end_byte"]), r.end_byte))
+        changed = _merge_ranges(changed)
+
+        out_of_scope: List[str] = []
+        windows: List[Tuple[int, int]] = []
+        root = new_tree.root_node
+        for start, end in changed:
+            path = _enclosing_definitions(root, start, end, cache_lang)
+            names = [_definition_name(node) for node, _ in path]
+            if "ENTIRE_FILE" not in targets and not targets.intersection(names):
+                line = _byte_to_point(new_source, start)[0] + 1
+                out_of_scope.append(f"{names[-1] if names else MODULE_SCOPE} (line {line})")
+            if path:
+                windows.append((path[-1][1].start_byte, path[-1][1].end_byte))
+            else:
+                # Правка на уровне модуля: окно расширяется до определений, которые оно задевает.
+                window_start, window_end = start, max(end, start + 1)
+                for definition in build(new_tree, (window_start, window_end)).definitions:
+                    window_start, window_end = min(window_start, definition.start_byte), max(window_end, definition.end_byte)
+                windows.append((window_start, window_end))
+
+        dependencies = _dependency_filter(cache_lang)
+        new_callees: Dict[str, Set[str]] = {}
+        seen: Set[str] = set()
+        reextracted = 0
+        for start, end in _merge_ranges(windows):
+            partial = build(new_tree, (start, end))
+            for definition in partial.definitions:
+                if definition.start_byte < start or definition.end_byte > end:
+                    continue  # объемлющее определение: захвачено только пересечением с окном
+                reextracted += 1
+                seen.add(definition.name)
+                previous = _old_definition(old_index, definition.name, _old_position(hunks, definition.start_byte))
+                added = dependencies(definition.calls, definition.name) - (dependencies(previous.calls, previous.name) if previous else set())
+                if added:
+                    new_callees.setdefault(definition.name, set()).update(added)
+            module_added = dependencies(partial.module_calls, MODULE_SCOPE) - dependencies(old_index.module_calls, MODULE_SCOPE)
+            if module_added:
+                new_callees.setdefault(MODULE_SCOPE, set()).update(module_added)
+
+        removed = [
+            d.name for old_start, old_end, _, _ in hunks for d in old_index.definitions
+            if d.start_byte >= old_start and d.end_byte <= old_end and d.name not in seen
+        ]
+
+    outcome = "out_of_scope" if out_of_scope else "new_callees" if new_callees else "clean"
+    METRICS.inc("commit_verifications_total", outcome=outcome)
+    scope = ", ".join(sorted(targets))
+    lines = [
+        f"VERIFICATION: {len(changed)} changed range(s), {reextracted} definition(s) re-extracted "
+        f"(old tree: {old_status}, new tree: {new_status})",
+        f"⚠️ OUT OF SCOPE ({scope}): {', '.join(dict.fromkeys(out_of_scope))}" if out_of_scope else f"✅ All changes stay inside: {scope}",
+    ]
+    if new_callees:
+        lines.append("⚠️ NEW CALLEES: " + "; ".join(f"{name}: {', '.join(sorted(callees))}" for name, callees in sorted(new_callees.items())))
+    else:
+        lines.append("✅ No new callees.")
+    if removed:
+        lines.append(f"Removed definitions: {', '.join(removed)}")
+    return lines
+
+def _verify_edit(file_path: str, old_source: Optional[bytes], new_source: bytes, targets: Set[str]) -> List[str]:
+    """_verify_commit for a file that is already written: a failed check is reported, never raised."""
+    if old_source is None:
+        return ["VERIFICATION: skipped (the file did not exist before this commit)."]
+    try:
+        if SCAN_SANDBOX_ENABLED and SCAN_SANDBOX.warmed:
+            # Дерево старого содержимого лежит в кэше воркера, который сканировал этот файл.
+            lines, drained = SCAN_SANDBOX.run(_run_with_metrics, _verify_commit, file_path, old_source, new_source, targets,
+                                              key=_sandbox_key(file_path))
+            if drained:
+                METRICS.merge(drained)
+            return lines
+        return _verify_commit(file_path, old_source, new_source, targets)
+    except ScanTooExpensive as e:
+        METRICS.inc("commit_verifications_total", outcome="error")
+        return [f"VERIFICATION STOPPED: {e}."]
+    except Exception as e:
+        METRICS.inc("commit_verifications_total", outcome="error")
+        return [f"VERIFICATION FAILED: {str(e)}"]
+
+def _commit_refusal(message: str, as_json: bool, started: float, outcome: str, state: str) -> str:
+    """A refused commit: the text message as is, or its JSON form without the banner."""
+    if not as_json:
+        return message
+    return _json_response({"ok": False, "state": state, "outcome": outcome, "error": message.split(": ", 1)[-1],
+                           "elapsed_ms": _elapsed_ms(started)})
+
+@_async_tool()
+def commit_safe_edit(
+    target_function: str,
+    file_path: str,
+    full_file_content: Optional[str] = None,
+    force_override: bool = False,
+    patch: str = "",
+    replacements: Optional[List[Dict[str, Any]]] = None,
+    base_hash: str = "",
+    verify: bool = False,
+    format: str = "text"
+) -> str:
+    """
+    Writes an approved edit. Send exactly one of:
+        full_file_content: the whole new file;
+        patch: a unified diff against the file on disk;
+        replacements: [{"start_line", "end_line", "text"}] whole-line replacements (1-based, inclusive).
+    base_hash: BASE HASH reported by scan_dependencies; the commit is refused if the file changed since.
+    verify: after writing, reparse incrementally and report changes outside target_function
+            and callees the changed definitions did not call before (JS, TS, tree-sitter Python).
+    Writes are atomic (temp file + fsync + rename).
+    format: "text" (default) or "json": one compact object with ok, state, outcome, bytes and the new base_hash.
+    """
+    started = time.perf_counter()
+    if _bad_format(format):
+        return _bad_format(format)
+    as_json = format == "json"
     state_key = get_state_key(file_path, target_function)
     current_state = APPROVAL_STATE.get(state_key, "NONE")
     
     if current_state != "APPROVED" and not force_override:
-        return f"⛔ SECURITY BLOCK: Integrity Score is NOT 1.0. Current state: {current_state}. Access Denied."
-    
+        METRICS.inc("commits_total", mode="unknown", outcome="blocked")
+        return _commit_refusal(f"⛔ SECURITY BLOCK: Integrity Score is NOT 1.0. Current state: {current_state}. Access Denied.",
+                               as_json, started, "blocked", current_state)
+
+    mode = _edit_mode(full_file_content, patch, replacements)
+    if mode is None:
+        METRICS.inc("commits_total", mode="unknown", outcome="invalid")
+        return _commit_refusal("❌ ERROR: Provide exactly one of full_file_content, patch or replacements.",
+                               as_json, started, "invalid", current_state)
+
     try:
         file_path = os.path.normpath(file_path)
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write(full_file_content)
+        data, transferred, on_disk = _prepare_edit(file_path, mode, full_file_content, patch, replacements, base_hash, keep_original=verify)
+    except StaleFileError as e:
+        METRICS.inc("commits_total", mode=mode, outcome="stale")
+        return _commit_refusal(f"❌ ERROR: {str(e)}", as_json, started, "stale", current_state)
+    except PatchError as e:
+        METRICS.inc("commits_total", mode=mode, outcome="rejected")
+        return _commit_refusal(f"❌ PATCH REJECTED: {str(e)}", as_json, started, "rejected", current_state)
+    except Exception as e:
+        METRICS.inc("commits_total", mode=mode, outcome="error")
+        return _commit_refusal(f"❌ ERROR: {str(e)}", as_json, started, "error", current_state)
+
+    # Одобрение одноразовое: забираем его атомарно, чтобы два процесса
+    # не смогли закоммитить по одному и тому же "APPROVED".
+    consumed = current_state == "APPROVED" and APPROVAL_STATE.transition(state_key, "APPROVED", "NONE")
+    if consumed:
+        _record_transition("APPROVED", "NONE")
+    elif not force_override:
+        METRICS.inc("commits_total", mode=mode, outcome="blocked")
+        return _commit_refusal(f"⛔ SECURITY BLOCK: Approval for '{state_key}' was already used. Access Denied.",
+                               as_json, started, "blocked", APPROVAL_STATE.get(state_key, "NONE"))
+    
+    try:
+        with METRICS.phase("write"):
+            _atomic_write(file_path, data)
         APPROVAL_STATE[state_key] = "NONE" # Сброс после записи
-        return f"✅ SAFE COMMIT: File '{file_path}' updated."
+        METRICS.inc("commits_total", mode=mode, outcome="forced" if force_override and not consumed else "committed")
+        METRICS.inc("committed_bytes_total", len(data))
+        new_hash = _file_hash(data)
+        result = (
+            f"✅ SAFE COMMIT: File '{file_path}' updated.\n"
+            f"Mode: {mode} | Bytes transferred: {transferred} | Bytes written: {len(data)}\n"
+            f"NEW BASE HASH: {new_hash}"
+        )
+    except Exception as e:
+        if consumed:
+            # Запись не удалась — одобрение остается в силе, если его не сбросило сканирование.
+            _grant(state_key, "NONE", "APPROVED")
+        METRICS.inc("commits_total", mode=mode, outcome="error")
+        return _commit_refusal(f"❌ ERROR: {str(e)}", as_json, started, "error", APPROVAL_STATE.get(state_key, "NONE"))
+    verification = _verify_edit(file_path, on_disk, data, {target_function}) if verify else None
+    if as_json:
+        payload = {
+            "ok": True, "state": "NONE", "outcome": "forced" if force_override and not consumed else "committed",
+            "mode": mode, "bytes_transferred": transferred, "bytes_written": len(data), "base_hash": new_hash,
+        }
+        if verification is not None:
+            payload["verification"] = verification
+        payload["elapsed_ms"] = _elapsed_ms(started)
+        return _json_response(payload)
+    if verification is not None:
+        result += "\n" + "\n".join(verification)
+    return result
+
+# --- ТРАНЗАКЦИИ ПРАВОК (CHANGESET) ---
+# Рефакторинг меняет функцию и ее вызывающих в нескольких файлах. Changeset объединяет
+# такие цели: одно сканирование, одна оценка, одно подтверждение пользователя и одна
+# запись всех файлов. Одобрение хранится в APPROVAL_STATE под ключом changeset::<id>;
+# id выводится из ключей целей, поэтому тот же набор целей получает тот же id.
+# Состав набора тоже лежит в APPROVAL_STATE (JSON под changeset-members::<id>), как и
+# обратные ссылки цель -> наборы (changesets-of::<ключ цели>): с бэкендом SQLite набор,
+# открытый одним процессом, виден всем, и повторное сканирование любой цели в любом
+# процессе отзывает одобрение ее наборов. Срок жизни — тот же STATE_TTL.
+# Запись двухфазная: все файлы готовятся и пишутся во временные файлы параллельно и
+# только потом переименовываются; при ошибке замененные файлы возвращаются назад.
+CHANGESET_MAX_TARGETS = 256
+CHANGESETS_PER_TARGET = 64
+CHANGESET_WRITE_WORKERS = int(os.environ.get("EDIT_MATH_CHANGESET_WORKERS", "0")) or 8
+
+_WRITE_POOL: Optional[ThreadPoolExecutor] = None
+_WRITE_POOL_LOCK = threading.Lock()
+
+def _changeset_id(state_keys: Sequence[str]) -> str:
+    return hashlib.sha256("\n".join(sorted(state_keys)).encode("utf-8")).hexdigest()[:16]
+
+def _changeset_state_key(changeset_id: str) -> str:
+    return f"changeset::{changeset_id}"
+
+def _changeset_members_key(changeset_id: str) -> str:
+    return f"changeset-members::{changeset_id}"
+
+def _changeset_link_key(state_key: str) -> str:
+    return f"changesets-of::{state_key}"
+
+def _changeset_members(changeset_id: str) -> Optional[Dict[str, str]]:
+    """State key -> normalized file path of every target, or None for an unknown (or expired) id."""
+    stored = APPROVAL_STATE.get(_changeset_members_key(changeset_id), "NONE")
+    return None if stored == "NONE" else json.loads(stored)
+
+def _link_changeset(state_key: str, changeset_id: str) -> None:
+    """Adds changeset_id to the changesets of a target; the oldest link over CHANGESETS_PER_TARGET is revoked."""
+    link_key = _changeset_link_key(state_key)
+    while True:
+        current = APPROVAL_STATE.get(link_key, "NONE")
+        linked = [] if current == "NONE" else json.loads(current)
+        if changeset_id in linked:
+            return
+        linked.append(changeset_id)
+        dropped, linked = linked[:-CHANGESETS_PER_TARGET], linked[-CHANGESETS_PER_TARGET:]
+        # Сравнение с прочитанным значением: параллельное открытие другого набора не теряется.
+        if APPROVAL_STATE.transition(link_key, current, json.dumps(linked)):
+            break
+    # Набор без обратной ссылки не узнает о повторном сканировании: его одобрение отзывается.
+    for old_id in dropped:
+        APPROVAL_STATE[_changeset_state_key(old_id)] = "NONE"
+
+def _get_write_pool() -> ThreadPoolExecutor:
+    # Отдельный пул: инструменты сами выполняются в потоках TOOL_EXECUTOR, и ожидание
+    # задач в том же пуле могло бы его исчерпать.
+    global _WRITE_POOL
+    with _WRITE_POOL_LOCK:
+        if _WRITE_POOL is None:
+            _WRITE_POOL = ThreadPoolExecutor(max_workers=CHANGESET_WRITE_WORKERS, thread_name_prefix="edit-math-write")
+        return _WRITE_POOL
+
+def _run_parallel(fn: Callable, items: List[Any]) -> List[Tuple[Any, Optional[BaseException]]]:
+    """fn over items on the write pool: (result, None) or (None, error) per item, in input order."""
+    def call(item):
+        try:
+            return fn(item), None
+        except Exception as e:
+            return None, e
+    if len(items) == 1:
+        return [call(items[0])]
+    return list(_get_write_pool().map(call, items))
+
+@_async_tool()
+def open_changeset(
+    targets: List[Dict[str, Any]],
+    max_workers: int = 0
+) -> Dict[str, Any]:
+    """
+    Opens a multi-target edit: scans every target and returns the changeset_id used by
+    evaluate_changeset and commit_changeset.
+    Args:
+        targets: Entries with `file_path`, `target_function` and optionally `language`, `ignore_custom`,
+                 `resolve_scripts` (as in scan_dependencies_batch). Files are always read from disk.
+        max_workers: Scan pool size (defaults to EDIT_MATH_BATCH_WORKERS or min(8, CPU count)).
+    Returns {"changeset_id", "targets": state keys, "results": one scan result per target, in input order}.
+    """
+    if not targets:
+        return {"error": "❌ ERROR: A changeset needs at least one target."}
+    if len(targets) > CHANGESET_MAX_TARGETS:
+        return {"error": f"❌ ERROR: A changeset holds at most {CHANGESET_MAX_TARGETS} targets ({len(targets)} given)."}
+    without_path = [i for i, target in enumerate(targets) if not target.get("file_path")]
+    if without_path:
+        return {"error": f"❌ ERROR: Every changeset target needs a file_path (missing in entries {without_path})."}
+
+    # Код из запроса не принимается: коммит пишет файлы на диске, и сканироваться должны они.
+    items = [{name: value for name, value in target.items() if name != "code"} for target in targets]
+    members = {
+        get_state_key(item["file_path"], item.get("target_function") or "ENTIRE_FILE"): os.path.normpath(item["file_path"]).lower()
+        for item in items
+    }
+    changeset_id = _changeset_id(list(members))
+    APPROVAL_STATE[_changeset_members_key(changeset_id)] = json.dumps(members)
+    for key in members:
+        _link_changeset(key, changeset_id)
+    # Повторное открытие — это новое сканирование: сканирование целей сбрасывает и одобрение набора.
+    results = scan_dependencies_batch(items, max_workers)
+    return {"changeset_id": changeset_id, "targets": list(members), "results": results}
+
+@_async_tool()
+def evaluate_changeset(
+    changeset_id: str,
+    evaluations: List[Dict[str, Any]],
+    user_last_message: str = ""
+) -> str:
+    """
+    One Integrity Score and one user confirmation for every target of a changeset.
+    Args:
+        evaluations: One entry per target with `file_path`, `target_function`, `dependencies`,
+                     `verified_dependencies` and optionally `proposed_header`, `breaking_change_description`
+                     (the arguments of calculate_integrity_score).
+        user_last_message: The FULL last user message, passed on the confirmation call.
+    The combined score is the lowest score of any target.
+    """
+    changeset_id = (changeset_id or "").strip()
+    members = _changeset_members(changeset_id)
+    if members is None:
+        return f"❌ ERROR: Unknown changeset '{changeset_id}'. Open it with open_changeset first."
+
+    by_key: Dict[str, Dict[str, Any]] = {}
+    for entry in evaluations or []:
+        key = get_state_key(entry.get("file_path") or "", entry.get("target_function") or "ENTIRE_FILE")
+        if key not in members:
+            return f"❌ ERROR: '{key}' is not a target of changeset '{changeset_id}'."
+        by_key[key] = entry
+    unevaluated = [key for key in members if key not in by_key]
+    if unevaluated:
+        return f"❌ ERROR: No evaluation for changeset targets: {unevaluated}"
+
+    rows = []
+    for key in members:
+        entry = by_key[key]
+        deps = entry.get("dependencies") or []
+        reasons = _confirmation_reasons(entry.get("target_function") or "ENTIRE_FILE", deps,
+                                        entry.get("proposed_header") or "", entry.get("breaking_change_description") or "")
+        score, missing = _integrity_score(deps, entry.get("verified_dependencies") or []) if reasons else (1.0, [])
+        rows.append((key, reasons, score, missing))
+
+    state_key = _changeset_state_key(changeset_id)
+    current_state = APPROVAL_STATE.get(state_key, "NONE")
+    needs_confirmation = any(reasons for _, reasons, _, _ in rows)
+
+    if needs_confirmation and current_state == "NONE":
+        if not _grant(state_key, "NONE", "PENDING"):
+            return _state_changed(state_key)
+        details = "\n".join(f"  - {key}: {', '.join(reasons)}" for key, reasons, _, _ in rows if reasons)
+        return f"""
+✋ STRICT MODE INTERVENTION (Step 1/2)
+-------------------------------------
+Scope: {state_key} ({len(rows)} targets)
+Reasons:
+{details}
+
+The server FORBIDS silent edits.
+
+INSTRUCTION FOR AI:
+1. STOP. Do not edit yet.
+2. Explain the plan/conflicts for ALL targets to the user.
+3. ASK THE USER: "Type 'ok' to confirm."
+4. Wait for the user's input.
+5. Call this tool again, passing the FULL last user message
+   as `user_last_message`.
+"""
+
+    if current_state == "PENDING" and not _user_confirmed(user_last_message):
+        return (
+            "⛔ ACCESS DENIED.\n"
+            "Waiting for explicit user confirmation.\n"
+            "The last user message is NOT exactly 'ok'."
+        )
+
+    if not needs_confirmation:
+        if not _grant(state_key, current_state, "APPROVED"):
+            return _state_changed(state_key)
+        return f"Score: 1.0 (Safe). Edits to all {len(rows)} targets of changeset '{changeset_id}' are allowed."
+
+    combined = min(score for _, _, score, _ in rows)
+    if combined >= INTEGRITY_PASS_SCORE:
+        if not _grant(state_key, current_state, "APPROVED"):
+            return _state_changed(state_key)
+        return (
+            f"Integrity Score: {combined:.4f} / 1.0 ({len(rows)} targets)\n"
+            "STATUS: ✅ ACCESS GRANTED (User Confirmed)"
+        )
+
+    missing = {key: missing for key, _, _, missing in rows if missing}
+    return (
+        f"Integrity Score: {combined:.4f} / 1.0 ({len(rows)} targets)\n"
+        "STATUS: ⛔ ACCESS DENIED\n"
+        f"Missing dependency verification: {missing}"
+    )
+
+@_async_tool()
+def commit_changeset(
+    changeset_id: str,
+    edits: List[Dict[str, Any]],
+    force_override: bool = False,
+    verify: bool = False
+) -> str:
+    """
+    Writes the files of an approved changeset, all or nothing.
+    Args:
+        edits: One entry per file with `file_path`, exactly one of `full_file_content`, `patch` or
+               `replacements`, and optionally `base_hash` (as in commit_safe_edit). Every file must
+               belong to a target of the changeset.
+        verify: after writing, check each file as commit_safe_edit does, against the changeset targets in it.
+    Every edit is applied and written to a synced temp file, in parallel, before any file is
+    replaced. If a replacement fails, the files already replaced are restored and the approval
+    stays in effect.
+    """
+    changeset_id = (changeset_id or "").strip()
+    members = _changeset_members(changeset_id)
+    if members is None:
+        return f"❌ ERROR: Unknown changeset '{changeset_id}'. Open it with open_changeset first."
+    state_key = _changeset_state_key(changeset_id)
+    current_state = APPROVAL_STATE.get(state_key, "NONE")
+    if current_state != "APPROVED" and not force_override:
+        METRICS.inc("commits_total", mode="changeset", outcome="blocked")
+        return f"⛔ SECURITY BLOCK: Changeset Integrity Score is NOT 1.0. Current state: {current_state}. Access Denied."
+
+    allowed = set(members.values())
+    plan = []
+    for entry in edits or []:
+        file_path = os.path.normpath(entry.get("file_path") or "")
+        if file_path.lower() not in allowed:
+            METRICS.inc("commits_total", mode="changeset", outcome="invalid")
+            return f"❌ ERROR: '{file_path}' is not a file of changeset '{changeset_id}'."
+        if any(other.lower() == file_path.lower() for other, _, _ in plan):
+            METRICS.inc("commits_total", mode="changeset", outcome="invalid")
+            return f"❌ ERROR: '{file_path}' has more than one edit; combine them into one."
+        mode = _edit_mode(entry.get("full_file_content"), entry.get("patch") or "", entry.get("replacements"))
+        if mode is None:
+            METRICS.inc("commits_total", mode="changeset", outcome="invalid")
+            return f"❌ ERROR: '{file_path}': provide exactly one of full_file_content, patch or replacements."
+        plan.append((file_path, mode, entry))
+    if not plan:
+        METRICS.inc("commits_total", mode="changeset", outcome="invalid")
+        return "❌ ERROR: The changeset commit has no edits."
+
+    # 1. Все правки применяются до какой-либо записи: одна несовпавшая — и не пишется ничего.
+    prepared = _run_parallel(
+        lambda step: _prepare_edit(step[0], step[1], step[2].get("full_file_content"), step[2].get("patch") or "",
+                                   step[2].get("replacements"), step[2].get("base_hash") or "", keep_original=True),
+        plan,
+    )
+    failures = [(file_path, error) for (file_path, _, _), (_, error) in zip(plan, prepared) if error is not None]
+    if failures:
+        outcome = "stale" if any(isinstance(e, StaleFileError) for _, e in failures) else \
+            "rejected" if any(isinstance(e, PatchError) for _, e in failures) else "error"
+        METRICS.inc("commits_total", mode="changeset", outcome=outcome)
+        details = "\n".join(f"  - {file_path}: {error}" for file_path, error in failures)
+        return f"❌ CHANGESET REJECTED: nothing was written.\n{details}"
+
+    consumed = current_state == "APPROVED" and APPROVAL_STATE.transition(state_key, "APPROVED", "NONE")
+    if consumed:
+        _record_transition("APPROVED", "NONE")
+    elif not force_override:
+        METRICS.inc("commits_total", mode="changeset", outcome="blocked")
+        return f"⛔ SECURITY BLOCK: Approval for '{state_key}' was already used. Access Denied."
+
+    def restore_approval():
+        # Сканирование цели во время записи отзывает набор: такой сброс не перезаписывается.
+        if consumed:
+            _grant(state_key, "NONE", "APPROVED")
+
+    # 2. Временные файлы пишутся и синхронизируются параллельно.
+    results = [result for result, _ in prepared]
+    with METRICS.phase("write"):
+        staged = _run_parallel(lambda write: _stage_file(*write), [(file_path, data) for (file_path, _, _), (data, _, _) in zip(plan, results)])
+        stage_failures = [(file_path, error) for (file_path, _, _), (_, error) in zip(plan, staged) if error is not None]
+        if stage_failures:
+            for tmp_path, _ in staged:
+                if tmp_path:
+                    _discard_staged(tmp_path)
+            restore_approval()
+            METRICS.inc("commits_total", mode="changeset", outcome="error")
+            details = "\n".join(f"  - {file_path}: {error}" for file_path, error in stage_failures)
+            return f"❌ ERROR: Could not stage the changeset; nothing was written.\n{details}"
+
+        # 3. Переименования дешевы и идут по очереди, чтобы точно знать, что откатывать.
+        replaced: List[Tuple[str, Optional[bytes]]] = []
+        for (file_path, _, _), (tmp_path, _), (_, _, original) in zip(plan, staged, results):
+            try:
+                os.replace(tmp_path, file_path)
+            except Exception as e:
+                rollback_errors = []
+                for done_path, done_original in reversed(replaced):
+                    try:
+                        if done_original is None:
+                            os.unlink(done_path)
+                        else:
+                            _atomic_write(done_path, done_original)
+                    except Exception as restore_error:
+                        rollback_errors.append(f"  - {done_path}: {restore_error}")
+                for pending_path, _ in staged[len(replaced):]:
+                    _discard_staged(pending_path)
+                restore_approval()
+                METRICS.inc("commits_total", mode="changeset", outcome="error")
+                if rollback_errors:
+                    return (f"❌ ERROR: Writing '{file_path}' failed ({e}) and these files could NOT be restored:\n"
+                            + "\n".join(rollback_errors))
+                return f"❌ ERROR: Writing '{file_path}' failed ({e}); {len(replaced)} already written file(s) were restored."
+            replaced.append((file_path, original))
+        for directory in {os.path.dirname(os.path.abspath(file_path)) for file_path, _, _ in plan}:
+            _fsync_directory(directory)
+
+    for key in members:
+        APPROVAL_STATE[key] = "NONE"
+    METRICS.inc("commits_total", mode="changeset", outcome="forced" if force_override and not consumed else "committed")
+    METRICS.inc("committed_bytes_total", sum(len(data) for data, _, _ in results))
+    lines = [
+        f"  - {file_path}: {mode} | Bytes transferred: {transferred} | Bytes written: {len(data)} | NEW BASE HASH: {_file_hash(data)}"
+        for (file_path, mode, _), (data, transferred, _) in zip(plan, results)
+    ]
+    if verify:
+        for (file_path, _, _), (data, _, original) in zip(plan, results):
+            path_key = file_path.lower()
+            targets = {key[len(path) + 2:] for key, path in members.items() if path == path_key}
+            lines.append(f"{file_path}:")
+            lines.extend("    " + line for line in _verify_edit(file_path, original, data, targets))
+    return f"✅ SAFE COMMIT: {len(plan)} file(s) of changeset '{changeset_id}' updated.\n" + "\n".join(lines)
+
+# --- ИНДЕКС ПРОЕКТА (СИМВОЛЫ И ОБРАТНЫЕ ВЫЗОВЫ) ---
+# "Кто вызывает эту функцию?" — главный вопрос при оценке радиуса правки.
+# Индекс строится один раз по каталогу, хранится в SQLite и обновляется
+# инкрементально по (mtime, size, hash) каждого файла.
+INDEX_DIR = os.environ.get("EDIT_MATH_INDEX_DIR", CACHE_DIR)
+
+INDEX_LANGUAGES = {
+    ".py": "python",
+    ".js": "javascript", ".mjs": "javascript", ".cjs": "javascript", ".jsx": "javascript",
+    ".ts": "typescript", ".tsx": "typescript", ".mts": "typescript", ".cts": "typescript",
+    ".html": "html", ".htm": "html",
+}
+
+INDEX_SKIP_DIRS = {"node_modules", "__pycache__", "venv", "dist", "build", "site-packages"}
+
+MODULE_SCOPE = "<module>"
+
+FUNCTION_VALUE_TYPES = {"arrow_function", "function", "function_expression", "generator_function", "class"}
+
+_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    language TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS definitions (
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    line INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS calls (
+    path TEXT NOT NULL,
+    caller TEXT NOT NULL,
+    callee TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_definitions_name ON definitions(name);
+CREATE INDEX IF NOT EXISTS idx_definitions_path ON definitions(path);
+CREATE INDEX IF NOT EXISTS idx_calls_callee ON calls(callee);
+CREATE INDEX IF NOT EXISTS idx_calls_path ON calls(path);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+def _default_index_path(root_dir: str) -> str:
+    root_id = hashlib.blake2b(os.path.abspath(root_dir).encode("utf8"), digest_size=8).hexdigest()
+    return os.path.join(INDEX_DIR, f"index_{root_id}.sqlite")
+
+def _open_index(index_path: str) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    conn = sqlite3.connect(index_path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(_INDEX_SCHEMA)
+    return conn
+
+def _iter_project_files(root_dir: str, exclude_dirs: Set[str]):
+    """Yields (relative_path, os.stat_result) for every indexable file; iterative to survive deep trees."""
+    stack = [root_dir]
+    while stack:
+        current = stack.pop()
+        try:
+            entries = list(os.scandir(current))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name.startswith(".") or entry.name in exclude_dirs:
+                        continue
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    if os.path.splitext(entry.name)[1].lower() in INDEX_LANGUAGES:
+                        yield os.path.relpath(entry.path, root_dir), entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+
+def _index_source(source: bytes, language: str) -> Tuple[List[Tuple[str, str, int]], Set[Tuple[str, str]]]:
+    """
+    Extracts definitions and (caller, callee) edges from one file via the same definition index scans use.
+    Calls outside any definition are attributed to MODULE_SCOPE.
+    """
+    edges: Set[Tuple[str, str]] = set()
+    if language == "html":
+        # Обработчики и код верхнего уровня встроенных скриптов попадают в MODULE_SCOPE.
+        definitions = []
+        regions = _collect_html_regions(_ts_parse(get_parser("html"), source).root_node, source)
+        for lang_key, _, _, embedded, _ in _iter_html_embedded(regions, source, ""):
+            if embedded is not None:
+                inline_definitions, inline_edges = _index_edges(_build_js_index(embedded, lang_key), lang_key)
+                definitions.extend(inline_definitions)
+                edges.update(inline_edges)
+        return definitions, edges
+
+    if language == "python":
+        try:
+            index = _parse_python_index(source, "")[1]
+        except (SyntaxError, ValueError):
+            return [], edges
+    else:
+        index = _build_js_index(_ts_parse(get_parser(language), source), language)
+    return _index_edges(index, language)
+
+def _index_edges(index: FileDefinitionIndex, language: str, ignore_custom: Optional[List[str]] = None) -> Tuple[List[Tuple[str, str, int]], Set[Tuple[str, str]]]:
+    """Symbols of a definition index and its filtered (caller, callee) edges, using the same ignore rules as scans."""
+    if language == "python":
+        ignore = set(PYTHON_IGNORE)
+        ignore.update(ignore_custom or [])
+        filter_calls = lambda calls, name: _filter_python_calls(calls, name, ignore, [])
+    else:
+        ignore_globals, ignore_methods = _js_ignore_sets(ignore_custom)
+        filter_calls = lambda calls, name: _filter_js_calls(calls, name, ignore_globals, ignore_methods)
+
+    edges: Set[Tuple[str, str]] = set()
+    definitions = []
+    for definition in index.definitions:
+        if definition.kind == 'variable_declarator' and definition.scan_type not in FUNCTION_VALUE_TYPES:
+            # Только объявления функций/классов: `const data = await load()` не является символом.
+            continue
+        definitions.append((definition.name, definition.kind, definition.line))
+        edges.update((definition.name, callee) for callee in filter_calls(definition.calls, definition.name))
+    for callee in filter_calls(index.module_calls, MODULE_SCOPE):
+        edges.add((MODULE_SCOPE, callee))
+    return definitions, edges
+
+def _index_meta(conn: sqlite3.Connection, key: str) -> Optional[str]:
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def _update_project_index(root_dir: str, index_path: str, exclude_dirs: Optional[Set[str]] = None) -> Dict[str, int]:
+    """
+    Brings the on-disk index in line with root_dir, re-extracting only files whose content changed.
+    exclude_dirs=None reuses the set stored with the index by the last explicit index_project.
+    """
+    stats = {"files": 0, "unchanged": 0, "touched": 0, "reindexed": 0, "removed": 0, "unsupported": 0, "errors": 0}
+    conn = _open_index(index_path)
+    try:
+        if exclude_dirs is None:
+            stored = _index_meta(conn, "exclude_dirs")
+            exclude_dirs = set(json.loads(stored)) if stored is not None else set(INDEX_SKIP_DIRS)
+        known = {row[0]: row[1:] for row in conn.execute("SELECT path, mtime_ns, size, hash FROM files")}
+        seen: Set[str] = set()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('exclude_dirs', ?)", (json.dumps(sorted(exclude_dirs)),))
+            for rel_path, st in _iter_project_files(root_dir, exclude_dirs):
+                stats["files"] += 1
+                seen.add(rel_path)
+                previous = known.get(rel_path)
+                if previous and previous[0] == st.st_mtime_ns and previous[1] == st.st_size:
+                    stats["unchanged"] += 1
+                    continue
+                language = INDEX_LANGUAGES[os.path.splitext(rel_path)[1].lower()]
+                if language != "python" and get_parser(language) is None:
+                    # Без грамматики файл не записываем: с ней он проиндексируется при следующем обновлении.
+                    stats["unsupported"] += 1
+                    continue
+                try:
+                    with open(os.path.join(root_dir, rel_path), "rb") as f:
+                        source = f.read()
+                except OSError:
+                    stats["errors"] += 1
+                    continue
+                digest = _content_hash(source)
+                if previous and previous[2] == digest:
+                    # Файл "тронут", но содержимое то же — обновляем только метаданные.
+                    conn.execute("UPDATE files SET mtime_ns = ?, size = ? WHERE path = ?", (st.st_mtime_ns, st.st_size, rel_path))
+                    stats["touched"] += 1
+                    continue
+                try:
+                    definitions, edges = _index_source(source, language)
+                except Exception:
+                    stats["errors"] += 1
+                    definitions, edges = [], set()
+                conn.execute("DELETE FROM definitions WHERE path = ?", (rel_path,))
+                conn.execute("DELETE FROM calls WHERE path = ?", (rel_path,))
+                conn.executemany("INSERT INTO definitions (path, name, kind, line) VALUES (?, ?, ?, ?)",
+                                 [(rel_path, name, kind, line) for name, kind, line in definitions])
+                conn.executemany("INSERT INTO calls (path, caller, callee) VALUES (?, ?, ?)",
+                                 [(rel_path, caller, callee) for caller, callee in edges])
+                conn.execute("INSERT OR REPLACE INTO files (path, mtime_ns, size, hash, language) VALUES (?, ?, ?, ?, ?)",
+                             (rel_path, st.st_mtime_ns, st.st_size, digest, language))
+                stats["reindexed"] += 1
+
+            for rel_path in known.keys() - seen:
+                conn.execute("DELETE FROM files WHERE path = ?", (rel_path,))
+                conn.execute("DELETE FROM definitions WHERE path = ?", (rel_path,))
+                conn.execute("DELETE FROM calls WHERE path = ?", (rel_path,))
+                stats["removed"] += 1
+
+            if stats["reindexed"] or stats["removed"]:
+                # Поколение индекса: по нему кэш графа вызовов (scan_impact) узнает об изменениях.
+                conn.execute("INSERT INTO meta (key, value) VALUES ('generation', '1') "
+                             "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1")
+    finally:
+        conn.close()
+    return stats
+
+def _normalize_exclude_dirs(exclude_dirs: Union[List[str], str, None]) -> Optional[Set[str]]:
+    if exclude_dirs is None:
+        return None
+    excluded = set(INDEX_SKIP_DIRS)
+    if isinstance(exclude_dirs, list):
+        excluded.update(exclude_dirs)
+    elif isinstance(exclude_dirs, str) and exclude_dirs:
+        excluded.add(exclude_dirs)
+    return excluded
+
+@_async_tool()
+def index_project(
+    root_dir: str,
+    index_path: str = "",
+    exclude_dirs: Union[List[str], str, None] = None
+) -> str:
+    """
+    Builds or refreshes the project-wide symbol and reverse-call index.
+    Args:
+        root_dir: Directory to index (walked recursively; hidden and vendor directories are skipped).
+        index_path: Optional SQLite file for the index. Defaults to a per-project file in EDIT_MATH_INDEX_DIR.
+        exclude_dirs: Directory names to skip besides the vendor ones. Stored with the index and reused by
+            later refreshes (find_callers, scan_impact); omit to keep the stored set.
+    """
+    try:
+        if not os.path.isdir(root_dir):
+            return f"❌ ERROR: '{root_dir}' is not a directory."
+        index_path = index_path or _default_index_path(root_dir)
+        started = time.perf_counter()
+        stats = _update_project_index(root_dir, index_path, _normalize_exclude_dirs(exclude_dirs))
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        return f"""
+        [INDEX UPDATED] {os.path.abspath(root_dir)}
+        --------------------------------
+        Files: {stats['files']} (reindexed: {stats['reindexed']}, unchanged: {stats['unchanged']}, touched: {stats['touched']}, removed: {stats['removed']}, unsupported: {stats['unsupported']}, errors: {stats['errors']})
+        Index: {index_path}
+        Time: {elapsed_ms:.1f} ms
+        """
+    except Exception as e:
+        return f"INTERNAL SERVER ERROR during indexing: {str(e)}\nTraceback: {traceback.format_exc()}"
+
+@_async_tool()
+def find_callers(
+    symbol: str,
+    root_dir: str,
+    index_path: str = "",
+    refresh: bool = False
+) -> str:
+    """
+    Answers "who calls this?" from the project index.
+    The index is built on first use; pass refresh=True to pick up edits made since the last index_project.
+    Args:
+        symbol: Function, method or class name to look up.
+        root_dir: Project directory the index belongs to.
+    """
+    try:
+        index_path = index_path or _default_index_path(root_dir)
+        if refresh or not os.path.exists(index_path):
+            if not os.path.isdir(root_dir):
+                return f"❌ ERROR: '{root_dir}' is not a directory."
+            _update_project_index(root_dir, index_path)
+
+        started = time.perf_counter()
+        conn = _open_index(index_path)
+        try:
+            definitions = conn.execute(
+                "SELECT path, line, kind FROM definitions WHERE name = ? ORDER BY path, line", (symbol,)
+            ).fetchall()
+            callers = conn.execute(
+                "SELECT path, caller FROM calls WHERE callee = ? AND caller != ? ORDER BY path, caller", (symbol, symbol)
+            ).fetchall()
+        finally:
+            conn.close()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        defined_in = [f"{path}:{line} ({kind})" for path, line, kind in definitions]
+        called_by = [f"{caller} @ {path}" for path, caller in callers]
+        return f"""
+        [CALLERS] '{symbol}':
+        --------------------------------
+        Defined In: {', '.join(defined_in) if defined_in else 'None'}
+        Called By ({len(called_by)}): {', '.join(called_by) if called_by else 'None'}
+        Lookup Time: {elapsed_ms:.1f} ms
+        """
+    except Exception as e:
+        return f"INTERNAL SERVER ERROR during lookup: {str(e)}\nTraceback: {traceback.format_exc()}"
+
+# --- АНАЛИЗ ВЛИЯНИЯ (ТРАНЗИТИВНОЕ ЗАМЫКАНИЕ) ---
+# Прямые вызовы не показывают радиус правки: лист, от которого зависят десятки функций,
+# выглядит как "Dependencies: 1". Граф вызовов сжимается в компоненты сильной связности
+# (рекурсивные циклы — один узел), замыкание считается обходом в ширину по DAG компонент:
+# O(V + E) на запрос, результат запоминается для повторных запросов по тому же графу.
+IMPACT_MEMO_ENTRIES = 1024
+IMPACT_MAX_LISTED = 200
+
+def _tarjan_scc(adjacency: List[List[int]]) -> Tuple[List[int], int]:
+    """Iterative Tarjan: component id per node, components numbered in reverse topological order."""
+    count = len(adjacency)
+    order = [-1] * count
+    low = [0] * count
+    on_stack = [False] * count
+    component = [-1] * count
+    stack: List[int] = []
+    counter = components = 0
+    for root in range(count):
+        if order[root] != -1:
+            continue
+        order[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        work = [(root, 0)]
+        while work:
+            node, position = work[-1]
+            children = adjacency[node]
+            if position < len(children):
+                work[-1] = (node, position + 1)
+                child = children[position]
+                if order[child] == -1:
+                    order[child] = low[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack[child] = True
+                    work.append((child, 0))
+                elif on_stack[child] and order[child] < low[node]:
+                    low[node] = order[child]
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                if low[node] < low[parent]:
+                    low[parent] = low[node]
+            if low[node] == order[node]:
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    component[member] = components
+                    if member == node:
+                        break
+                components += 1
+    return component, components
+
+class CallGraph:
+    """Name-level call graph condensed into strongly connected components, with memoized closures."""
+
+    def __init__(self, edges: Set[Tuple[str, str]]):
+        self.ids: Dict[str, int] = {}
+        self.names: List[str] = []
+        adjacency: List[Set[int]] = []
+        for caller, callee in edges:
+            for name in (caller, callee):
+                if name not in self.ids:
+                    self.ids[name] = len(self.names)
+                    self.names.append(name)
+                    adjacency.append(set())
+            adjacency[self.ids[caller]].add(self.ids[callee])
+        self.edge_count = sum(len(children) for children in adjacency)
+        self.component, component_count = _tarjan_scc([list(children) for children in adjacency])
+
+        self.members: List[List[int]] = [[] for _ in range(component_count)]
+        for node, comp in enumerate(self.component):
+            self.members[comp].append(node)
+        successors: List[Set[int]] = [set() for _ in range(component_count)]
+        predecessors: List[Set[int]] = [set() for _ in range(component_count)]
+        for node, children in enumerate(adjacency):
+            source = self.component[node]
+            for child in children:
+                target = self.component[child]
+                if source != target:
+                    successors[source].add(target)
+                    predecessors[target].add(source)
+        self._dag = {"callees": [list(c) for c in successors], "callers": [list(c) for c in predecessors]}
+        self.cycles = [sorted(self.names[n] for n in members) for members in self.members if len(members) > 1]
+        self._memo: "OrderedDict[Tuple[int, str, int], Tuple[List[List[str]], List[List[str]]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.memo_hits = 0
+
+    def cycle_of(self, name: str) -> List[str]:
+        if name not in self.ids:
+            return []
+        members = self.members[self.component[self.ids[name]]]
+        return sorted(self.names[n] for n in members) if len(members) > 1 else []
+
+    def closure(self, name: str, direction: str, max_depth: int = 0) -> Tuple[List[List[str]], List[List[str]]]:
+        """
+        Transitive callees or callers of `name` as layers by distance, plus the recursive cycles reached.
+        Layer 0 holds the other members of name's own cycle; a whole cycle counts as one hop.
+        max_depth <= 0 means unlimited.
+        """
+        if name not in self.ids:
+            return [], []
+        start = self.component[self.ids[name]]
+        key = (start, direction, max(0, max_depth))
+        with self._lock:
+            cached = self._memo.get(key)
+            if cached is not None:
+                self._memo.move_to_end(key)
+                self.memo_hits += 1
+                return cached
+
+        dag = self._dag[direction]
+        seen = {start}
+        frontier = [start]
+        layers: List[List[str]] = [sorted(self.names[n] for n in self.members[start] if self.names[n] != name)]
+        cycles: List[List[str]] = []
+        depth = 0
+        while frontier and (max_depth <= 0 or depth < max_depth):
+            depth += 1
+            next_frontier = []
+            for comp in frontier:
+                for neighbour in dag[comp]:
+                    if neighbour not in seen:
+                        seen.add(neighbour)
+                        next_frontier.append(neighbour)
+            if not next_frontier:
+                break
+            layer: List[str] = []
+            for comp in next_frontier:
+                members = [self.names[n] for n in self.members[comp]]
+                layer.extend(members)
+                if len(members) > 1:
+                    cycles.append(sorted(members))
+            layers.append(sorted(layer))
+            frontier = next_frontier
+
+        result = (layers, cycles)
+        with self._lock:
+            self._memo[key] = result
+            if len(self._memo) > IMPACT_MEMO_ENTRIES:
+                self._memo.popitem(last=False)
+        return result
+
+_PROJECT_GRAPHS: "OrderedDict[str, Tuple[tuple, CallGraph]]" = OrderedDict()
+_PROJECT_GRAPHS_LOCK = threading.Lock()
+PROJECT_GRAPHS_MAX = 8
+
+def _project_call_graph(index_path: str) -> Tuple[CallGraph, bool]:
+    """Call graph of a project index, rebuilt only when the indexed files changed. Returns (graph, was_cached)."""
+    conn = _open_index(index_path)
+    try:
+        # Сумма mtime_ns (~1.7e18 на файл) переполняет INTEGER SQLite уже на шести файлах,
+        # поэтому сигнатура — поколение индекса плюс агрегаты, которые не переполняются.
+        signature = (_index_meta(conn, "generation"),) + tuple(
+            conn.execute("SELECT COUNT(*), MAX(mtime_ns), TOTAL(size) FROM files").fetchone())
+        with _PROJECT_GRAPHS_LOCK:
+            cached = _PROJECT_GRAPHS.get(index_path)
+            if cached is not None and cached[0] == signature:
+                _PROJECT_GRAPHS.move_to_end(index_path)
+                return cached[1], True
+        with METRICS.phase("call_graph"):
+            graph = CallGraph(set(conn.execute("SELECT DISTINCT caller, callee FROM calls")))
+    finally:
+        conn.close()
+    with _PROJECT_GRAPHS_LOCK:
+        _PROJECT_GRAPHS[index_path] = (signature, graph)
+        _PROJECT_GRAPHS.move_to_end(index_path)
+        while len(_PROJECT_GRAPHS) > PROJECT_GRAPHS_MAX:
+            _PROJECT_GRAPHS.popitem(last=False)
+    return graph, False
+
+def _impact_language(language: str, file_path: str, code_bytes: bytes) -> str:
+    lang_lower = language.lower()
+    if lang_lower in ("python", "py"):
+        return "python"
+    if lang_lower in ("ts", "typescript", "tsx"):
+        return "typescript"
+    if lang_lower in ("js", "javascript", "jsx"):
+        return "javascript"
+    detected, _ = _cheap_language(code_bytes, file_path)
+    if detected in ("python", "javascript", "typescript"):
+        return detected
+    try:
+        ast.parse(code_bytes)
+        return "python"
+    except (SyntaxError, ValueError):
+        return "javascript"
+
+def _file_call_graph(code_bytes: bytes, file_path: str, language: str, ignore_custom: List[str]) -> Tuple[CallGraph, bool]:
+    """Call graph of one file, attached to its cached parse tree so unchanged files are not rebuilt."""
+    built = []
+    cache_lang = language
+    if language == "python":
+        tree, index, _, cache_lang = _parse_python_index(code_bytes, file_path)
+    else:
+        tree, _ = _parse_cached(get_parser(language), language, code_bytes, file_path)
+        index = _index_cached(tree, language, file_path, lambda: _build_js_index(tree, language))
+
+    def build() -> CallGraph:
+        built.append(True)
+        with METRICS.phase("call_graph", language):
+            return CallGraph(_index_edges(index, language, ignore_custom)[1])
+
+    if not file_path:
+        return build(), False
+    name = "call_graph:" + ",".join(sorted(ignore_custom))
+    graph = PARSE_CACHE.attachment((os.path.normpath(file_path).lower(), cache_lang), tree, name, build)
+    return graph, not built
+
+def _format_layers(layers: List[List[str]]) -> List[str]:
+    lines, listed = [], 0
+    for depth, layer in enumerate(layers):
+        if not layer:
+            continue
+        shown = layer[:max(0, IMPACT_MAX_LISTED - listed)]
+        listed += len(shown)
+        more = f" (+{len(layer) - len(shown)} more)" if len(shown) < len(layer) else ""
+        label = "same cycle" if depth == 0 else f"depth {depth}"
+        lines.append(f"  {label}: {', '.join(shown)}{more}")
+    return lines or ["  None"]
+
+@_async_tool()
+def scan_impact(
+    target_function: str,
+    file_path: str = "",
+    root_dir: str = "",
+    code: str = "",
+    language: str = "auto",
+    max_depth: int = 0,
+    direction: str = "both",
+    index_path: str = "",
+    refresh: bool = False,
+    ignore_custom: Union[List[str], str, None] = None
+) -> str:
+    """
+    Transitive impact of editing a function: everything it reaches (callees) and everything that reaches it (callers).
+    Recursive cycles are collapsed into single nodes and reported.
+    Args:
+        target_function: Function, method or class name.
+        root_dir: Analyse the whole project through its index (built on first use, like find_callers).
+                  Without it, only `file_path` / `code` is analysed.
+        max_depth: Maximum number of call hops (0 = unlimited). A recursive cycle counts as one hop.
+        direction: "callees", "callers" or "both".
+    """
+    try:
+        if direction not in ("callees", "callers", "both"):
+            return "❌ ERROR: direction must be 'callees', 'callers' or 'both'."
+        normalized_ignore = [ignore_custom] if isinstance(ignore_custom, str) else list(ignore_custom or [])
+        started = time.perf_counter()
+
+        if root_dir:
+            if not os.path.isdir(root_dir):
+                return f"❌ ERROR: '{root_dir}' is not a directory."
+            index_path = index_path or _default_index_path(root_dir)
+            if refresh or not os.path.exists(index_path):
+                _update_project_index(root_dir, index_path)
+            graph, cached = _project_call_graph(index_path)
+            scope = f"project {os.path.abspath(root_dir)}"
+        else:
+            if code:
+                code_bytes = bytes(code, "utf8")
+            elif file_path:
+                code_bytes = SOURCE_CACHE.read(file_path)
+            else:
+                return "❌ ERROR: Provide `root_dir`, `file_path` or `code`."
+            lang_key = _impact_language(language, file_path, code_bytes)
+            if lang_key == "html":
+                return "❌ ERROR: Single-file impact analysis supports Python, JavaScript and TypeScript; pass `root_dir` for HTML handlers."
+            if lang_key != "python" and get_parser(lang_key) is None:
+                return _grammar_unavailable(lang_key)
+            graph, cached = _file_call_graph(code_bytes, file_path, lang_key, normalized_ignore)
+            scope = f"file {file_path or '<code>'} ({lang_key})"
+
+        lines = []
+        for side in (("callees", "callers") if direction == "both" else (direction,)):
+            layers, cycles = graph.closure(target_function, side, max_depth)
+            lines.append(f"Transitive {side.capitalize()} ({sum(len(layer) for layer in layers)}):")
+            lines.extend(_format_layers(layers))
+            if cycles:
+                lines.append("  cycles reached: " + "; ".join(" <-> ".join(cycle) for cycle in cycles))
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        own_cycle = graph.cycle_of(target_function)
+        found = target_function in graph.ids
+        return f"""
+        [IMPACT] '{target_function}' in {scope}:
+        --------------------------------
+        Graph: {len(graph.names)} symbols, {graph.edge_count} call edges, {len(graph.cycles)} recursive cycles collapsed
+        Target In Graph: {found}
+        Recursive Cycle: {' <-> '.join(own_cycle) if own_cycle else 'None'}
+        Max Depth: {max_depth if max_depth > 0 else 'unlimited'}
+        {(chr(10) + "        ").join(lines)}
+        Time: {elapsed_ms:.1f} ms (graph cached: {cached}, memo hits: {graph.memo_hits})
+        """
+    except OSError as e:
+        return f"❌ ERROR: Cannot read '{file_path}': {e}"
     except Exception as e:
-        return f"❌ ERROR: {str(e)}"
+        return f"INTERNAL SERVER ERROR during impact analysis: {str(e)}\nTraceback: {traceback.format_exc()}"
+
+# --- МЕТРИКИ: ИНСТРУМЕНТ И HTTP-ЭНДПОИНТ ---
+def _metric_gauges() -> Dict[str, List[Tuple[Dict[str, Any], float]]]:
+    """Point-in-time values owned by the caches and the executor, folded into the metrics output."""
+    gauges: Dict[str, List[Tuple[Dict[str, Any], float]]] = {"cache": [], "executor": [], "scan_sandbox": []}
+    for cache_name, stats in (("parse", PARSE_CACHE.stats()), ("source", SOURCE_CACHE.stats())):
+        gauges["cache"].extend(({"cache": cache_name, "stat": stat}, value) for stat, value in stats.items())
+    for lane, stats in TOOL_EXECUTOR.stats().items():
+        gauges["executor"].extend(({"lane": lane, "stat": stat}, value) for stat, value in stats.items())
+    gauges["scan_sandbox"].extend(({"stat": stat}, value) for stat, value in SCAN_SANDBOX.stats().items())
+    return gauges
+
+@_async_tool()
+def get_metrics() -> Dict[str, Any]:
+    """
+    Server metrics: per-tool and per-phase latency histograms (seconds), counters for parsed bytes,
+    detected languages, Auto-Wrapper fallbacks, approval state transitions and commits,
+    plus parse cache, source cache, executor and scan sandbox statistics.
+    Collection is disabled with EDIT_MATH_METRICS=0.
+    """
+    snapshot = METRICS.snapshot()
+    snapshot["parse_cache"] = PARSE_CACHE.stats()
+    snapshot["source_cache"] = SOURCE_CACHE.stats()
+    snapshot["executor"] = TOOL_EXECUTOR.stats()
+    snapshot["scan_sandbox"] = SCAN_SANDBOX.stats()
+    snapshot["grammars"] = {"loaded": sorted(_PARSERS), "unavailable": dict(GRAMMAR_ERRORS)}
+    return snapshot
+
+def _register_metrics_route() -> None:
+    from starlette.responses import PlainTextResponse
+
+    @mcp.custom_route("/metrics", methods=["GET"])
+    async def prometheus_metrics(request):
+        body = render_prometheus(METRICS.snapshot(), _metric_gauges())
+        return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
 
 def main():
     import os
     port = os.environ.get("PORT")
     if port:
         print(f"Starting in HTTP mode on port {port}...")
-        mcp.run(transport="sse", port=int(port), host="0.0.0.0")
+        if METRICS.enabled:
+            _register_metrics_route()
+            print(f"Prometheus metrics: http://0.0.0.0:{port}/metrics")
+        # FastMCP берёт адрес из settings, а не из аргументов run().
+        # Защиту от DNS rebinding FastMCP включает только для localhost — на 0.0.0.0 она не нужна.
+        mcp.settings.host = "0.0.0.0"
+        mcp.settings.port = int(port)
+        mcp.settings.transport_security = None
+        mcp.run(transport="sse")
     else:
         mcp.run()
 
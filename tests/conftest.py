@@ -0,0 +1,29 @@
+import os
+import tempfile
+
+# Состояние и индексы тестов — во временном каталоге; сканирование — в процессе теста.
+os.environ.setdefault("EDIT_MATH_CACHE_DIR", tempfile.mkdtemp(prefix="edit-math-tests-"))
+os.environ.setdefault("EDIT_MATH_SCAN_SANDBOX", "0")
+
+import pytest  # noqa: E402
+
+import mcp_edit_math as engine  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def clean_engine():
+    engine.PARSE_CACHE.clear()
+    engine.APPROVAL_STATE.clear()
+    yield
+    engine.APPROVAL_STATE.clear()
+
+
+@pytest.fixture
+def write_file(tmp_path):
+    def write(name: str, content: str) -> str:
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content, encoding="utf-8")
+        return str(path)
+
+    return write
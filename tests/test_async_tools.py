@@ -0,0 +1,70 @@
+import asyncio
+import json
+import threading
+import time
+
+import mcp_edit_math as engine
+
+
+def _call(name: str, arguments: dict) -> str:
+    content, _ = asyncio.run(engine.mcp.call_tool(name, arguments))
+    return content[0].text
+
+
+def test_registered_tool_runs_on_the_io_lane():
+    before = engine.TOOL_EXECUTOR.lanes["io"].completed
+    text = _call("scan_dependencies", {"code": "function a() { b(); }", "target_function": "a",
+                                       "language": "javascript", "format": "json"})
+    assert json.loads(text)["dependencies"] == ["b"]
+    assert engine.TOOL_EXECUTOR.lanes["io"].completed == before + 1
+
+
+def test_lane_bounds_concurrency_and_keeps_the_loop_free():
+    lane = engine._ExecutorLane("test", 2)
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def blocking():
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.1)
+        with lock:
+            running.pop()
+        return True
+
+    async def main():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        tick_task = asyncio.create_task(ticker())
+        results = await asyncio.gather(*(lane.run(engine.TOOL_EXECUTOR._threads, blocking) for _ in range(4)))
+        tick_task.cancel()
+        return results, ticks
+
+    results, ticks = asyncio.run(main())
+    assert results == [True] * 4
+    assert max(peak) <= 2
+    assert lane.stats()["peak_queue_depth"] >= 2
+    # Блокирующие вызовы шли в потоках: цикл событий продолжал тикать.
+    assert ticks >= 5
+
+
+def test_large_scan_is_offloaded_to_the_heavy_lane(monkeypatch):
+    monkeypatch.setattr(engine, "OFFLOAD_SCAN_BYTES", 16)
+    before = engine.TOOL_EXECUTOR.lanes["heavy"].completed
+    try:
+        text = _call("scan_dependencies", {"code": "function a() { b(); c(); }", "target_function": "a",
+                                           "language": "javascript", "format": "json"})
+    finally:
+        pool = engine._BATCH_POOL
+        if pool is not None:
+            engine._discard_batch_pool(pool)
+    assert json.loads(text)["dependencies"] == ["b", "c"]
+    assert engine.TOOL_EXECUTOR.lanes["heavy"].completed == before + 1
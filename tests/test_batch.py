@@ -0,0 +1,59 @@
+import threading
+
+import pytest
+
+import mcp_edit_math as engine
+
+
+@pytest.fixture
+def shared_pool(monkeypatch):
+    monkeypatch.setattr(engine, "BATCH_MAX_WORKERS", 2)
+    yield
+    pool = engine._BATCH_POOL
+    if pool is not None:
+        engine._discard_batch_pool(pool)
+
+
+def _items(write_file, prefix: str, count: int):
+    items = []
+    for i in range(count):
+        path = write_file(f"{prefix}{i}.js", f"function f{i}() {{ g{i}(); }}\n")
+        items.append({"file_path": path, "target_function": f"f{i}", "language": "javascript"})
+    return items
+
+
+def test_results_keep_input_order_and_reset_state(shared_pool, write_file):
+    items = _items(write_file, "a", 3)
+    for item in items:
+        engine.APPROVAL_STATE[engine.get_state_key(item["file_path"], item["target_function"])] = "APPROVED"
+    results = engine.scan_dependencies_batch(items)
+    assert [r["target_function"] for r in results] == ["f0", "f1", "f2"]
+    for i, result in enumerate(results):
+        assert f"Found Dependencies: g{i}" in result["result"]
+        assert engine.APPROVAL_STATE[result["state_key"]] == "NONE"
+
+
+def test_concurrent_batches_of_different_sizes_share_one_pool(shared_pool, write_file):
+    batches = [_items(write_file, "b", 2), _items(write_file, "c", 3), _items(write_file, "d", 4)]
+    results = [None] * len(batches)
+
+    def run(i):
+        results[i] = engine.scan_dependencies_batch(batches[i], max_workers=len(batches[i]))
+
+    pool = engine._get_batch_pool()
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(batches))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(120)
+
+    assert engine._get_batch_pool() is pool
+    for batch, result in zip(batches, results):
+        assert len(result) == len(batch)
+        assert all("error" not in r and "Found Dependencies" in r["result"] for r in result)
+
+
+def test_missing_file_is_reported_per_item(shared_pool, tmp_path):
+    results = engine.scan_dependencies_batch([{"target_function": "x"}, {"file_path": str(tmp_path / "nope.js")}])
+    assert results[0]["error"].startswith("Either")
+    assert results[1]["error"].startswith("Cannot read file")
@@ -0,0 +1,34 @@
+import asyncio
+import os
+
+import pytest
+
+from benchmarks import bench_load
+
+
+def test_percentile_and_recorder():
+    ordered = [float(n) for n in range(1, 101)]
+    assert bench_load._percentile(ordered, 0.50) == pytest.approx(50.5)
+    assert bench_load._percentile(ordered, 0.99) == pytest.approx(99.01)
+    assert bench_load._percentile([3.0], 0.95) == 3.0
+
+    recorder = bench_load.Recorder()
+    recorder.fail("commit_safe_edit", "refused")
+    recorder.fail("scan_dependencies", "later")
+    assert recorder.errors["commit_safe_edit"] == 1 and recorder.first_error == "commit_safe_edit: refused"
+
+
+def test_workspace_gives_every_client_its_own_file(tmp_path):
+    workloads = bench_load._prepare_workspace(str(tmp_path), "small", 5)
+    assert len({w["path"] for w in workloads}) == 5
+    assert all(os.path.isfile(w["path"]) and w["language"] != "html" for w in workloads)
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc"), reason="RSS is read from /proc")
+@pytest.mark.parametrize("transport", bench_load.TRANSPORTS)
+def test_easm_loop_runs_end_to_end(transport):
+    result = asyncio.run(bench_load.run_transport(transport, 2, 1, "small", 0.05, 120))
+    assert result.get("first_error") is None, result["first_error"]
+    assert result["sessions_ok"] == 2 and result["error_rate"] == 0.0
+    assert result["latency"]["commit_safe_edit"]["count"] == 2
+    assert result["rss_peak_kb"] > 0
@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+import mcp_edit_math as engine
+from benchmarks import baseline
+from benchmarks.corpus import SIZE_BUCKETS, all_cases, generate, parse_case_id, target_for
+
+
+@pytest.mark.parametrize("case", all_cases(["small"]), ids=lambda case: case.case_id)
+def test_small_corpus_is_deterministic_and_scannable(case):
+    source = generate(case)
+    assert source == generate(case)
+    assert SIZE_BUCKETS["small"] * 0.9 <= len(source.encode()) < SIZE_BUCKETS["small"] * 2
+    assert parse_case_id(case.case_id) == case
+
+    result = json.loads(engine.scan_dependencies(source, target_for(case), "", case.language, format="json"))
+    assert result["ok"], result
+
+
+def test_compare_flags_only_real_regressions():
+    previous = {"a": {"scan_s": 0.100, "rss_mb": 100.0}, "b": {"scan_s": 0.001}}
+    current = {"a": {"scan_s": 0.200, "rss_mb": 110.0}, "b": {"scan_s": 0.004}, "c": {"scan_s": 9.0}}
+    regressions = baseline.compare(current, previous, ["scan_s"], 1.25, 0.005, ["rss_mb"], 1.2)
+    # b: рост в 4 раза, но меньше порога шума; c: нет в базовой линии.
+    assert len(regressions) == 1 and regressions[0].startswith("a: scan_s")
+
+    regressions = baseline.compare({"a": {"rss_mb": 130.0}}, previous, ["scan_s"], 1.25, 0.005, ["rss_mb"], 1.2)
+    assert len(regressions) == 1 and "rss_mb" in regressions[0]
+
+
+def test_memory_noise_floor_is_absolute_and_per_metric():
+    previous = {"a": {"index_kb": 10, "peak_rss_kb": 50000}}
+    current = {"a": {"index_kb": 30, "peak_rss_kb": 70000}}
+    floor = {"index_kb": 64, "peak_rss_kb": 4096}
+    # index_kb вырос в 3 раза, но на 20 КБ — это шум; peak_rss_kb вырос на 20 МБ.
+    regressions = baseline.compare(current, previous, [], 1.25, 0.005, ["index_kb", "peak_rss_kb"], 1.2, floor)
+    assert len(regressions) == 1 and "peak_rss_kb" in regressions[0]
+
+
+def test_scan_gate_skips_allocation_block_counts():
+    from benchmarks import bench_scan
+    assert "index_blocks" not in bench_scan.MEMORY_METRICS
+    assert set(bench_scan.MEMORY_NOISE_FLOOR_KB) == set(bench_scan.MEMORY_METRICS)
+
+
+def test_update_baseline_keeps_other_cases(tmp_path):
+    path = str(tmp_path / "baseline.json")
+    baseline.update_baseline(path, {"a": {"scan_s": 1.0}})
+    baseline.update_baseline(path, {"b": {"scan_s": 2.0}})
+    assert baseline.load_baseline(path) == {"a": {"scan_s": 1.0}, "b": {"scan_s": 2.0}}
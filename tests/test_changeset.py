@@ -0,0 +1,147 @@
+import multiprocessing
+
+import mcp_edit_math as engine
+
+A = "function a() {\n  b();\n}\n"
+B = "function b() {\n  return 1;\n}\n"
+
+
+def _open(paths):
+    opened = engine.open_changeset([{"file_path": path, "target_function": target} for path, target in paths])
+    assert "error" not in opened, opened
+    return opened["changeset_id"]
+
+
+def _approve(changeset_id, paths):
+    evaluations = [{"file_path": path, "target_function": target, "dependencies": [], "verified_dependencies": []}
+                   for path, target in paths]
+    assert "allowed" in engine.evaluate_changeset(changeset_id, evaluations)
+
+
+def test_changeset_commits_all_files_once(write_file):
+    paths = [(write_file("a.js", A), "a"), (write_file("b.js", B), "b")]
+    changeset_id = _open(paths)
+    assert "SECURITY BLOCK" in engine.commit_changeset(changeset_id, [{"file_path": paths[0][0], "full_file_content": "x"}])
+
+    _approve(changeset_id, paths)
+    edits = [{"file_path": paths[0][0], "full_file_content": A.replace("b()", "c()")},
+             {"file_path": paths[1][0], "full_file_content": B.replace("1", "2")}]
+    assert "2 file(s)" in engine.commit_changeset(changeset_id, edits)
+    assert "c()" in open(paths[0][0]).read() and "return 2" in open(paths[1][0]).read()
+    assert "SECURITY BLOCK" in engine.commit_changeset(changeset_id, edits)
+
+
+def test_failed_edit_writes_nothing(write_file):
+    paths = [(write_file("a.js", A), "a"), (write_file("b.js", B), "b")]
+    changeset_id = _open(paths)
+    _approve(changeset_id, paths)
+    edits = [{"file_path": paths[0][0], "full_file_content": "changed"},
+             {"file_path": paths[1][0], "patch": "@@ -1 +1 @@\n-nope\n+yes\n"}]
+    assert "nothing was written" in engine.commit_changeset(changeset_id, edits)
+    assert open(paths[0][0]).read() == A
+
+
+def test_rescanning_a_member_revokes_the_changeset(write_file):
+    paths = [(write_file("a.js", A), "a"), (write_file("b.js", B), "b")]
+    changeset_id = _open(paths)
+    _approve(changeset_id, paths)
+    engine.scan_dependencies("", "b", paths[1][0])
+    assert engine.APPROVAL_STATE[engine._changeset_state_key(changeset_id)] == "NONE"
+    edits = [{"file_path": paths[1][0], "full_file_content": "x"}]
+    assert "SECURITY BLOCK" in engine.commit_changeset(changeset_id, edits)
+
+    _approve(changeset_id, paths)
+    engine.scan_dependencies_batch([{"file_path": paths[0][0], "target_function": "a"}])
+    assert "SECURITY BLOCK" in engine.commit_changeset(changeset_id, edits)
+
+
+def test_oldest_link_over_the_cap_is_revoked(write_file, monkeypatch):
+    monkeypatch.setattr(engine, "CHANGESETS_PER_TARGET", 1)
+    a, b = write_file("a.js", A), write_file("b.js", B)
+    first = _open([(a, "a")])
+    _approve(first, [(a, "a")])
+    _open([(a, "a"), (b, "b")])
+    assert engine.APPROVAL_STATE[engine._changeset_state_key(first)] == "NONE"
+
+
+def _open_in_process(state_path, a, b, queue):
+    engine.APPROVAL_STATE = engine.SQLiteStateBackend(state_path)
+    changeset_id = _open([(a, "a"), (b, "b")])
+    _approve(changeset_id, [(a, "a"), (b, "b")])
+    queue.put(changeset_id)
+
+
+def test_sqlite_changeset_is_shared_between_processes(write_file, tmp_path, monkeypatch):
+    state_path = str(tmp_path / "state.sqlite")
+    a, b = write_file("a.js", A), write_file("b.js", B)
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_open_in_process, args=(state_path, a, b, queue))
+    process.start()
+    changeset_id = queue.get(timeout=120)
+    process.join(60)
+    assert process.exitcode == 0
+
+    monkeypatch.setattr(engine, "APPROVAL_STATE", engine.SQLiteStateBackend(state_path))
+    assert engine._changeset_members(changeset_id) is not None
+    # Повторное сканирование в этом процессе отзывает одобрение, выданное в другом.
+    engine.scan_dependencies("", "a", a)
+    assert "SECURITY BLOCK" in engine.commit_changeset(changeset_id, [{"file_path": a, "full_file_content": "x"}])
+    _approve(changeset_id, [(a, "a"), (b, "b")])
+    assert "1 file(s)" in engine.commit_changeset(changeset_id, [{"file_path": a, "full_file_content": "x"}])
+
+
+def test_unknown_changeset_is_rejected():
+    assert "Unknown changeset" in engine.evaluate_changeset("deadbeef", [])
+    assert "Unknown changeset" in engine.commit_changeset("deadbeef", [])
+
+
+def test_member_rescan_during_evaluation_is_not_overwritten(write_file, monkeypatch):
+    paths = [(write_file("a.js", A), "a"), (write_file("b.js", B), "b")]
+    changeset_id = _open(paths)
+    state_key = engine._changeset_state_key(changeset_id)
+    read = engine.APPROVAL_STATE.get
+
+    def get_then_rescan(key, default="NONE"):
+        state = read(key, default)
+        if key == state_key:
+            engine.APPROVAL_STATE.set(state_key, "NONE")
+        return state
+
+    engine.APPROVAL_STATE[state_key] = "APPROVED"
+    monkeypatch.setattr(engine.APPROVAL_STATE, "get", get_then_rescan)
+    evaluations = [{"file_path": path, "target_function": target, "dependencies": [], "verified_dependencies": []}
+                   for path, target in paths]
+    assert "changed during this call" in engine.evaluate_changeset(changeset_id, evaluations)
+    monkeypatch.undo()
+    assert engine.APPROVAL_STATE[state_key] == "NONE"
+
+
+def test_changeset_id_is_normalized_once(write_file):
+    paths = [(write_file("a.js", A), "a")]
+    changeset_id = _open(paths)
+    _approve(f"  {changeset_id}\n", paths)
+    assert engine.APPROVAL_STATE[engine._changeset_state_key(changeset_id)] == "APPROVED"
+    edits = [{"file_path": paths[0][0], "full_file_content": "x"}]
+    assert "1 file(s)" in engine.commit_changeset(f" {changeset_id} ", edits)
+
+
+def test_failed_changeset_write_keeps_a_concurrent_revocation(write_file, monkeypatch):
+    paths = [(write_file("a.js", A), "a"), (write_file("b.js", B), "b")]
+    changeset_id = _open(paths)
+    _approve(changeset_id, paths)
+    replace = engine.os.replace
+
+    def rescan_then_fail(src, dst):
+        if dst == paths[1][0]:
+            engine._reset_scan_state(engine.get_state_key(*paths[1]))
+            engine.APPROVAL_STATE[engine._changeset_state_key(changeset_id)] = "PENDING"
+            raise OSError("disk full")
+        return replace(src, dst)
+
+    monkeypatch.setattr(engine.os, "replace", rescan_then_fail)
+    edits = [{"file_path": path, "full_file_content": "x"} for path, _ in paths]
+    assert "were restored" in engine.commit_changeset(changeset_id, edits)
+    monkeypatch.undo()
+    assert open(paths[0][0]).read() == A
+    assert engine.APPROVAL_STATE[engine._changeset_state_key(changeset_id)] == "PENDING"
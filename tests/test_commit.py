@@ -0,0 +1,108 @@
+import difflib
+import os
+
+import pytest
+
+import mcp_edit_math as engine
+
+ORIGINAL = "function a() {\n  b();\n}\n\nfunction b() {\n  return 1;\n}\n"
+
+
+def _diff(old: str, new: str) -> str:
+    return "".join(difflib.unified_diff(old.splitlines(True), new.splitlines(True), "a/f.js", "b/f.js"))
+
+
+def _approve(path: str, target: str = "a") -> None:
+    engine.APPROVAL_STATE[engine.get_state_key(path, target)] = "APPROVED"
+
+
+def test_unified_diff_applies_and_relocates_hunks():
+    new = ORIGINAL.replace("return 1", "return 2")
+    patch = _diff(ORIGINAL, new)
+    assert engine._apply_unified_diff(ORIGINAL, patch) == new
+    # Хунк ищется рядом, если над ним добавились строки.
+    shifted = "// header\n// more\n" + ORIGINAL
+    assert engine._apply_unified_diff(shifted, patch) == "// header\n// more\n" + new
+
+
+def test_unified_diff_keeps_crlf_and_missing_final_newline():
+    original = "one\r\ntwo"
+    patch = "@@ -1,2 +1,2 @@\n one\n-two\n+three\n\\ No newline at end of file\n"
+    assert engine._apply_unified_diff(original, patch) == "one\r\nthree"
+
+
+@pytest.mark.parametrize("patch", ["", "@@ nonsense @@\n", "@@ -1,3 +1,3 @@\n function a() {\n", "@@ -1 +1 @@\n-nope\n+yes\n"])
+def test_bad_patches_are_rejected(patch):
+    with pytest.raises(engine.PatchError):
+        engine._apply_unified_diff(ORIGINAL, patch)
+
+
+def test_range_replacements():
+    replaced = engine._apply_range_replacements(ORIGINAL, [
+        {"start_line": 2, "end_line": 2, "text": "  c();\n  b();"},
+        {"start_line": 5, "end_line": 4, "text": "// b"},
+    ])
+    assert replaced == "function a() {\n  c();\n  b();\n}\n\n// b\nfunction b() {\n  return 1;\n}\n"
+    with pytest.raises(engine.PatchError):
+        engine._apply_range_replacements(ORIGINAL, [{"start_line": 1, "end_line": 2}, {"start_line": 2, "end_line": 3}])
+    with pytest.raises(engine.PatchError):
+        engine._apply_range_replacements(ORIGINAL, [{"start_line": 9, "end_line": 9}])
+
+
+def test_commit_requires_approval_and_consumes_it(write_file):
+    path = write_file("f.js", ORIGINAL)
+    edit = [{"start_line": 6, "end_line": 6, "text": "  return 2;"}]
+    assert "SECURITY BLOCK" in engine.commit_safe_edit("a", path, replacements=edit)
+
+    _approve(path)
+    assert "SAFE COMMIT" in engine.commit_safe_edit("a", path, replacements=edit)
+    assert "return 2" in open(path, encoding="utf-8").read()
+    assert engine.APPROVAL_STATE[engine.get_state_key(path, "a")] == "NONE"
+    assert "SECURITY BLOCK" in engine.commit_safe_edit("a", path, replacements=edit)
+
+
+def test_stale_base_hash_is_refused(write_file):
+    path = write_file("f.js", ORIGINAL)
+    base_hash = engine._file_hash(ORIGINAL.encode())
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("// concurrent edit\n")
+    _approve(path)
+    result = engine.commit_safe_edit("a", path, full_file_content="x", base_hash=base_hash)
+    assert result.startswith("❌ ERROR")
+    assert open(path, encoding="utf-8").read().endswith("// concurrent edit\n")
+    assert engine.APPROVAL_STATE[engine.get_state_key(path, "a")] == "APPROVED"
+
+
+def test_patch_commit_reports_transferred_bytes(write_file):
+    path = write_file("f.js", ORIGINAL)
+    new = ORIGINAL.replace("b();", "b(); c();")
+    patch = _diff(ORIGINAL, new)
+    _approve(path)
+    result = engine.commit_safe_edit("a", path, patch=patch, base_hash=engine._file_hash(ORIGINAL.encode()))
+    assert f"Mode: patch | Bytes transferred: {len(patch.encode())} | Bytes written: {len(new.encode())}" in result
+    assert f"NEW BASE HASH: {engine._file_hash(new.encode())}" in result
+    assert open(path, encoding="utf-8").read() == new
+
+
+def test_failed_write_leaves_the_file_and_the_approval(write_file, monkeypatch, tmp_path):
+    path = write_file("f.js", ORIGINAL)
+    _approve(path)
+
+    def failing_replace(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(engine.os, "replace", failing_replace)
+    result = engine.commit_safe_edit("a", path, full_file_content="broken")
+    monkeypatch.undo()
+
+    assert "disk full" in result
+    assert open(path, encoding="utf-8").read() == ORIGINAL
+    assert os.listdir(tmp_path) == ["f.js"]
+    assert engine.APPROVAL_STATE[engine.get_state_key(path, "a")] == "APPROVED"
+
+
+def test_commit_needs_exactly_one_edit_form(write_file):
+    path = write_file("f.js", ORIGINAL)
+    _approve(path)
+    assert "exactly one" in engine.commit_safe_edit("a", path, full_file_content="x", patch="@@ -1 +1 @@\n")
+    assert engine.APPROVAL_STATE[engine.get_state_key(path, "a")] == "APPROVED"
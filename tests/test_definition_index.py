@@ -0,0 +1,45 @@
+import json
+
+import mcp_edit_math as engine
+
+JS = "function a() { b(); }\nfunction b() { c(); d(); }\nclass K { m() { this.a(); } }\n"
+PY = "def a():\n    b()\n\nclass K:\n    def m(self):\n        a()\n"
+
+
+def test_one_index_answers_every_target(write_file, monkeypatch):
+    path = write_file("a.js", JS)
+    builds = []
+    build = engine._build_js_index
+    monkeypatch.setattr(engine, "_build_js_index", lambda *args, **kwargs: builds.append(1) or build(*args, **kwargs))
+
+    answers = {target: json.loads(engine.scan_dependencies("", target, path, "javascript", format="json"))["dependencies"]
+               for target in ("a", "b", "m")}
+    assert answers == {"a": ["b"], "b": ["c", "d"], "m": ["a"]}
+    assert len(builds) == 1
+
+
+def test_all_targets_for_javascript(write_file):
+    path = write_file("a.js", JS)
+    result = json.loads(engine.scan_dependencies("", engine.ALL_TARGETS, path, "javascript", format="json"))
+    assert result["target_fields"] == list(engine.ALL_TARGETS_FIELDS)
+    rows = {row[0]: row for row in result["targets"]}
+    assert rows["a"] == ["a", "function_declaration", 1, "b"]
+    assert rows["b"][3] == "c,d"
+    assert rows["m"][3] == "a"
+
+
+def test_all_targets_for_python_text_report(write_file):
+    path = write_file("a.py", PY)
+    report = engine.scan_dependencies("", engine.ALL_TARGETS, path, "python")
+    assert "Targets: 3" in report
+    assert "a (FunctionDef, line 1): b" in report
+    assert "m (FunctionDef, line 5): a" in report
+
+
+def test_index_is_rebuilt_after_an_edit(write_file):
+    path = write_file("a.js", JS)
+    engine.scan_dependencies("", "a", path, "javascript")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(JS.replace("b(); }", "e(); }", 1))
+    result = json.loads(engine.scan_dependencies("", "a", path, "javascript", format="json"))
+    assert result["dependencies"] == ["e"]
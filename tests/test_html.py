@@ -0,0 +1,49 @@
+import mcp_edit_math as engine
+
+PAGE = """<!doctype html>
+<html><head>
+<script src="app.js"></script>
+<script src></script>
+<script>init(); console.log(1);</script>
+<script lang="ts">const n: number = typed();</script>
+</head>
+<body><button onclick="save(event)">Save</button><div onmouseover="hover()"></div></body></html>
+"""
+
+
+def _scan(path: str, **kwargs) -> str:
+    return engine.scan_dependencies("", "ENTIRE_FILE", path, "html", **kwargs)
+
+
+def test_single_page_report(write_file):
+    report = _scan(write_file("page.html", PAGE))
+    deps = report.split("Found Dependencies: ", 1)[1].splitlines()[0]
+    assert deps.split(", ") == sorted(["CALL: init", "CALL: typed", "EVENT: hover", "EVENT: save", "FILE: app.js"])
+
+
+def test_script_src_without_a_value_is_ignored(write_file):
+    report = _scan(write_file("page.html", "<script src></script><script src=\"\"></script>"))
+    assert "FILE:" not in report
+
+
+def test_resolve_scripts_merges_local_files(write_file):
+    write_file("app.js", "function save(e) { persist(e); }\n")
+    report = _scan(write_file("page.html", PAGE), resolve_scripts=True)
+    assert "CALL: persist" in report
+    assert "Handler save: defined in app.js" in report
+    assert "Handler hover: not defined on this page" in report
+
+
+def test_resolve_scripts_stays_in_the_page_directory(tmp_path, write_file):
+    write_file("secret.js", "function leaked() { token(); }\n")
+    page_dir = tmp_path / "site"
+    page = write_file("site/page.html", '<script src="../secret.js"></script><script src="/../secret.js"></script>')
+    (page_dir / "link.js").symlink_to(tmp_path / "secret.js")
+    with open(page, "a", encoding="utf-8") as f:
+        f.write('<script src="link.js"></script>')
+
+    report = _scan(page, resolve_scripts=True)
+    assert "token" not in report
+    assert "Not resolved: ../secret.js" in report
+    assert "Not resolved: link.js" in report
+    assert engine._local_script_path(str(page_dir), "../secret.js") is None
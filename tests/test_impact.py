@@ -0,0 +1,51 @@
+import os
+
+import mcp_edit_math as engine
+
+CODE = "function a() { b(); }\nfunction b() { c(); a(); }\nfunction c() { d(); }\nfunction d() {}\nfunction e() { a(); }\n"
+
+
+def test_cycles_are_collapsed_and_depth_is_limited():
+    report = engine.scan_impact("a", code=CODE, language="javascript")
+    assert "Recursive Cycle: a <-> b" in report
+    assert "depth 1: c" in report and "depth 2: d" in report
+    assert "depth 1: e" in report
+
+    limited = engine.scan_impact("a", code=CODE, language="javascript", max_depth=1, direction="callees")
+    assert "depth 2" not in limited
+    assert "Transitive Callers" not in limited
+
+
+def test_project_mode_with_many_files(tmp_path, write_file):
+    # Больше пяти файлов: сумма mtime_ns в наносекундах уже не помещается в INTEGER SQLite.
+    for i in range(12):
+        write_file(f"src/m{i}.js", f"function f{i}() {{ f{i + 1}(); }}\n")
+    index_path = str(tmp_path / "index.sqlite")
+    root = str(tmp_path)
+
+    report = engine.scan_impact("f5", root_dir=root, index_path=index_path)
+    assert "ERROR" not in report
+    assert "depth 1: f6" in report and "depth 7: f12" in report
+    assert "depth 5: f0" in report
+    assert "graph cached: False" in report
+    assert "graph cached: True" in engine.scan_impact("f5", root_dir=root, index_path=index_path)
+
+
+def test_project_graph_is_rebuilt_after_reindexing(tmp_path, write_file):
+    for i in range(8):
+        write_file(f"m{i}.js", f"function f{i}() {{ f{i + 1}(); }}\n")
+    index_path = str(tmp_path / "index.sqlite")
+    root = str(tmp_path)
+    engine.scan_impact("f0", root_dir=root, index_path=index_path)
+
+    path = write_file("m3.js", "function f3() { other(); }\n")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    report = engine.scan_impact("f0", root_dir=root, index_path=index_path, refresh=True)
+    assert "graph cached: False" in report
+    assert "depth 3: f3" in report and "depth 4: other" in report
+    assert "f4" not in report
+
+
+def test_bad_direction_is_rejected():
+    assert engine.scan_impact("a", code=CODE, direction="up").lstrip().startswith("❌ ERROR")
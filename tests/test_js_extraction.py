@@ -0,0 +1,37 @@
+import json
+
+import mcp_edit_math as engine
+
+
+def _deps(code: str, target: str, language: str):
+    return json.loads(engine.scan_dependencies(code, target, "", language, format="json"))["dependencies"]
+
+
+def test_method_calls_skip_builtins_and_globals():
+    code = "class A { run() { this.step(); helper(); console.log(1); [1].map(x => x); } step() {} }\nfunction helper() {}\n"
+    assert _deps(code, "run", "javascript") == ["helper", "step"]
+
+
+def test_arrow_function_declarator_in_typescript():
+    code = "const load = async <T>(x: T): Promise<T> => { return fetchData<T>(x); };\n"
+    assert _deps(code, "load", "typescript") == ["fetchData"]
+
+
+def test_ignore_custom_is_applied():
+    code = "function a() { b(); track(); }\n"
+    result = json.loads(engine.scan_dependencies(code, "a", "", "javascript", ignore_custom=["track"], format="json"))
+    assert result["dependencies"] == ["b"]
+
+
+def test_deep_nesting_does_not_recurse_in_python():
+    depth = 3000
+    code = "function outer() {" + "(function(){" * depth + "inner();" + "})();" * depth + "}"
+    assert _deps(code, "outer", "javascript") == ["inner"]
+
+    tree = engine.get_parser("javascript").parse(code.encode())
+    assert sum(1 for _ in engine._iter_nodes(tree.root_node)) > depth
+
+
+def test_missing_target_is_reported():
+    report = engine.scan_dependencies("function a() {}\n", "nope", "", "javascript")
+    assert "not found" in report.lower()
@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+import mcp_edit_math as engine
+
+CODE = "function a() {\n  b();\n}\n\nfunction b() {\n  return 1;\n}\n"
+
+
+def _json(text: str) -> dict:
+    payload = json.loads(text)
+    # Компактно: без отступов и пробелов после разделителей.
+    assert text == json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+    return payload
+
+
+def test_scan_json_is_compact_and_logs_only_with_debug(write_file):
+    path = write_file("f.js", CODE)
+    result = _json(engine.scan_dependencies("", "a", path, format="json"))
+    assert result["ok"] and result["state"] == "NONE" and result["dependencies"] == ["b"]
+    assert result["base_hash"] == engine._file_hash(CODE.encode())
+    assert result["detected_by"] == "extension" and "logs" not in result and result["elapsed_ms"] >= 0
+    assert _json(engine.scan_dependencies("", "a", path, format="json", debug=True))["logs"]
+
+
+def test_all_targets_json_uses_rows(write_file):
+    path = write_file("f.js", CODE)
+    result = _json(engine.scan_dependencies("", engine.ALL_TARGETS, path, format="json"))
+    assert result["target_fields"] == list(engine.ALL_TARGETS_FIELDS)
+    assert ["a", "function_declaration", 1, "b"] in result["targets"]
+
+
+def test_scan_error_json():
+    result = _json(engine.scan_dependencies("", "a", "/nonexistent/f.js", format="json"))
+    assert not result["ok"] and result["error"].startswith("Cannot read")
+
+
+def test_score_json_walks_the_state_machine():
+    args = dict(target_function="a", dependencies=["b"], verified_dependencies=["b"], file_path="f.js",
+                proposed_header="renamed", format="json")
+    first = _json(engine.calculate_integrity_score(**args))
+    assert first["state"] == "PENDING" and first["action"] == "ask_user" and first["reasons"]
+    assert _json(engine.calculate_integrity_score(**args, user_last_message="sure"))["error"]
+    granted = _json(engine.calculate_integrity_score(**args, user_last_message="ok"))
+    assert granted == {"ok": True, "state": "APPROVED", "scope": engine.get_state_key("f.js", "a"), "score": 1.0,
+                       "confirmed": True, "elapsed_ms": granted["elapsed_ms"]}
+
+
+def test_commit_json_success_and_refusal(write_file):
+    path = write_file("f.js", CODE)
+    blocked = _json(engine.commit_safe_edit("a", path, full_file_content="x", format="json"))
+    assert blocked["ok"] is False and blocked["outcome"] == "blocked" and not blocked["error"].startswith("⛔")
+
+    engine.APPROVAL_STATE[engine.get_state_key(path, "a")] = "APPROVED"
+    new = CODE.replace("b();", "b(); c();")
+    result = _json(engine.commit_safe_edit("a", path, full_file_content=new, format="json", verify=True))
+    assert result["ok"] and result["outcome"] == "committed" and result["mode"] == "full"
+    assert result["base_hash"] == engine._file_hash(new.encode()) and result["bytes_written"] == len(new)
+    assert any("NEW CALLEES" in line for line in result["verification"])
+
+
+@pytest.mark.parametrize("call", [
+    lambda: engine.scan_dependencies("function a() {}", "a", "", format="xml"),
+    lambda: engine.calculate_integrity_score("a", [], [], format="xml"),
+    lambda: engine.commit_safe_edit("a", "f.js", full_file_content="x", format="xml"),
+])
+def test_unknown_format_is_rejected(call):
+    assert call().startswith("❌ ERROR: Unknown format 'xml'")
@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+import mcp_edit_math as engine
+
+
+def _scan(code: str, target: str = "ENTIRE_FILE", path: str = "") -> dict:
+    return json.loads(engine.scan_dependencies(code, target, path, format="json"))
+
+
+def test_auto_detected_target_without_dependencies_runs_the_wrapper():
+    # Дерево строится при определении языка; Auto-Wrapper все равно получает парсер.
+    report = engine.scan_dependencies("function foo(){ return 1 }", "foo", "")
+    assert "INTERNAL SERVER ERROR" not in report
+    assert "Auto-Detected JS" in report and "Found Dependencies: None" in report
+
+    result = _scan("function foo(){ return 1 }", "foo")
+    assert result["ok"] and result["dependencies"] == [] and result["wrapper"] is False
+
+
+@pytest.mark.parametrize("code, path, language, method", [
+    ("# -*- coding: utf-8 -*-\nx = 1\n", "", "python", "pragma"),
+    ("<!DOCTYPE html><html></html>", "", "html", "sniff"),
+    ("def a():\n    b()\n", "", "python", "sniff"),
+    ("function a() { b(); }", "", "javascript", "sniff"),
+    ("function a() { b(); }", "m.js", "javascript", "extension"),
+    ("def a():\n    b()\n", "m.py", "python", "extension"),
+])
+def test_cheap_detection(code, path, language, method):
+    result = _scan(code, path=path)
+    assert (result["language"], result["detected_by"]) == (language, method)
+
+
+def test_typescript_in_a_js_file_is_ambiguous(write_file):
+    code = "function a(x: number): number { return b(x); }\n"
+    path = write_file("m.js", code)
+    result = _scan(code, "a", path)
+    assert result["error"] == "ambiguous_language"
+
+
+def test_detection_is_cached_per_file_and_content(write_file):
+    code = "function a() { b(); }\n"
+    path = write_file("m.txt", code)
+    assert _scan(code, "a", path)["dependencies"] == ["b"]
+    key = engine.os.path.normpath(path).lower()
+    assert engine._DETECTIONS[key] == (engine._file_hash(code.encode()), "javascript", "sniff")
+
+    edited = "def a():\n    b()\n"
+    assert _scan(edited, "a", path)["language"] == "python"
+    assert engine._DETECTIONS[key][1] == "python"
@@ -0,0 +1,55 @@
+import asyncio
+
+import mcp_edit_math as engine
+
+
+def test_counters_histograms_and_drain_merge():
+    registry = engine.MetricsRegistry()
+    registry.inc("scans_total", language="python")
+    registry.inc("scans_total", 2, language="python")
+    with registry.phase("parse", "python"):
+        pass
+    registry.observe("tool_duration_seconds", 0.3, tool="scan")
+
+    snapshot = registry.snapshot()
+    assert snapshot["counters"]["scans_total"] == [{"labels": {"language": "python"}, "value": 3}]
+    histogram = snapshot["histograms"]["tool_duration_seconds"][0]
+    assert histogram["count"] == 1 and histogram["buckets"]["0.25"] == 0 and histogram["buckets"]["0.5"] == 1
+
+    parent = engine.MetricsRegistry()
+    parent.inc("scans_total", language="python")
+    parent.merge(registry.drain())
+    assert registry.snapshot()["counters"] == {}
+    assert parent.snapshot()["counters"]["scans_total"][0]["value"] == 4
+    assert parent.snapshot()["histograms"]["phase_duration_seconds"][0]["count"] == 1
+
+
+def test_disabled_registry_records_nothing():
+    registry = engine.MetricsRegistry(enabled=False)
+    registry.inc("scans_total")
+    with registry.timer("x"):
+        pass
+    assert registry.snapshot()["counters"] == {} and registry.snapshot()["histograms"] == {}
+
+
+def test_prometheus_rendering():
+    registry = engine.MetricsRegistry()
+    registry.inc("commits_total", mode="patch", outcome='we"ird')
+    registry.observe("tool_duration_seconds", 0.002, tool="scan")
+    text = engine.render_prometheus(registry.snapshot(), {"cache": [({"cache": "parse", "stat": "hits"}, 3)]})
+    assert "# TYPE edit_math_commits_total counter" in text
+    assert 'edit_math_commits_total{mode="patch",outcome="we\\"ird"} 1' in text
+    assert 'edit_math_tool_duration_seconds_bucket{tool="scan",le="0.0025"} 1' in text
+    assert 'edit_math_tool_duration_seconds_count{tool="scan"} 1' in text
+    assert 'edit_math_cache{cache="parse",stat="hits"} 3' in text
+
+
+def test_tool_calls_are_measured():
+    asyncio.run(engine.mcp.call_tool("scan_dependencies", {"code": "function a() { b(); }", "target_function": "a",
+                                                           "language": "javascript"}))
+    snapshot = engine.get_metrics()
+    tools = {entry["labels"]["tool"] for entry in snapshot["histograms"]["tool_duration_seconds"]}
+    assert "scan_dependencies" in tools
+    phases = {entry["labels"]["phase"] for entry in snapshot["histograms"]["phase_duration_seconds"]}
+    assert {"parse", "index"} <= phases
+    assert "parse_cache" in snapshot and "executor" in snapshot
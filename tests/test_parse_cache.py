@@ -0,0 +1,79 @@
+import json
+
+import mcp_edit_math as engine
+
+SOURCE = b"function a() { b(); }\nfunction b() { return 1; }\n"
+
+
+def _parse(cache, key, source):
+    parser = engine.get_parser("javascript")
+    return cache.parse(key, source, lambda src, old: engine._ts_parse(parser, src, old),
+                       lambda src, tree: engine._ts_copy(parser, src, tree))
+
+
+def test_statuses_follow_content():
+    cache = engine.ParseTreeCache(1 << 30)
+    key = ("a.js", "javascript")
+    assert _parse(cache, key, SOURCE)[1] == "miss"
+    assert _parse(cache, key, SOURCE)[1] == "hit"
+    edited = SOURCE.replace(b"return 1", b"return 2")
+    tree, status = _parse(cache, key, edited)
+    assert status == "incremental"
+    assert tree.root_node.text == edited
+    assert not engine.has_syntax_errors(tree)
+
+
+def test_incremental_reparse_leaves_the_cached_tree_intact():
+    cache = engine.ParseTreeCache(1 << 30)
+    key = ("a.js", "javascript")
+    old_tree, _ = _parse(cache, key, SOURCE)
+    second = old_tree.root_node.children[1]
+    start, end = second.start_byte, second.end_byte
+
+    _parse(cache, key, b"// inserted line\n" + SOURCE)
+
+    # Дерево, которое мог держать другой поток, не сдвинуто правкой.
+    assert old_tree.root_node.end_byte == len(SOURCE)
+    assert (old_tree.root_node.children[1].start_byte, old_tree.root_node.children[1].end_byte) == (start, end)
+
+
+def test_budget_charges_tree_and_attachment_estimates():
+    cache = engine.ParseTreeCache(1 << 30)
+    key = ("a.js", "javascript")
+    tree, _ = _parse(cache, key, SOURCE)
+    assert cache.stats()["bytes"] == len(SOURCE) * (1 + engine.TREE_BYTES_PER_SOURCE_BYTE)
+    cache.attachment(key, tree, "definitions", lambda: object())
+    assert cache.stats()["bytes"] == len(SOURCE) * (1 + engine.TREE_BYTES_PER_SOURCE_BYTE + engine.ATTACHMENT_BYTES_PER_SOURCE_BYTE)
+
+
+def test_budget_and_entry_cap_evict_oldest():
+    per_entry = len(SOURCE) * (1 + engine.TREE_BYTES_PER_SOURCE_BYTE)
+    cache = engine.ParseTreeCache(per_entry * 2)
+    for name in ("a.js", "b.js", "c.js"):
+        _parse(cache, (name, "javascript"), SOURCE)
+    assert cache.stats()["entries"] == 2
+    assert _parse(cache, ("a.js", "javascript"), SOURCE)[1] == "miss"
+
+    capped = engine.ParseTreeCache(1 << 30, max_entries=1)
+    _parse(capped, ("a.js", "javascript"), SOURCE)
+    _parse(capped, ("b.js", "javascript"), SOURCE)
+    assert capped.stats()["entries"] == 1
+    assert capped.stats()["evictions"] == 1
+
+
+def test_entry_larger_than_budget_is_not_cached():
+    cache = engine.ParseTreeCache(len(SOURCE) * 2)
+    _parse(cache, ("a.js", "javascript"), SOURCE)
+    assert cache.stats()["entries"] == 0
+    assert cache.stats()["bytes"] == 0
+
+
+def test_rescan_after_edit_is_incremental(write_file):
+    path = write_file("app.js", SOURCE.decode())
+    first = json.loads(engine.scan_dependencies("", "a", path, "javascript", format="json"))
+    assert first["dependencies"] == ["b"]
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("function c() { a(); }\n")
+    second = json.loads(engine.scan_dependencies("", "c", path, "javascript", format="json"))
+    assert second["cache"]["parse"] == "incremental"
+    assert second["dependencies"] == ["a"]
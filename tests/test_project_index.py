@@ -0,0 +1,55 @@
+import pytest
+
+import mcp_edit_math as engine
+
+
+@pytest.fixture
+def project(tmp_path, write_file):
+    write_file("src/core.js", "function helper() { return 1; }\nfunction main() { helper(); }\n")
+    write_file("src/tool.py", "def run():\n    helper()\n")
+    write_file("vendor/lib.js", "function patched() { helper(); }\n")
+    return str(tmp_path), str(tmp_path / "index.sqlite")
+
+
+def test_find_callers_reads_the_index(project):
+    root, index_path = project
+    report = engine.index_project(root, index_path)
+    assert "reindexed: 3" in report
+
+    callers = engine.find_callers("helper", root, index_path)
+    assert "src/core.js:1 (function_declaration)" in callers
+    assert "main @ src/core.js" in callers
+    assert "run @ src/tool.py" in callers
+    assert "patched @ vendor/lib.js" in callers
+
+
+def test_refresh_only_reindexes_changed_files(project, write_file):
+    root, index_path = project
+    engine.index_project(root, index_path)
+    write_file("src/core.js", "function helper() { return 2; }\n")
+    report = engine.index_project(root, index_path)
+    assert "reindexed: 1, unchanged: 2" in report
+    assert "main @" not in engine.find_callers("helper", root, index_path)
+
+
+def test_refresh_keeps_the_excluded_directories(project, write_file):
+    root, index_path = project
+    report = engine.index_project(root, index_path, exclude_dirs=["vendor"])
+    assert "Files: 2" in report
+
+    write_file("vendor/more.js", "function extra() { helper(); }\n")
+    for refreshed in (engine.find_callers("helper", root, index_path, refresh=True),
+                      engine.scan_impact("helper", root_dir=root, index_path=index_path, refresh=True)):
+        assert "vendor/" not in refreshed
+
+    # Явный index_project без exclude_dirs оставляет сохраненный набор.
+    assert "Files: 2" in engine.index_project(root, index_path)
+    assert "Files: 4" in engine.index_project(root, index_path, exclude_dirs=[])
+
+
+def test_removed_files_leave_the_index(project, tmp_path):
+    root, index_path = project
+    engine.index_project(root, index_path)
+    (tmp_path / "src" / "tool.py").unlink()
+    assert "removed: 1" in engine.index_project(root, index_path)
+    assert "run @" not in engine.find_callers("helper", root, index_path)
@@ -0,0 +1,48 @@
+import json
+
+import pytest
+
+import mcp_edit_math as engine
+
+CODE = "class A:\n    def run(self):\n        self.step()\n        helper(len([]))\n\n    def step(self):\n        pass\n\n\ndef helper(x):\n    return x\n"
+
+
+def _scan(code: str, target: str, path: str = "") -> dict:
+    return json.loads(engine.scan_dependencies(code, target, path, "python", format="json"))
+
+
+@pytest.mark.parametrize("backend", ["ast", "tree-sitter"])
+def test_backends_agree_on_valid_code(monkeypatch, backend):
+    monkeypatch.setattr(engine, "PYTHON_BACKEND", backend)
+    assert _scan(CODE, "run")["dependencies"] == ["helper", "step"]
+
+
+def test_backend_indexes_match():
+    source = CODE.encode()
+    ts_index = engine._build_python_ts_index(engine.get_parser("python").parse(source))
+    ast_index = engine._build_python_index(engine.ast.parse(source))
+    assert {n: sorted(d.calls) for n, d in ts_index.by_name.items()} == \
+        {n: sorted(d.calls) for n, d in ast_index.by_name.items()}
+
+
+def test_syntax_error_gives_partial_result_with_tree_sitter(monkeypatch):
+    monkeypatch.setattr(engine, "PYTHON_BACKEND", "tree-sitter")
+    broken = CODE + "\ndef bad(:\n"
+    report = engine.scan_dependencies(broken, "run", "", "python")
+    assert "partial results" in report
+    assert _scan(broken, "run")["dependencies"] == ["helper", "step"]
+
+
+def test_syntax_error_is_reported_by_ast(monkeypatch):
+    monkeypatch.setattr(engine, "PYTHON_BACKEND", "ast")
+    report = engine.scan_dependencies(CODE + "\ndef bad(:\n", "run", "", "python")
+    assert "Syntax Error" in report
+
+
+def test_rescan_after_edit_is_incremental(monkeypatch, write_file):
+    monkeypatch.setattr(engine, "PYTHON_BACKEND", "tree-sitter")
+    path = write_file("m.py", CODE)
+    assert _scan(CODE, "run", path)["cache"]["parse"] == "miss"
+    edited = CODE.replace("return x", "return x + 1")
+    assert _scan(edited, "run", path)["cache"]["parse"] == "incremental"
+    assert _scan(edited, "run", path)["cache"]["parse"] == "hit"
@@ -0,0 +1,78 @@
+import asyncio
+import json
+import os
+import time
+
+import pytest
+
+import mcp_edit_math as engine
+from benchmarks.corpus import Case, generate
+
+
+def _hog(megabytes: int) -> int:
+    held = bytearray(megabytes * 1024 * 1024)
+    time.sleep(10)
+    return len(held)
+
+
+@pytest.fixture
+def supervisor():
+    sandbox = engine.ScanSupervisor(2, timeout=2.0, max_rss_bytes=256 * 1024 * 1024)
+    yield sandbox
+    # Замены стартуют в фоне: дожидаемся их, чтобы не оставить процессы.
+    deadline = time.monotonic() + 60
+    while sandbox.stats()["idle"] < sandbox.stats()["alive"] and time.monotonic() < deadline:
+        time.sleep(0.05)
+    for worker in list(sandbox._idle):
+        worker.stop()
+
+
+def test_worker_runs_and_remembers_files(supervisor):
+    assert supervisor.run(len, "abc", key="a.js") == 3
+    assert supervisor.run(len, "abcd", key="a.js") == 4
+    assert supervisor.stats()["alive"] == 1
+    assert "a.js" in supervisor._idle[0].recent
+    with pytest.raises(RuntimeError, match="ZeroDivisionError"):
+        supervisor.run(divmod, 1, 0)
+
+
+@pytest.mark.parametrize("fn, args, reason", [
+    (time.sleep, (30,), "timeout"),
+    (os._exit, (3,), "crash"),
+    (_hog, (512,), "memory"),
+])
+def test_runaway_worker_is_killed_and_replaced(supervisor, fn, args, reason):
+    if reason == "memory" and not os.path.exists(f"/proc/{os.getpid()}/statm"):
+        pytest.skip("RSS is read from /proc")
+    started = time.monotonic()
+    with pytest.raises(engine.ScanTooExpensive) as error:
+        supervisor.run(fn, *args)
+    assert error.value.reason == reason
+    assert time.monotonic() - started < 10
+    assert supervisor.stats()[f"killed_{reason}"] == 1
+    # Следующий запрос обслуживает замена.
+    assert supervisor.run(len, "ok") == 2
+
+
+def test_expensive_scan_reports_and_keeps_access_revoked(supervisor, monkeypatch, write_file):
+    path = write_file("big.js", generate(Case("javascript", "minified", "large")))
+    supervisor.timeout = 0.01
+    monkeypatch.setattr(engine, "SCAN_SANDBOX_ENABLED", True)
+    monkeypatch.setattr(engine, "SCAN_SANDBOX", supervisor)
+    monkeypatch.setattr(engine, "SCAN_WARM_WORKERS", 0)
+    engine.APPROVAL_STATE[engine.get_state_key(path, "ENTIRE_FILE")] = "APPROVED"
+
+    content, _ = asyncio.run(engine.mcp.call_tool("scan_dependencies", {"file_path": path, "format": "json"}))
+    result = json.loads(content[0].text)
+    assert result == {"ok": False, "state": "NONE", "error": "scan_too_expensive", "reason": "timeout",
+                      "detail": "the scan ran longer than 0.01s", "elapsed_ms": result["elapsed_ms"]}
+    assert result["elapsed_ms"] >= 10
+    assert engine.APPROVAL_STATE[engine.get_state_key(path, "ENTIRE_FILE")] == "NONE"
+
+
+def test_expensive_scan_json_reports_the_stored_state():
+    # Другой клиент успел перевести цель в PENDING: ответ показывает фактическое состояние.
+    engine.APPROVAL_STATE[engine.get_state_key("f.js", "a")] = "PENDING"
+    arguments = {"file_path": "f.js", "target_function": "a", "format": "json"}
+    result = json.loads(engine._scan_too_expensive(arguments, engine.ScanTooExpensive("memory", "too big"), time.perf_counter()))
+    assert result["state"] == "PENDING" and result["reason"] == "memory" and result["elapsed_ms"] >= 0
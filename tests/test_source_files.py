@@ -0,0 +1,46 @@
+import json
+import os
+
+import mcp_edit_math as engine
+
+
+def test_cache_revalidates_on_mtime_and_size(write_file):
+    cache = engine.SourceFileCache(1 << 20)
+    path = write_file("a.js", "function a() {}\n")
+    assert cache.read(path) == b"function a() {}\n"
+    assert cache.read(path) == b"function a() {}\n"
+    assert cache.stats()["hits"] == 1
+
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("function a() { b(); }\n")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    assert cache.read(path) == b"function a() { b(); }\n"
+    assert cache.stats() == {"entries": 1, "bytes": 22, "hits": 1, "misses": 2}
+
+
+def test_cache_is_bounded(write_file):
+    cache = engine.SourceFileCache(40)
+    for name in ("a.js", "b.js", "c.js"):
+        cache.read(write_file(name, "x" * 16))
+    assert cache.stats()["entries"] == 2
+    cache.read(write_file("big.js", "x" * 64))
+    assert cache.stats()["bytes"] <= 40
+
+
+def test_large_files_are_read_through_mmap(write_file, monkeypatch):
+    monkeypatch.setattr(engine, "MMAP_THRESHOLD_BYTES", 8)
+    path = write_file("a.js", "function a() { b(); }\n" * 100)
+    assert engine._read_file_bytes(path, os.path.getsize(path)) == ("function a() { b(); }\n" * 100).encode()
+
+
+def test_scan_reads_the_file_when_code_is_empty(write_file):
+    path = write_file("a.py", "def a():\n    b()\n")
+    result = json.loads(engine.scan_dependencies("", "a", path, "python", format="json"))
+    assert result["dependencies"] == ["b"]
+    assert result["base_hash"] == engine._file_hash(b"def a():\n    b()\n")
+
+
+def test_scan_of_a_missing_file_is_an_error(tmp_path):
+    result = engine.scan_dependencies("", "a", str(tmp_path / "missing.js"))
+    assert result.lstrip().startswith("❌ ERROR")
@@ -0,0 +1,41 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _run(code: str) -> dict:
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    completed = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True, timeout=120)
+    assert completed.returncode == 0, completed.stderr
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def test_grammars_load_on_first_use():
+    result = _run(
+        "import json, sys\n"
+        "import mcp_edit_math as m\n"
+        "before = sorted(m._PARSERS)\n"
+        "m.scan_dependencies('function a() { b(); }', 'a', '', 'javascript')\n"
+        "print(json.dumps({'before': before, 'after': sorted(m._PARSERS),\n"
+        "                  'grammar_modules': sorted(k for k in sys.modules if k.startswith('tree_sitter_') and '.' not in k)}))\n"
+    )
+    assert result["before"] == []
+    assert result["after"] == ["javascript"]
+    assert result["grammar_modules"] == ["tree_sitter_javascript"]
+
+
+def test_python_only_mode_without_tree_sitter():
+    result = _run(
+        "import json, sys\n"
+        "sys.modules['tree_sitter'] = None\n"
+        "import mcp_edit_math as m\n"
+        "py = m.scan_dependencies('def a():\\n    b()\\n', 'a', '', 'python', format='json')\n"
+        "js = m.scan_dependencies('function a() { b(); }', 'a', '', 'javascript')\n"
+        "print(json.dumps({'available': m.TREE_SITTER_AVAILABLE, 'py': json.loads(py), 'js': js}))\n"
+    )
+    assert result["available"] is False
+    assert result["py"]["dependencies"] == ["b"]
+    assert "Python-only mode" in result["js"]
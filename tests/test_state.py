@@ -0,0 +1,118 @@
+import multiprocessing
+
+import pytest
+
+import mcp_edit_math as engine
+
+
+def _backends(tmp_path):
+    return [engine.MemoryStateBackend(), engine.SQLiteStateBackend(str(tmp_path / "state.sqlite"))]
+
+
+@pytest.mark.parametrize("kind", ["memory", "sqlite"])
+def test_default_set_and_transition(tmp_path, kind):
+    backend = _backends(tmp_path)[0 if kind == "memory" else 1]
+    assert backend["a::f"] == "NONE"
+    backend["a::f"] = "PENDING"
+    assert not backend.transition("a::f", "NONE", "APPROVED")
+    assert backend.transition("a::f", "PENDING", "APPROVED")
+    assert backend["a::f"] == "APPROVED"
+    backend["a::f"] = "NONE"
+    assert len(backend) == 0
+
+
+@pytest.mark.parametrize("kind", ["memory", "sqlite"])
+def test_expired_states_read_as_none(tmp_path, kind):
+    backend = _backends(tmp_path)[0 if kind == "memory" else 1]
+    backend["a::f"] = "APPROVED"
+    backend.ttl_seconds = 1e-9
+    assert backend["a::f"] == "NONE"
+
+
+def test_memory_backend_evicts_least_recently_used():
+    backend = engine.MemoryStateBackend(max_entries=2)
+    backend["a"] = "PENDING"
+    backend["b"] = "PENDING"
+    backend["a"] = "APPROVED"
+    backend["c"] = "PENDING"
+    assert backend["b"] == "NONE"
+    assert backend["a"] == "APPROVED"
+
+
+def _approve(path: str, key: str) -> None:
+    engine.SQLiteStateBackend(path).transition(key, "PENDING", "APPROVED")
+
+
+def test_sqlite_backend_is_shared_between_processes(tmp_path):
+    path = str(tmp_path / "state.sqlite")
+    backend = engine.SQLiteStateBackend(path)
+    backend["a::f"] = "PENDING"
+    process = multiprocessing.get_context("spawn").Process(target=_approve, args=(path, "a::f"))
+    process.start()
+    process.join(60)
+    assert process.exitcode == 0
+    assert backend["a::f"] == "APPROVED"
+
+
+def test_unknown_backend_is_rejected():
+    with pytest.raises(ValueError):
+        engine.create_state_backend("redis")
+
+
+class _RescanAfterRead(engine.MemoryStateBackend):
+    """Simulates a rescan in another process landing between a tool's read and its write."""
+
+    def __init__(self, key: str):
+        super().__init__()
+        self.key = key
+        self.armed = False
+
+    def get(self, key, default="NONE"):
+        state = super().get(key, default)
+        if self.armed and key == self.key:
+            self.armed = False
+            super().set(key, "NONE")
+        return state
+
+
+def _score(**extra):
+    return engine.calculate_integrity_score("a", ["b"], ["b"], "f.js", proposed_header="renamed", **extra)
+
+
+def test_rescan_between_read_and_grant_wins(monkeypatch):
+    key = engine.get_state_key("f.js", "a")
+    backend = _RescanAfterRead(key)
+    monkeypatch.setattr(engine, "APPROVAL_STATE", backend)
+    assert "STRICT MODE" in _score()
+
+    backend.armed = True
+    result = _score(user_last_message="ok")
+    assert result.startswith("⛔ ACCESS DENIED") and "changed during this call" in result
+    assert backend[key] == "NONE"
+
+
+def test_rescan_between_read_and_pending_wins(monkeypatch):
+    key = engine.get_state_key("f.js", "a")
+    backend = _RescanAfterRead(key)
+    monkeypatch.setattr(engine, "APPROVAL_STATE", backend)
+    backend.set(key, "APPROVED")
+    backend.armed = True
+    # Прочитано APPROVED, сканирование сбросило в NONE: повторное одобрение не проходит молча.
+    assert '"error":"state_changed"' in _score(format="json", user_last_message="ok")
+    assert backend[key] == "NONE"
+
+
+def test_failed_commit_does_not_undo_a_concurrent_rescan(monkeypatch, write_file):
+    path = write_file("f.js", "function a() {}\n")
+    key = engine.get_state_key(path, "a")
+    engine.APPROVAL_STATE[key] = "APPROVED"
+
+    def rescan_then_fail(src, dst):
+        engine._reset_scan_state(key)
+        engine.APPROVAL_STATE[key] = "PENDING"
+        raise OSError("disk full")
+
+    monkeypatch.setattr(engine.os, "replace", rescan_then_fail)
+    assert "disk full" in engine.commit_safe_edit("a", path, full_file_content="x")
+    monkeypatch.undo()
+    assert engine.APPROVAL_STATE[key] == "PENDING"
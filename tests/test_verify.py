@@ -0,0 +1,49 @@
+import mcp_edit_math as engine
+
+JS = "function a() {\n  b();\n}\n\nfunction b() {\n  return 1;\n}\n\nfunction c() {\n  return 2;\n}\n"
+PY = "def a():\n    b()\n\n\n@decorator\ndef b():\n    return 1\n"
+
+
+def _verify(path: str, old: str, new: str, targets=("a",)) -> str:
+    engine.scan_dependencies("", "a", path)
+    return "\n".join(engine._verify_commit(path, old.encode(), new.encode(), set(targets)))
+
+
+def test_edit_inside_the_target_is_clean(write_file):
+    path = write_file("f.js", JS)
+    report = _verify(path, JS, JS.replace("  b();", "  b();\n  b();"))
+    assert "✅ All changes stay inside: a" in report and "✅ No new callees." in report
+    assert "old tree: hit" in report and "new tree: incremental" in report
+
+
+def test_out_of_scope_edit_and_new_callee_are_reported(write_file):
+    path = write_file("f.js", JS)
+    new = JS.replace("return 2;", "return d();")
+    report = _verify(path, JS, new)
+    assert "⚠️ OUT OF SCOPE (a): c (line 10)" in report
+    assert "⚠️ NEW CALLEES: c: d" in report
+
+
+def test_removed_definition_is_listed(write_file):
+    path = write_file("f.js", JS)
+    new = JS.replace("function c() {\n  return 2;\n}\n", "")
+    assert "Removed definitions: c" in _verify(path, JS, new, ["ENTIRE_FILE"])
+
+
+def test_python_decorator_edit_belongs_to_its_definition(write_file):
+    path = write_file("f.py", PY)
+    report = _verify(path, PY, PY.replace("@decorator", "@other"), ["b"])
+    assert "✅ All changes stay inside: b" in report
+
+
+def test_commit_with_verify_appends_the_report(write_file):
+    path = write_file("f.js", JS)
+    engine.scan_dependencies("", "a", path)
+    engine.APPROVAL_STATE[engine.get_state_key(path, "a")] = "APPROVED"
+    result = engine.commit_safe_edit("a", path, full_file_content=JS.replace("b();", "b(); e();"), verify=True)
+    assert "SAFE COMMIT" in result and "⚠️ NEW CALLEES: a: e" in result
+
+
+def test_unsupported_language_is_reported(write_file):
+    path = write_file("f.html", "<p>x</p>")
+    assert engine._verify_commit(path, b"<p>x</p>", b"<p>y</p>", {"a"})[0].startswith("VERIFICATION: unavailable")